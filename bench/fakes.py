@@ -0,0 +1,308 @@
+"""ベンチマーク用の Discord / Gemini の代役
+
+本物の Cog や gemini モジュールのコードをそのまま動かすため、
+実際に使われている属性とメソッドだけを持つ偽物を用意する。
+"""
+import asyncio
+import itertools
+import random
+import time
+from dataclasses import dataclass, field
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Optional
+
+import discord
+from google.genai import errors, types
+
+_ids = itertools.count(1_300_000_000_000_000_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+# --- Discord ---
+
+class FakeMessage:
+    def __init__(self, webhook: "FakeFollowup", **kwargs):
+        self.id = next_id()
+        self.webhook = webhook
+        self.kwargs = kwargs
+        self.edits = 0
+
+    async def edit(self, **kwargs) -> "FakeMessage":
+        await self.webhook.delay()
+        self.kwargs.update(kwargs)
+        self.edits += 1
+        self.webhook.record("edit")
+        return self
+
+
+class FakeFollowup:
+    """interaction.followup の代役。送信・編集ごとに Discord の REST 呼び出し分だけ待つ"""
+
+    def __init__(self, itx: "FakeInteraction", latency: float):
+        self.itx = itx
+        self.latency = latency
+        self.messages: list[FakeMessage] = []
+
+    async def delay(self) -> None:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def record(self, kind: str) -> None:
+        if self.itx.first_output is None:
+            self.itx.first_output = time.perf_counter()
+        self.itx.calls.append(kind)
+
+    async def send(self, content: Any = None, *, wait: bool = False, **kwargs) -> Optional[FakeMessage]:
+        await self.delay()
+        for file in [kwargs.get("file"), *(kwargs.get("files") or [])]:
+            if isinstance(file, discord.File):
+                self.itx.bytes_sent += len(file.fp.getbuffer()) if isinstance(file.fp, BytesIO) else 0
+        message = FakeMessage(self, content=content, **kwargs)
+        self.messages.append(message)
+        self.record("send")
+        return message if wait else None
+
+
+class FakeResponse:
+    def __init__(self, itx: "FakeInteraction", latency: float):
+        self.itx = itx
+        self.latency = latency
+        self._done = False
+        self.modal: Optional[discord.ui.Modal] = None
+        self.sent: dict[str, Any] = {}
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _respond(self, kind: str) -> None:
+        if self._done:
+            raise RuntimeError("interaction already responded")
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        self._done = True
+        self.itx.calls.append(kind)
+
+    async def defer(self, **kwargs) -> None:
+        await self._respond("defer")
+
+    async def send_message(self, *args, **kwargs) -> None:
+        await self._respond("send_message")
+        self.sent = kwargs
+        if self.itx.first_output is None:
+            self.itx.first_output = time.perf_counter()
+
+    async def edit_message(self, **kwargs) -> None:
+        await self._respond("edit_message")
+
+    async def send_modal(self, modal: discord.ui.Modal) -> None:
+        await self._respond("send_modal")
+        self.modal = modal
+
+
+class FakeUser:
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.display_avatar = None
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeBot:
+    """Cog が参照する commands.Bot の属性だけを持つ"""
+
+    def __init__(self):
+        self.user = FakeUser(next_id(), "custom-ai-bot")
+        self.cogs: dict[str, Any] = {}
+
+    def get_cog(self, name: str) -> Any:
+        return self.cogs.get(name)
+
+
+class FakeInteraction:
+    def __init__(self, bot: FakeBot, user: FakeUser, rest_latency: float = 0.05):
+        self.id = next_id()
+        self.client = bot
+        self.user = user
+        self.response = FakeResponse(self, rest_latency)
+        self.followup = FakeFollowup(self, rest_latency)
+        self.calls: list[str] = []
+        self.first_output: Optional[float] = None
+        self.bytes_sent = 0
+
+
+class FakeAttachment:
+    def __init__(self, data: bytes, content_type: str, filename: str, read_latency: float = 0.05):
+        self.data = data
+        self.content_type = content_type
+        self.filename = filename
+        self.size = len(data)
+        self.read_latency = read_latency
+
+    async def read(self) -> bytes:
+        if self.read_latency > 0:
+            await asyncio.sleep(self.read_latency)
+        return self.data
+
+    def is_spoiler(self) -> bool:
+        return False
+
+
+# --- Gemini ---
+
+@dataclass
+class FakeGeminiOptions:
+    latency: float = 0.8              # 応答全体にかかる秒数
+    jitter: float = 0.3               # latency に加えるばらつき (割合)
+    first_chunk: float = 0.3          # ストリーミングで最初のチャンクが届くまでの秒数
+    chunks: int = 12
+    output_chars: int = 1500
+    image_latency: float = 4.0
+    image_bytes: bytes = b""
+    error_rate: float = 0.0           # 429/503 を返す確率
+    error_codes: tuple[int, ...] = (429, 503)
+    seed: int = 0
+    calls: dict[str, int] = field(default_factory=dict)
+
+
+def _count_tokens(contents: list[types.Content]) -> int:
+    tokens = 0
+    for content in contents:
+        for part in content.parts or []:
+            if part.text:
+                tokens += len(part.text) // 2 + 1
+            elif part.inline_data or part.file_data:
+                tokens += 258
+    return tokens
+
+
+def _as_parts(message: Any) -> list[types.Part]:
+    items = message if isinstance(message, list) else [message]
+    return [types.Part(text=item) if isinstance(item, str) else item for item in items]
+
+
+class FakeGemini:
+    """genai.Client の代役。gemini モジュールが使う aio.* のメソッドだけを実装する"""
+
+    def __init__(self, options: FakeGeminiOptions):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.aio = SimpleNamespace(
+            chats=SimpleNamespace(create=self._create_chat),
+            models=SimpleNamespace(generate_content=self._generate_content),
+            caches=SimpleNamespace(create=self._create_cache, update=self._noop, delete=self._noop),
+            files=SimpleNamespace(upload=self._upload, get=self._get_file),
+        )
+
+    def _count(self, name: str) -> None:
+        self.options.calls[name] = self.options.calls.get(name, 0) + 1
+
+    def _latency(self, base: float) -> float:
+        return max(0.0, base * (1 + self.random.uniform(-self.options.jitter, self.options.jitter)))
+
+    def _maybe_fail(self) -> None:
+        if self.options.error_rate and self.random.random() < self.options.error_rate:
+            code = self.random.choice(self.options.error_codes)
+            self._count(f"error_{code}")
+            raise errors.APIError(code, {"error": {"code": code, "message": "injected by bench", "status": "UNAVAILABLE"}})
+
+    def _text(self) -> str:
+        words = ["Gemini", "の", "応答", "です。", "テスト", "文章", "\n", "**強調**", "`code`", "リンク"]
+        out: list[str] = []
+        size = 0
+        while size < self.options.output_chars:
+            word = self.random.choice(words)
+            out.append(word)
+            size += len(word)
+        return "".join(out)
+
+    def _response(self, text: Optional[str], prompt_tokens: int, image: Optional[bytes] = None) -> types.GenerateContentResponse:
+        parts = []
+        if text:
+            parts.append(types.Part(text=text))
+        if image:
+            parts.append(types.Part(inline_data=types.Blob(mime_type="image/png", data=image)))
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=len(text or "") // 2,
+            ),
+        )
+
+    def _create_chat(self, *, model: str, config: Any = None, history: Optional[list[types.Content]] = None) -> "FakeChat":
+        return FakeChat(self, list(history or []))
+
+    async def _generate_content(self, *, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        self._count("generate_content")
+        contents = contents if isinstance(contents, list) else [contents]
+        is_image = bool(config and getattr(config, "response_modalities", None))
+        await asyncio.sleep(self._latency(self.options.image_latency if is_image else self.options.latency))
+        self._maybe_fail()
+        if is_image:
+            return self._response("生成した画像です", _count_tokens(contents), self.options.image_bytes)
+        return self._response(self._text(), _count_tokens(contents))
+
+    async def _create_cache(self, *, model: str, config: Any = None) -> SimpleNamespace:
+        self._count("caches.create")
+        await asyncio.sleep(self._latency(self.options.latency / 2))
+        return SimpleNamespace(name=f"cachedContents/{next_id()}")
+
+    async def _upload(self, *, file: Any, config: Any = None) -> types.File:
+        self._count("files.upload")
+        await asyncio.sleep(self._latency(self.options.latency))
+        name = f"files/{next_id()}"
+        return types.File(name=name, uri=f"https://fake.invalid/{name}", state=types.FileState.ACTIVE)
+
+    async def _get_file(self, *, name: str) -> types.File:
+        return types.File(name=name, uri=f"https://fake.invalid/{name}", state=types.FileState.ACTIVE)
+
+    async def _noop(self, **kwargs) -> None:
+        return None
+
+
+class FakeChat:
+    """AsyncChat の代役。送信した内容と応答を履歴に積む"""
+
+    def __init__(self, client: FakeGemini, history: list[types.Content]):
+        self.client = client
+        self.history = history
+
+    def get_history(self, curated: bool = False) -> list[types.Content]:
+        return list(self.history)
+
+    async def send_message(self, message: Any, config: Any = None) -> types.GenerateContentResponse:
+        self.client._count("send_message")
+        user = types.Content(role="user", parts=_as_parts(message))
+        await asyncio.sleep(self.client._latency(self.client.options.latency))
+        self.client._maybe_fail()
+        response = self.client._response(self.client._text(), _count_tokens([*self.history, user]))
+        self.history += [user, response.candidates[0].content] # type: ignore
+        return response
+
+    async def send_message_stream(self, message: Any, config: Any = None) -> AsyncIterator[types.GenerateContentResponse]:
+        self.client._count("send_message_stream")
+        options = self.client.options
+        user = types.Content(role="user", parts=_as_parts(message))
+        await asyncio.sleep(self.client._latency(options.first_chunk))
+        self.client._maybe_fail()
+        text = self.client._text()
+        prompt_tokens = _count_tokens([*self.history, user])
+        step = max(1, len(text) // options.chunks)
+        rest = max(0.0, options.latency - options.first_chunk) / options.chunks
+
+        async def stream() -> AsyncIterator[types.GenerateContentResponse]:
+            for i in range(0, len(text), step):
+                if i:
+                    await asyncio.sleep(self.client._latency(rest))
+                chunk = self.client._response(text[i:i + step], prompt_tokens)
+                self.history += [user, chunk.candidates[0].content] if i == 0 else [chunk.candidates[0].content] # type: ignore
+                yield chunk
+
+        return stream()
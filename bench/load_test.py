@@ -0,0 +1,278 @@
+"""Discord と Gemini を偽物に置き換えて、本物の Cog のコードに負荷をかけるベンチマーク
+
+    python -m bench.load_test --requests 200 --concurrency 20
+    python -m bench.load_test --mix ask=5,reply=3,attach=1,image=1 --error-rate 0.05 --json result.json
+
+/ask・/image・返信 (ReplyModal)・添付付きの /ask を混ぜて実行し、
+レイテンシ (p50/p95/p99)、最初の出力までの時間、スループット、ピーク RSS、イベントループの遅延を表示する。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from io import BytesIO
+
+# bot を読み込む前に、実行環境に依存する設定を差し替える
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench-data-"))
+os.environ.setdefault("STREAM_EDIT_INTERVAL", "0.5")
+
+from bench.fakes import (FakeAttachment, FakeBot, FakeGemini, FakeGeminiOptions,  # noqa: E402
+                         FakeInteraction, FakeUser, next_id)
+from bot import gemini  # noqa: E402
+from bot.cogs.chat import ChatCog, ReplyModal  # noqa: E402
+from bot.config import Config  # noqa: E402
+
+
+def make_image(size: int = 2048) -> bytes:
+    from PIL import Image
+    img = Image.effect_noise((size, size), 64).convert("RGB")
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def make_png(size: int = 1024) -> bytes:
+    from PIL import Image
+    buf = BytesIO()
+    Image.effect_noise((size, size), 32).convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@dataclass
+class Result:
+    kind: str
+    latency: float
+    first_output: float | None
+    ok: bool
+
+
+@dataclass
+class Report:
+    results: list[Result] = field(default_factory=list)
+    loop_lags: list[float] = field(default_factory=list)
+    wall: float = 0.0
+
+
+class LoopLagMonitor:
+    """interval 秒ごとに起きるタスクの遅れを測る"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class Workload:
+    def __init__(self, args: argparse.Namespace, bot: FakeBot, cog: ChatCog):
+        self.args = args
+        self.bot = bot
+        self.cog = cog
+        self.random = random.Random(args.seed)
+        self.users = [FakeUser(next_id(), f"user{i}") for i in range(args.users)]
+        self.mix = self._parse_mix(args.mix)
+        self.conversations: list[int] = []  # 返信できる会話のセッションID
+        self.image = make_image() if "attach" in self.mix else b""
+
+    @staticmethod
+    def _parse_mix(text: str) -> dict[str, float]:
+        mix = {}
+        for item in text.split(","):
+            name, _, weight = item.partition("=")
+            mix[name.strip()] = float(weight or 1)
+        unknown = set(mix) - {"ask", "reply", "attach", "image"}
+        if unknown:
+            raise SystemExit(f"unknown request kinds: {', '.join(sorted(unknown))}")
+        return mix
+
+    def _itx(self) -> FakeInteraction:
+        return FakeInteraction(self.bot, self.random.choice(self.users), self.args.rest_latency)
+
+    def _question(self) -> str:
+        # 一部は同じ質問にして、応答キャッシュが効く状況も作る
+        if self.random.random() < self.args.duplicate_rate:
+            return "今日のお知らせのリンク先について教えて"
+        return f"質問 {self.random.randrange(10 ** 9)} について詳しく説明してください"
+
+    async def run_one(self) -> Result:
+        kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if kind == "reply" and not self.conversations:
+            kind = "ask"
+        itx = self._itx()
+        start = time.perf_counter()
+        ok = True
+        try:
+            if kind == "ask":
+                await self.cog.ask.callback(self.cog, itx, text=self._question()) # type: ignore
+                self.conversations.append(itx.id)
+            elif kind == "attach":
+                attachment = FakeAttachment(self.image, "image/jpeg", "photo.jpg", self.args.rest_latency)
+                await self.cog.ask.callback(self.cog, itx, text="この画像について説明して", file=attachment) # type: ignore
+                self.conversations.append(itx.id)
+            elif kind == "image":
+                await self.cog.image.callback(self.cog, itx, prompt="夕焼けの海辺の猫", count=self.args.image_count) # type: ignore
+            else:
+                # 深い返信の連鎖になるよう、最近の会話ほど選ばれやすくする
+                parent_id = self.conversations[-1 - min(int(self.random.expovariate(0.5)), len(self.conversations) - 1)]
+                branch = gemini.chats.get(parent_id)
+                if branch is None:
+                    kind = "ask"
+                    await self.cog.ask.callback(self.cog, itx, text=self._question()) # type: ignore
+                else:
+                    modal = ReplyModal(original_itx=itx, chat_id=parent_id, last_idx=len(branch))
+                    modal.reply_text._value = "もう少し詳しく教えて"
+                    await modal.on_submit(itx) # type: ignore
+                self.conversations.append(itx.id)
+        except Exception:
+            ok = False
+        latency = time.perf_counter() - start
+        # エラー (利用上限による拒否を含む) は Cog が埋め込みで返すため、送信内容から判定する
+        for message in [*itx.followup.messages, itx.response]:
+            embed = message.sent.get("embed") if message is itx.response else message.kwargs.get("embed")
+            if embed is not None and embed.title == Config.EMBED_SET["error"]["title"]:
+                ok = False
+        first = itx.first_output - start if itx.first_output is not None else None
+        return Result(kind, latency, first, ok)
+
+
+async def run(args: argparse.Namespace) -> Report:
+    options = FakeGeminiOptions(
+        latency=args.latency,
+        first_chunk=args.first_chunk,
+        image_latency=args.image_latency,
+        output_chars=args.output_chars,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        image_bytes=make_png(),
+    )
+    gemini._client = FakeGemini(options) # type: ignore
+    Config.STREAM_RESPONSE = not args.no_stream
+    bot = FakeBot()
+    cog = ChatCog(bot) # type: ignore
+    bot.cogs["ChatCog"] = cog
+    workload = Workload(args, bot, cog)
+
+    report = Report()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    remaining = args.requests
+    interval = 1 / args.rate if args.rate else 0.0
+
+    async def worker() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            report.results.append(await workload.run_one())
+            if interval:
+                await asyncio.sleep(interval * args.concurrency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    report.wall = time.perf_counter() - started
+    await monitor.stop()
+    report.loop_lags = monitor.samples
+    await gemini.session_db.flush()
+    print(f"gemini calls: {options.calls}", file=sys.stderr)
+    return report
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(p) - 1]
+
+
+def summarize(report: Report) -> dict:
+    rows = {}
+    kinds = sorted({r.kind for r in report.results})
+    for kind in ["all", *kinds]:
+        results = [r for r in report.results if kind == "all" or r.kind == kind]
+        latencies = [r.latency for r in results]
+        firsts = [r.first_output for r in results if r.first_output is not None]
+        rows[kind] = {
+            "count": len(results),
+            "errors": sum(not r.ok for r in results),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "first_output_p50": percentile(firsts, 50),
+            "first_output_p95": percentile(firsts, 95),
+        }
+    return {
+        "requests": len(report.results),
+        "wall_seconds": report.wall,
+        "throughput_rps": len(report.results) / report.wall if report.wall else 0.0,
+        # Linux では KB 単位
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "loop_lag_ms": {
+            "p50": percentile(report.loop_lags, 50) * 1000,
+            "p99": percentile(report.loop_lags, 99) * 1000,
+            "max": max(report.loop_lags, default=0.0) * 1000,
+        },
+        "latency": rows,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f"requests: {summary['requests']}  wall: {summary['wall_seconds']:.2f}s  "
+          f"throughput: {summary['throughput_rps']:.2f} req/s  peak RSS: {summary['peak_rss_mb']:.1f}MB")
+    lag = summary["loop_lag_ms"]
+    print(f"event loop lag: p50 {lag['p50']:.1f}ms  p99 {lag['p99']:.1f}ms  max {lag['max']:.1f}ms")
+    print(f"{'kind':<8} {'count':>6} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'first p50':>10} {'first p95':>10}")
+    for kind, row in summary["latency"].items():
+        print(f"{kind:<8} {row['count']:>6} {row['errors']:>6} {row['p50']:>7.2f}s {row['p95']:>7.2f}s {row['p99']:>7.2f}s "
+              f"{row['first_output_p50']:>9.2f}s {row['first_output_p95']:>9.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="偽の Discord / Gemini を使った負荷テスト")
+    parser.add_argument("--requests", type=int, default=200, help="実行するリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=20, help="同時に処理するリクエスト数")
+    parser.add_argument("--rate", type=float, default=0.0, help="全体のリクエスト/秒の上限 (0 で上限なし)")
+    parser.add_argument("--users", type=int, default=10, help="リクエストを送るユーザー数")
+    parser.add_argument("--mix", default="ask=5,reply=3,attach=1,image=1", help="種類ごとの比率")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="同じ質問を送る割合")
+    parser.add_argument("--latency", type=float, default=0.8, help="テキスト応答の秒数")
+    parser.add_argument("--first-chunk", type=float, default=0.3, help="ストリーミングの最初のチャンクまでの秒数")
+    parser.add_argument("--image-latency", type=float, default=4.0, help="画像生成の秒数")
+    parser.add_argument("--image-count", type=int, default=1, help="/image で生成する枚数")
+    parser.add_argument("--output-chars", type=int, default=1500, help="応答の文字数")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="Discord の REST 呼び出し1回の秒数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Gemini が 429/503 を返す確率")
+    parser.add_argument("--no-stream", action="store_true", help="ストリーミング表示を使わない")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    summary = summarize(asyncio.run(run(args)))
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
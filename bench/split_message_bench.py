@@ -0,0 +1,83 @@
+"""split_message のマイクロベンチマーク
+
+旧実装 (文字列の連結を繰り返す版) と MessageSplitter を大きな入力で比較する。
+
+    python -m bench.split_message_bench
+"""
+import random
+import string
+import timeit
+
+from bot.config import Config
+from bot.myutils import split_message
+
+
+def legacy_split_message(text, max_length=Config.MAX_CHUNK_LEN):
+    if len(text) <= max_length:
+        return [text]
+    chunks = []
+    current_chunk = ""
+    lines = text.split('\n')
+    for line in lines:
+        if len(line) > max_length:
+            sentences = line.split('。')
+            for sentence in sentences:
+                if sentence:
+                    sentence = sentence + '。' if not sentence.endswith('。') else sentence
+                    if len(current_chunk + sentence) > max_length:
+                        if current_chunk:
+                            chunks.append(current_chunk.strip())
+                            current_chunk = sentence
+                        else:
+                            chunks.append(sentence[:max_length])
+                            current_chunk = sentence[max_length:]
+                    else:
+                        current_chunk += sentence
+        else:
+            if len(current_chunk + '\n' + line) > max_length:
+                chunks.append(current_chunk.strip())
+                current_chunk = line
+            else:
+                current_chunk += '\n' + line if current_chunk else line
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+
+def _words(rng: random.Random, n: int) -> str:
+    return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(n))
+
+
+def make_inputs(size: int, seed: int = 0) -> dict[str, str]:
+    rng = random.Random(seed)
+    markdown = []
+    while sum(len(s) for s in markdown) < size:
+        kind = rng.random()
+        if kind < 0.1:
+            markdown.append("## " + _words(rng, 4))
+        elif kind < 0.25:
+            body = "\n".join("    " + _words(rng, 8) for _ in range(rng.randint(3, 30)))
+            markdown.append(f"```python\n{body}\n```")
+        else:
+            markdown.append(_words(rng, 60) + f" [link](https://example.com/{rng.randint(0, 9999)}) " + _words(rng, 20))
+    return {
+        "markdown": "\n".join(markdown)[:size],
+        "long sentences": ("あいうえおかきくけこ" * 20 + "。") * (size // 201),
+        "short sentences": "はい。" * (size // 3),
+        "one long line": "あ" * size,
+    }
+
+
+def main():
+    for size in (10_000, 100_000, 1_000_000):
+        for name, text in make_inputs(size).items():
+            row = []
+            for label, fn in (("legacy", legacy_split_message), ("splitter", split_message)):
+                number = max(1, 200_000 // size)
+                sec = min(timeit.repeat(lambda: fn(text), number=number, repeat=3)) / number
+                row.append(f"{label}: {sec * 1000:9.2f}ms")
+            print(f"{size:>9,} chars  {name:<15} " + "  ".join(row))
+
+
+if __name__ == "__main__":
+    main()
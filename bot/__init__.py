@@ -1,46 +1,131 @@
 import discord
+from discord import app_commands
 from discord.ext import commands
-import os
+import asyncio
+import importlib
 import logging
+import signal
+import threading
 import time
 from .config import Config
 from . import myutils
+from . import metrics
+from .command_sync import CommandSyncState, sync_commands
 
 # --- ロガー取得 (ハンドラは run.py で設定) ---
 logger = logging.getLogger(__name__)
 
+class DrainingCommandTree(app_commands.CommandTree):
+    """終了処理中は新しいコマンドを受け付けず、再起動中であることをすぐに返す"""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if getattr(self.client, "draining", False):
+            await interaction.response.send_message(embed=myutils.get_restarting_embed(), ephemeral=True)
+            return False
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
+        if isinstance(error, app_commands.CheckFailure) and getattr(self.client, "draining", False):
+            return
+        await super().on_error(interaction, error)
+
 # --- Botクラスの定義 ---
 class CUSTOM_AI_BOT(commands.Bot):
     def __init__(self):
         intents = discord.Intents.none()
         member_cache_flags = discord.MemberCacheFlags.none()
+        shard_options = {"shard_id": Config.SHARD_ID, "shard_count": Config.SHARD_COUNT} if Config.SHARD_COUNT else {}
         super().__init__(
             command_prefix=None,  # type: ignore
             intents=intents,
             member_cache_flags=member_cache_flags,
-            max_messages=None
+            max_messages=None,
+            tree_cls=DrainingCommandTree,
+            **shard_options
         )
         self.start_ts = time.perf_counter()
         self.guild_id = Config.GUILD_ID
+        self.force_sync = False
+        self.sync_state = CommandSyncState(Config.COMMAND_SYNC_STATE)
+        # 起動の各段階にかかった秒数 (print_banner で表示する)
+        self.phases: dict[str, float] = {}
+        self._phase_ts = self.start_ts
+        self.metrics_server: metrics.MetricsServer | None = None
+        self.draining = False
+        self._drain_task: asyncio.Task | None = None
+
+    def mark_phase(self, name: str) -> None:
+        now = time.perf_counter()
+        self.phases[name] = now - self._phase_ts
+        self._phase_ts = now
 
     async def setup_hook(self):
-        # cogsディレクトリからCogをロード
-        for filename in os.listdir('./bot/cogs'):
-            if filename.endswith('.py'):
-                try:
-                    await self.load_extension(f'bot.cogs.{filename[:-3]}')
-                    logger.info(f"Loaded cog: {filename}")
-                except Exception as e:
-                    logger.exception(f"Failed to load cog {filename}: {e}")
-
-        # コマンドを特定のギルドに同期
+        self.mark_phase("login")
+        try:
+            # fly.io はデプロイ時に SIGTERM を送り、kill_timeout 後に強制終了する
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._on_sigterm)
+        except NotImplementedError:
+            pass
+        if Config.SHARD_COUNT and guild_shard(self.guild_id, Config.SHARD_COUNT) != Config.SHARD_ID:
+            # Discord はギルドのインタラクションをそのギルドを担当するシャードにだけ送る
+            logger.warning(
+                f"Shard {Config.SHARD_ID}/{Config.SHARD_COUNT} does not own guild {self.guild_id} "
+                f"(shard {guild_shard(self.guild_id, Config.SHARD_COUNT)} does) and will receive no interactions from it"
+            )
+        if Config.METRICS_PORT:
+            # 準備ができるまで /healthz は 503 を返す
+            self.metrics_server = metrics.MetricsServer(Config.METRICS_HOST, Config.METRICS_PORT, self.is_healthy)
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"Failed to start metrics server: {e}")
+                self.metrics_server = None
+        # Config.COGS に並べた Cog をロード
+        for name in Config.COGS:
+            try:
+                await self.load_extension(name)
+                logger.info(f"Loaded cog: {name}")
+            except Exception as e:
+                logger.exception(f"Failed to load cog {name}: {e}")
+        self.mark_phase("cogs")
+
+        # コマンドを特定のギルドに同期 (前回の同期から変わっていなければ省略)
         guild = discord.Object(id=self.guild_id)
         try:
-            self.tree.copy_global_to(guild=guild)
-            await self.tree.sync(guild=guild)
-            logger.info(f"Synced commands to guild {self.guild_id}")
+            await sync_commands(self.tree, guild, self.sync_state, self.application_id, force=self.force_sync)
         except Exception as e:
             logger.exception(f"Failed to sync commands when starting\n{e}")
+        self.mark_phase("sync")
+
+    def is_healthy(self) -> bool:
+        return self.is_ready() and not self.is_closed() and not self.draining
+
+    def _on_sigterm(self) -> None:
+        if self._drain_task is None:
+            logger.warning("Received SIGTERM, draining")
+            self._drain_task = asyncio.create_task(self.drain())
+
+    async def drain(self, timeout: float = Config.DRAIN_TIMEOUT) -> None:
+        """新しいリクエストを断り、処理中のものが終わるのを待ってからセッションを書き出して終了する"""
+        self.draining = True
+        from . import gemini
+        deadline = time.monotonic() + timeout
+        while gemini.quotas.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        if gemini.quotas.inflight:
+            logger.warning(f"Shutting down with {gemini.quotas.inflight} requests still in flight after {timeout:.0f}s")
+        try:
+            count = await gemini.save_snapshot()
+            await gemini.uploader.index.flush()
+            logger.info(f"Saved {count} sessions to {Config.SESSION_SNAPSHOT}")
+        except Exception as e:
+            logger.exception(f"Failed to save sessions on shutdown: {e}")
+        await self.close()
+
+    async def close(self) -> None:
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await super().close()
 
     async def on_guild_join(self, guild: discord.Guild):
         # 許可されていないギルドからは退出
@@ -49,19 +134,33 @@ class CUSTOM_AI_BOT(commands.Bot):
             await guild.leave()
         else:
             try:
-                self.tree.copy_global_to(guild=guild)
-                await self.tree.sync(guild=guild)
+                # 参加し直したギルドにはコマンドが残っていないことがあるため、常に同期する
+                await sync_commands(self.tree, guild, self.sync_state, self.application_id, force=True)
                 logger.info(f"bot joined to {guild.id}")
             except Exception as e:
                 logger.exception(f"failed to add slash commands when joining to {guild.id}\n{e}")
 
-bot = CUSTOM_AI_BOT()
+    async def on_ready(self) -> None:
+        if "gateway" not in self.phases:
+            self.mark_phase("gateway")
+        myutils.print_banner(self, self.start_ts)
+        print("Bot is ready!")
+
+def guild_shard(guild_id: int, shard_count: int) -> int:
+    """ギルドのイベントとインタラクションを受け取るシャードの番号 (Discord の割り当て規則)"""
+    return (guild_id >> 22) % shard_count
 
-@bot.event
-async def on_ready() -> None:
-    myutils.print_banner(bot, bot.start_ts)
-    print("Bot is ready!")
+def _preload() -> None:
+    # ログインの通信を待っている間に、Cog が使う重いモジュールを読み込んでおく
+    for name in Config.PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.debug(f"Failed to preload {name}: {e!r}")
 
-def run(level=logging.WARNING):
+def run(level=logging.WARNING, force_sync: bool = False):
+    threading.Thread(target=_preload, name="preload", daemon=True).start()
+    bot = CUSTOM_AI_BOT()
+    bot.force_sync = force_sync
     # ログハンドラをrun.pyで一元管理するため、discord.pyのデフォルトハンドラを無効化
     bot.run(Config.TOKEN, log_handler=None, log_level=level)  # type: ignore
\ No newline at end of file
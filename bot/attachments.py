@@ -0,0 +1,52 @@
+import asyncio
+import discord
+from io import BytesIO
+from .config import Config
+
+
+class AttachmentError(Exception):
+    """ユーザーに表示するメッセージを持つ添付ファイルのエラー"""
+
+
+class IngestedFile:
+    """一度だけダウンロードした添付ファイル
+
+    同じ bytes から再投稿用の discord.File と Gemini 用の file_data を作る。
+    BytesIO は元の bytes を書き換えない限りコピーせずに共有する。
+    """
+    __slots__ = ("filename", "content_type", "data", "spoiler")
+
+    def __init__(self, filename: str, content_type: str, data: bytes, spoiler: bool = False):
+        self.filename = filename
+        self.content_type = content_type
+        self.data = data
+        self.spoiler = spoiler
+
+    def to_file(self) -> discord.File:
+        return discord.File(BytesIO(self.data), filename=self.filename, spoiler=self.spoiler)
+
+    def to_part(self) -> dict:
+        return {"file_data": {"mime_type": self.content_type, "data": self.data}}
+
+
+def check(attachment: discord.Attachment, allowed_mime: set[str], max_bytes: int = Config.MAX_ATTACHMENT_BYTES) -> None:
+    """ダウンロード前に形式とサイズを確認する"""
+    if attachment.content_type not in allowed_mime:
+        raise AttachmentError("サポートされていないファイル形式です")
+    if attachment.size > max_bytes:
+        raise AttachmentError(f"ファイルサイズが大きすぎます (上限: {max_bytes // (1024 * 1024)}MB)")
+
+
+async def ingest(attachment: discord.Attachment) -> IngestedFile:
+    data = await attachment.read()
+    return IngestedFile(
+        filename=attachment.filename,
+        content_type=attachment.content_type, # type: ignore
+        data=data,
+        spoiler=attachment.is_spoiler(),
+    )
+
+
+async def ingest_all(attachments: list[discord.Attachment]) -> list[IngestedFile]:
+    """複数の添付ファイルを並行してダウンロードする (順序は保たれる)"""
+    return list(await asyncio.gather(*(ingest(a) for a in attachments)))
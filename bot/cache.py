@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+from google.genai import types
+
+# 質問文の先頭に付けている "**ユーザ名**: "
+_NAME_PREFIX_RE = re.compile(r"^\*\*[^*\n]*\*\*: ")
+
+
+@dataclass
+class CachedAnswer:
+    text: str
+    input_token: Optional[int]
+    output_token: Optional[int]
+    turns: list[types.Content]  # 前処理済みのユーザーの質問と、それに続くモデルの応答
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0     # 実行中の同じリクエストの結果を待って使った数
+    tokens_saved: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.coalesced + self.misses
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+
+def normalize_text(text: str) -> str:
+    text = _NAME_PREFIX_RE.sub("", text)
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def cache_key(parts: list[dict], model: str) -> str:
+    """create_part_objs に渡す parts とモデル名から、質問の内容を表すハッシュを作る"""
+    h = hashlib.sha256(model.encode())
+    for part in parts:
+        if "text" in part:
+            h.update(b"\0text\0" + normalize_text(part["text"]).encode("utf-8"))
+        elif "file_data" in part:
+            h.update(b"\0file\0" + part["file_data"]["mime_type"].encode())
+            h.update(hashlib.sha256(part["file_data"]["data"]).digest())
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """最初の質問に対する応答のキャッシュ
+
+    作成から ttl 秒で期限切れになり、max_entries を超えたら古いものから追い出す。
+    同じ質問が処理中なら、その結果を待って使う (single-flight)。
+    """
+
+    def __init__(self, *, max_entries: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[float, CachedAnswer]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires_at, answer = item
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return answer
+
+    def put(self, key: str, answer: CachedAnswer) -> None:
+        self._entries[key] = (self._clock() + self.ttl, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def acquire(self, key: str) -> Optional[CachedAnswer]:
+        """キャッシュ済み、または処理中の同じ質問の応答を返す
+
+        None が返った場合は呼び出し側が応答を生成し、必ず release() で結果を渡すこと。
+        """
+        while True:
+            answer = self.get(key)
+            if answer is not None:
+                self.stats.hits += 1
+                self._count_saved(answer)
+                return answer
+            fut = self._inflight.get(key)
+            if fut is None:
+                self.stats.misses += 1
+                self._inflight[key] = asyncio.get_running_loop().create_future()
+                return None
+            answer = await asyncio.shield(fut)
+            if answer is not None:
+                self.stats.coalesced += 1
+                self._count_saved(answer)
+                return answer
+            # 先に処理していたリクエストが失敗したので、次の1件が代わりに生成する
+
+    def release(self, key: str, answer: Optional[CachedAnswer]) -> None:
+        """acquire() で None を受け取ったリクエストの結果を登録し、待っているリクエストに渡す"""
+        if answer is not None:
+            self.put(key, answer)
+        fut = self._inflight.pop(key, None)
+        if fut is not None and not fut.done():
+            fut.set_result(answer)
+
+    def _count_saved(self, answer: CachedAnswer) -> None:
+        self.stats.tokens_saved += (answer.input_token or 0) + (answer.output_token or 0)
@@ -2,63 +2,86 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 from discord.app_commands import describe
-import os
+import asyncio
+import time
 import logging
 from typing import Optional
 from datetime import datetime
+from io import BytesIO
 
 from .. import gemini
 from .. import myutils
+from .. import attachments
+from .. import media
+from .. import metrics
+from .. import quota
 from ..config import Config
 
 logger = logging.getLogger(__name__)
 
 # --- 返信用のUIコンポーネント ---
-class ReplyButton(discord.ui.Button):
-    def __init__(self, *, chat_id: int, last_idx: int):
+class ReplyButton(discord.ui.DynamicItem[discord.ui.Button], template=r"reply:(?P<chat_id>[0-9]+):(?P<last_idx>[0-9]+)"):
+    """返信ボタン
+
+    返信先のセッションIDと履歴の位置を custom_id に埋め込み、起動時に一度だけ登録する。
+    メッセージごとに View やタイマーを保持しないため、再起動後もボタンが使える。
+    """
+    def __init__(self, chat_id: int, last_idx: int):
         super().__init__(
-            label = "返信する",
-            emoji = "💬",
-            style = discord.ButtonStyle.primary
+            discord.ui.Button(
+                label = "返信する",
+                emoji = "💬",
+                style = discord.ButtonStyle.primary,
+                custom_id = f"reply:{chat_id}:{last_idx}"
+            )
         )
         self.chat_id = chat_id
         self.last_idx = last_idx
-        self.is_replied = False
-        
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match, /):
+        return cls(int(match["chat_id"]), int(match["last_idx"]))
+
     async def callback(self, interaction: discord.Interaction):
+        # ボタンはコマンドツリーの確認を通らないため、終了処理中かをここで確かめる
+        if getattr(interaction.client, "draining", False):
+            await interaction.response.send_message(embed=myutils.get_restarting_embed(), ephemeral=True)
+            return
+        try:
+            # 返信時にだけセッションを読み込む (メモリになければディスクから)
+            await gemini.load_branch(self.chat_id)
+        except gemini.SessionNotFoundError:
+            # 期限切れのボタンは押されたときに取り除く
+            await interaction.response.edit_message(view=None)
+            await interaction.followup.send(embed=myutils.get_error_embed("会話の有効期限が切れています。/ask から新しく質問してください"), ephemeral=True)
+            return
+        except Exception as e:
+            # 保存先 (SQLite / Redis) に繋がらない場合など
+            await interaction.response.send_message(embed=myutils.get_error_embed("会話の読み込みに失敗しました。しばらくしてからもう一度お試しください"), ephemeral=True)
+            logger.exception(f"{interaction.id} : Failed to load session {self.chat_id}. {e}")
+            return
         modal = ReplyModal(
             original_itx=interaction,
-            button=self
+            chat_id=self.chat_id,
+            last_idx=self.last_idx
         )
         await interaction.response.send_modal(modal)
 
-class ReplyView(discord.ui.View):
-    def __init__(self, *, button: ReplyButton, bot: commands.Bot):
-        super().__init__(timeout=Config.BOTTON_TIMEOUT)
-        self.button = button
-        self.add_item(button)
-        self.message: Optional[discord.WebhookMessage] = None
-        self.bot = bot
-        
-    async def on_timeout(self):
-        if not self.button.is_replied:
-            gemini.delete_chat(self.button.chat_id)
-        self.button.disabled = True
-        if self.message:
-            channel = await self.bot.fetch_channel(self.message.channel.id)
-            if isinstance(channel, discord.TextChannel):
-                message = await channel.fetch_message(self.message.id)
-                try:
-                    await message.edit(view=None)
-                except Exception as e:
-                    print(f"メッセージ編集エラー: {e}")
+def reply_view(chat_id: int, last_idx: int) -> discord.ui.View:
+    """返信ボタンだけを持つ View を作る"""
+    view = discord.ui.View(timeout=None)
+    view.add_item(ReplyButton(chat_id, last_idx))
+    # 押下は登録済みの ReplyButton が受け取るため、メッセージごとに View を保持させない
+    view.stop()
+    return view
 
 
 class ReplyModal(discord.ui.Modal, title='AIに返信'):
-    def __init__(self, original_itx: discord.Interaction, button: ReplyButton):
+    def __init__(self, original_itx: discord.Interaction, chat_id: int, last_idx: int):
         super().__init__()
         self.original_itx = original_itx
-        self.button = button
+        self.chat_id = chat_id
+        self.last_idx = last_idx
         self.cog: "ChatCog" = original_itx.client.get_cog("ChatCog") # type: ignore
 
     reply_text = discord.ui.TextInput(
@@ -67,34 +90,149 @@ class ReplyModal(discord.ui.Modal, title='AIに返信'):
     )
 
     async def on_submit(self, itx: discord.Interaction):
-        if self.button.is_replied:
-            id = itx.id
-            parent_id = self.button.chat_id
-            last_idx = self.button.last_idx
+        # 返信ごとに新しいセッションを作り、返信先の履歴を共有して分岐させる
+        admission = await self.cog._admit(itx)
+        if admission is None:
+            return
+        with admission:
+            trace = metrics.Trace(itx.id, "reply")
+            with trace.span("defer"):
+                await itx.response.defer(thinking=True)
+            try:           
+                user_message = self.reply_text.value
+                await self.cog._answer(
+                    itx,
+                    parts=[{"text": f"{itx.user.display_name}: {user_message}"}],
+                    user_prompt=user_message,
+                    chat_id=itx.id,
+                    parent_id=self.chat_id,
+                    last_idx=self.last_idx,
+                    is_new_chat=True,
+                    trace=trace,
+                    admission=admission
+                    )
+
+            except gemini.SessionNotFoundError:
+                await itx.followup.send(embed=myutils.get_error_embed("会話の有効期限が切れています。/ask から新しく質問してください"))
+                logger.info(f"{itx.id} : Reply to an expired session {self.chat_id}")
+            except gemini.errors.APIError as e:
+                await itx.followup.send(embed=myutils.get_error_embed(gemini.get_error_message(e)))
+                logger.error(f"{itx.id} : Reply raised an API error. {e}")
+            except Exception as e:
+                await itx.followup.send(embed=myutils.get_error_embed("エラーが発生しました"))
+                logger.exception(f"{itx.id} : Reply raised an Exception. {e}")
+            finally:
+                trace.finish()
+
+
+# --- ストリーミング表示 ---
+
+class StreamRenderer:
+    """ストリーミング応答を followup メッセージの編集で段階的に表示する
+
+    編集は同時に1件までとし、送信中に届いたテキストは次の編集にまとめる。
+    STREAM_EDIT_INTERVAL 秒経過するか STREAM_EDIT_CHARS 文字溜まるまでは編集しない。
+    テキストは MessageSplitter で区切り、確定したチャンクごとに次の埋め込みに移る。
+    メッセージの埋め込みが上限に達したら新しいメッセージに切り替える。
+    """
+    def __init__(self, cog: "ChatCog", itx: discord.Interaction, user_prompt: str, file_to_attach: Optional[discord.File] = None):
+        self.cog = cog
+        self.itx = itx
+        self.header = f"**{itx.user.display_name}**: {user_prompt}\n\n"
+        self.file_to_attach = file_to_attach
+        self.message: Optional[discord.WebhookMessage] = None
+        self.is_first = True
+        self.splitter = myutils.MessageSplitter()
+        self.done: list[str] = []  # 今のメッセージで確定した埋め込みのテキスト
+        self.text = ""             # ストリームで受け取ったテキスト全体
+        self.unsent = 0
+        self.last_edit = 0.0
+        self.edit_task: Optional[asyncio.Task] = None
+
+    async def feed(self, delta: str):
+        self.text += delta
+        self.unsent += len(delta)
+        for chunk in self.splitter.feed(delta):
+            await self._commit(chunk)
+        if self.message is None:
+            # 最初のチャンクは待たずに表示する
+            await self._write([*self.done, self._preview()])
+        elif self.edit_task is None or self.edit_task.done():
+            elapsed = time.monotonic() - self.last_edit
+            if elapsed >= Config.STREAM_EDIT_INTERVAL or self.unsent >= Config.STREAM_EDIT_CHARS:
+                self.edit_task = asyncio.create_task(self._write([*self.done, self._preview()]))
+
+    def _preview(self) -> str:
+        # 確定済みの埋め込みと合わせてメッセージの文字数上限に収まるよう途中経過を切り詰める
+        room = Config.MAX_EMBED_CHARS_PER_MESSAGE - sum(len(t) for t in self.done)
+        preview = self.splitter.preview
+        if len(preview) > room:
+            preview = preview[:max(room - 1, 0)] + "…"
+        return preview
+
+    async def finish(self, response: str, view: discord.ui.View, footer: Optional[str] = None):
+        """最終的な応答 (参考リンク付き) で残りを書き切り、最後のメッセージにビューを付ける"""
+        await self._wait_edit()
+        # 最終的な応答はストリームのテキスト (末尾の空白を除く) に参考リンクを足したもの
+        if response.startswith(self.text):
+            rest = response[len(self.text):]
         else:
-            id = self.button.chat_id
-            parent_id = None
-            last_idx = None
-        await itx.response.defer(thinking=True)
-        try:           
-            user_message = self.reply_text.value
-            response, input_token, output_token, last_idx = await gemini.generate_text(
-                parts=[{"text": f"{itx.user.display_name}: {user_message}"}],
-                id=id,
-                parent_id=parent_id,
-                last_idx=last_idx,
-                is_new_chat=self.button.is_replied
-                )
-            logger.info(f"{itx.id}: {{input_token: {input_token}, output_token: {output_token}}}")
-            self.button.is_replied = True
-            await self.cog._send_response(itx, user_prompt=user_message, response=response, chat_id=id, last_idx=last_idx)
+            rest = response[len(self.text.rstrip()):]
+        chunks = [*self.splitter.feed(rest), *self.splitter.close()]
+        groups = myutils.pack_chunks([*self.done, *chunks]) or [[""]]
+        for i, group in enumerate(groups):
+            is_last = (i == len(groups) - 1)
+            await self._write(
+                group,
+                view=view if is_last else discord.utils.MISSING,
+                footer=footer if is_last else None
+            )
+            if not is_last:
+                self.message = None
 
-        except gemini.errors.APIError as e:
-            await itx.followup.send(embed=myutils.get_error_embed(gemini.get_error_message(e)))
-            logger.error(f"{itx.id} : Reply raised an API error. {e}")
-        except Exception as e:
-            await itx.followup.send(embed=myutils.get_error_embed("エラーが発生しました"))
-            logger.exception(f"{itx.id} : Reply raised an Exception. {e}")
+    async def _commit(self, chunk: str):
+        # 確定したチャンクを埋め込み1つ分として今のメッセージに積む
+        await self._wait_edit()
+        self.done.append(chunk)
+        room = Config.MAX_EMBED_CHARS_PER_MESSAGE - sum(len(t) for t in self.done)
+        if len(self.done) >= Config.MAX_EMBEDS_PER_MESSAGE or room < Config.MAX_CHUNK_LEN:
+            # このメッセージには次の埋め込みが入らないので確定して次のメッセージへ
+            await self._write(self.done)
+            self.done = []
+            self.message = None
+
+    async def _wait_edit(self):
+        if self.edit_task is not None:
+            await self.edit_task
+            self.edit_task = None
+
+    async def _write(self, texts: list[str], view: discord.ui.View = discord.utils.MISSING, footer: Optional[str] = None):
+        self.last_edit = time.monotonic()
+        self.unsent = 0
+        embeds = [discord.Embed(description=text.strip() or "…", colour=Config.EMBED_SET["answer"]["colour"]) for text in texts]
+        if footer:
+            embeds[-1].set_footer(text=footer)
+        try:
+            if self.message is not None:
+                self.message = await self.message.edit(embeds=embeds, view=view)
+            elif self.is_first:
+                embeds[0].set_author(name=self.cog.bot.user.name, icon_url=self.cog.bot.user.display_avatar) # type: ignore
+                if self.file_to_attach is not None:
+                    # 前回の送信で読み進めた位置から送らないように先頭へ戻す
+                    self.file_to_attach.reset()
+                self.message = await self.itx.followup.send(
+                    content=self.header, embeds=embeds, view=view, wait=True,
+                    file=self.file_to_attach or discord.utils.MISSING
+                )
+                # 送信に失敗したら次の送信でヘッダーと添付を付け直す
+                self.is_first = False
+            else:
+                self.message = await self.itx.followup.send(embeds=embeds, view=view, wait=True)
+        except discord.HTTPException as e:
+            # 途中経過の編集に失敗しても最終結果の送信で取り戻せるため、ログだけ残す
+            if view is not discord.utils.MISSING:
+                raise
+            logger.warning(f"{self.itx.id} : Failed to update streaming message. {e}")
 
 
 # --- Cogクラス ---
@@ -102,120 +240,227 @@ class ReplyModal(discord.ui.Modal, title='AIに返信'):
 class ChatCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+
+    async def _answer(self, itx: discord.Interaction, parts: list[dict], user_prompt: str, chat_id: int,
+                      parent_id: Optional[int] = None, last_idx: Optional[int] = None, is_new_chat: bool = True,
+                      view_tokens: bool = False, file_to_attach: Optional[discord.File] = None, trace: Optional[metrics.Trace] = None,
+                      admission: Optional[quota.Admission] = None):
+        """応答を生成して送信する。STREAM_RESPONSE が有効なら生成しながら表示する"""
+        trace = trace or metrics.Trace(itx.id, "answer")
+        downgrade = admission is not None and admission.downgrade
+        if not Config.STREAM_RESPONSE:
+            with trace.span("model"):
+                response, input_token, output_token, last_idx = await gemini.generate_text(
+                    parts=parts, id=chat_id, parent_id=parent_id, last_idx=last_idx, is_new_chat=is_new_chat, user_id=itx.user.id,
+                    downgrade=downgrade
+                    )
+            self._log_usage(itx, input_token, output_token, admission)
+            with trace.span("send"):
+                await self._send_response(itx, user_prompt=user_prompt, response=response, chat_id=chat_id, last_idx=last_idx, view_tokens=view_tokens,
+                                          input_token=input_token, output_token=output_token, file_to_attach=file_to_attach)
+            return
+
+        stream = gemini.generate_text_stream(
+            parts=parts, id=chat_id, parent_id=parent_id, last_idx=last_idx, is_new_chat=is_new_chat, user_id=itx.user.id,
+            downgrade=downgrade
+            )
+        renderer = StreamRenderer(self, itx, user_prompt, file_to_attach)
+        # 最初の差分が届くまでと、生成 (途中経過の表示を含む) が終わるまでを分けて記録する
+        with trace.span("stream"):
+            started = time.perf_counter()
+            async for delta in stream:
+                if renderer.message is None and renderer.is_first:
+                    trace.add("first_token", time.perf_counter() - started)
+                await renderer.feed(delta)
+        response, input_token, output_token, last_idx = stream.result # type: ignore
+        self._log_usage(itx, input_token, output_token, admission)
+        footer = f"input_token: {input_token} output_token: {output_token}" if view_tokens else None
+        with trace.span("send"):
+            await renderer.finish(response, view=reply_view(chat_id, last_idx), footer=footer)
+
+    async def _admit(self, itx: discord.Interaction, cost: int = 1) -> Optional[quota.Admission]:
+        """利用上限と混雑を確認する。断ったときはエラーを返信して None を返す"""
+        if getattr(self.bot, "draining", False):
+            await itx.response.send_message(embed=myutils.get_restarting_embed(), ephemeral=True)
+            return None
+        try:
+            return gemini.quotas.admit(itx.user.id, cost)
+        except quota.QuotaExceeded as e:
+            logger.info(f"{itx.id} : Rejected a request from {itx.user.id}. {e}")
+            await itx.response.send_message(embed=myutils.get_error_embed(str(e)), ephemeral=True)
+            return None
+
+    def _log_usage(self, itx: discord.Interaction, input_token: Optional[int], output_token: Optional[int],
+                   admission: Optional[quota.Admission] = None):
+        logger.info(f"{itx.id}: {{input_token: {input_token}, output_token: {output_token}}}")
+        metrics.observe_tokens(input_token, output_token)
+        if admission is not None:
+            admission.record(input_token, output_token)
+        if gemini.answer_cache.enabled:
+            stats = gemini.answer_cache.stats
+            logger.info(f"{itx.id}: {{cache_hit_rate: {stats.hit_rate:.1%}, tokens_saved: {stats.tokens_saved}}}")
+
     async def _send_response(self, itx: discord.Interaction, user_prompt: str, response: str, chat_id: int, last_idx: int, view_tokens: bool = False,
                              input_token: Optional[int] = None, output_token: Optional[int] = None,
                              file_to_attach: Optional[discord.File] = None):
-        """応答を分割して送信するためのヘルパーメソッド"""
+        """応答を分割し、できるだけ少ないメッセージにまとめて送信するヘルパーメソッド"""
         header = f"**{itx.user.display_name}**: {user_prompt}\n\n"
-        
-        webhook_message: Optional[discord.WebhookMessage] = None
-        if file_to_attach:
-            webhook_message = await itx.followup.send(file=file_to_attach, wait=True)
-
-        chunks = myutils.split_message(response)
-        for i, chunk in enumerate(chunks):
-            is_last_chunk = (i == len(chunks) - 1)
-            embed = discord.Embed(description=chunk, colour=Config.EMBED_SET["answer"]["colour"])
-            
-            if is_last_chunk and view_tokens:
-                embed.set_footer(text=f"input_token: {input_token} output_token: {output_token}")
-
-            view = ReplyView(button=ReplyButton(chat_id=chat_id, last_idx=last_idx), bot=self.bot) if is_last_chunk else discord.utils.MISSING
-
-            if i == 0:
-                embed.set_author(name=self.bot.user.name, icon_url=self.bot.user.display_avatar) # type: ignore
-                if webhook_message:
-                    msg = await webhook_message.edit(content=header, embed=embed, view=view)
-                else:
-                    msg = await itx.followup.send(content=header, embed=embed, view=view)
+
+        groups = myutils.pack_chunks(myutils.split_message(response))
+        for i, group in enumerate(groups):
+            is_first, is_last = (i == 0), (i == len(groups) - 1)
+            embeds = [discord.Embed(description=chunk, colour=Config.EMBED_SET["answer"]["colour"]) for chunk in group]
+
+            if is_last and view_tokens:
+                embeds[-1].set_footer(text=f"input_token: {input_token} output_token: {output_token}")
+
+            view = reply_view(chat_id, last_idx) if is_last else discord.utils.MISSING
+
+            if is_first:
+                embeds[0].set_author(name=self.bot.user.name, icon_url=self.bot.user.display_avatar) # type: ignore
+                await itx.followup.send(content=header, embeds=embeds, view=view, file=file_to_attach or discord.utils.MISSING)
             else:
-                msg= await itx.followup.send(embed=embed, view=view)
-            if is_last_chunk:
-                view.message = msg
+                await itx.followup.send(embeds=embeds, view=view)
 
     @app_commands.command(name="ask", description="AIに質問する")
     @describe(text="質問内容", file="ファイルを添付 (画像/音声)", view_tokens="入出力トークンを表示")
     async def ask(self, itx: discord.Interaction, text: str, file: Optional[discord.Attachment] = None, view_tokens: bool = False):
         if len(text) > Config.MAX_PROMPT_LEN:
             return await itx.response.send_message(embed=myutils.get_error_embed("質問が長すぎます"), ephemeral=True)
+        if file:
+            try:
+                attachments.check(file, Config.ALLOWED_IMAGE_MIME | Config.ALLOWED_AUDIO_MIME)
+            except attachments.AttachmentError as e:
+                return await itx.response.send_message(embed=myutils.get_error_embed(str(e)), ephemeral=True)
         
-        await itx.response.defer(thinking=True)
-        parts: list[dict] = [{"text": f"**{itx.user.display_name}**: {text}"}]
-        file_to_resend: Optional[discord.File] = None
+        # 添付ファイルのダウンロードやモデルの呼び出しの前に、利用上限と混雑を確認する
+        admission = await self._admit(itx)
+        if admission is None:
+            return
+        with admission:
+            trace = metrics.Trace(itx.id, "ask")
+            with trace.span("defer"):
+                await itx.response.defer(thinking=True)
+            parts: list[dict] = [{"text": f"**{itx.user.display_name}**: {text}"}]
+            file_to_resend: Optional[discord.File] = None
 
-        if file:
-            if file.content_type not in Config.ALLOWED_IMAGE_MIME and file.content_type not in Config.ALLOWED_AUDIO_MIME:
-                return await itx.followup.send(embed=myutils.get_error_embed("サポートされていないファイル形式です"), ephemeral=True)
-            file_to_resend = await file.to_file()
-            parts.insert(0, {"file_data": {"mime_type": file.content_type, "data": await file.read()}})
+            try:
+                if file:
+                    with trace.span("download"):
+                        ingested = await attachments.ingest(file)
+                    file_to_resend = ingested.to_file()
+                    parts.insert(0, ingested.to_part())
 
-        try:
-            response, input_token, output_token, last_idx = await gemini.generate_text(parts=parts, id=itx.id, is_new_chat=True)
-            logger.info(f"{itx.id}: {{input_token: {input_token}, output_token: {output_token}}}")
-            
-            await self._send_response(itx, user_prompt=text, response=response, chat_id=itx.id, last_idx=last_idx, view_tokens=view_tokens, 
-                                      input_token=input_token, output_token=output_token, file_to_attach=file_to_resend)
-
-        except gemini.errors.APIError as e:
-            await itx.followup.send(embed=myutils.get_error_embed(gemini.get_error_message(e)))
-            logger.error(f"{itx.id} : /ask raised an API error. {e}")
-        except Exception as e:
-            await itx.followup.send(embed=myutils.get_error_embed("エラーが発生しました"))
-            logger.exception(f"{itx.id} : /ask raised an Exception. {e}")
+                await self._answer(itx, parts=parts, user_prompt=text, chat_id=itx.id, view_tokens=view_tokens, file_to_attach=file_to_resend,
+                                   trace=trace, admission=admission)
+
+            except gemini.errors.APIError as e:
+                await itx.followup.send(embed=myutils.get_error_embed(gemini.get_error_message(e)))
+                logger.error(f"{itx.id} : /ask raised an API error. {e}")
+            except Exception as e:
+                await itx.followup.send(embed=myutils.get_error_embed("エラーが発生しました"))
+                logger.exception(f"{itx.id} : /ask raised an Exception. {e}")
+            finally:
+                trace.finish()
 
     @app_commands.command(name="image", description="画像を生成")
-    @describe(prompt="生成する画像の説明", file="ファイルを添付 (画像のみ)", file2="追加のファイルを添付 (画像のみ)", view_token="入出力トークンを表示する")
+    @describe(prompt="生成する画像の説明", file="ファイルを添付 (画像のみ)", file2="追加のファイルを添付 (画像のみ)", view_token="入出力トークンを表示する",
+              count="生成する枚数 (複数のときは並行して生成し、一覧画像と元の画像を送る)")
     async def image(
         self, 
         itx: discord.Interaction, 
         prompt: str, 
         file: Optional[discord.Attachment] = None, 
         file2: Optional[discord.Attachment] = None, 
-        view_token: bool = False
+        view_token: bool = False,
+        count: app_commands.Range[int, 1, Config.IMAGE_MAX_COUNT] = 1
         ):
         if len(prompt) > Config.MAX_PROMPT_LEN:
             return await itx.response.send_message(embed=myutils.get_error_embed("プロンプトが長すぎます"), ephemeral=True)
-        
-        await itx.response.defer(thinking=True)
-        parts: list[dict] = [{"text": prompt}]
-        file_to_resends: Optional[list[discord.File]] = []
-
-        if file2:
-            if file2.content_type not in Config.ALLOWED_IMAGE_MIME:
-                return await itx.followup.send(embed=myutils.get_error_embed("サポートされていないファイル形式です"), ephemeral=True)
-            file_to_resends.insert(0, await file2.to_file())
-            parts.insert(0, {"file_data": {"mime_type": file2.content_type, "data": await file2.read()}})
-        if file:
-            if file.content_type not in Config.ALLOWED_IMAGE_MIME:
-                return await itx.followup.send(embed=myutils.get_error_embed("サポートされていないファイル形式です"), ephemeral=True)
-            file_to_resends.insert(0, await file.to_file())
-            parts.insert(0, {"file_data": {"mime_type": file.content_type, "data": await file.read()}})
+        inputs = [f for f in (file, file2) if f]
         try:
-            path, text, input_token, output_token = await gemini.generate_image(parts)
-            logger.info(f"{itx.id}: {{input_token: {input_token}, output_token: {output_token}}}")
-
-            if path:
-                filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                output_file = discord.File(path, filename)
-                embed = discord.Embed(title=prompt, description=text, colour=Config.EMBED_SET["image"]["colour"])
-                embed.set_image(url=f"attachment://{filename}")
-                if view_token:
-                    embed.set_footer(text=f"input_token: {input_token} output_token: {output_token}")
-                if len(file_to_resends) > 0:
-                    file_to_resends.append(output_file)
-                    await itx.followup.send(embed=embed, files=file_to_resends)
+            for f in inputs:
+                attachments.check(f, Config.ALLOWED_IMAGE_MIME)
+        except attachments.AttachmentError as e:
+            return await itx.response.send_message(embed=myutils.get_error_embed(str(e)), ephemeral=True)
+        
+        admission = await self._admit(itx, cost=Config.QUOTA_IMAGE_COST * count)
+        if admission is None:
+            return
+        with admission:
+            trace = metrics.Trace(itx.id, "image")
+            with trace.span("defer"):
+                await itx.response.defer(thinking=True)
+            parts: list[dict] = [{"text": prompt}]
+            file_to_resends: Optional[list[discord.File]] = []
+
+            try:
+                if inputs:
+                    with trace.span("download"):
+                        ingested_files = await attachments.ingest_all(inputs)
                 else:
-                    await itx.followup.send(embed=embed, file=output_file)
-                os.remove(path)
-            else:
-                await itx.followup.send(embed=myutils.get_error_embed("画像の生成に失敗しました。"))
+                    ingested_files = []
+                file_to_resends = [f.to_file() for f in ingested_files]
+                parts[:0] = [f.to_part() for f in ingested_files]
 
-        except gemini.errors.APIError as e:
-            await itx.followup.send(embed=myutils.get_error_embed(gemini.get_error_message(e)))
-            logger.error(f"{itx.id} : /image raised an API error. {e}")
-        except Exception as e:
-            await itx.followup.send(embed=myutils.get_error_embed("エラーが発生しました"))
-            logger.exception(f"{itx.id} : /image raised an Exception. {e}")
+                with trace.span("model"):
+                    if count == 1:
+                        image, text, input_token, output_token = await gemini.generate_image(parts, user_id=itx.user.id)
+                        results = [(image, text)] if image else []
+                    else:
+                        results, input_token, output_token = await gemini.generate_images(parts, count, user_id=itx.user.id)
+                logger.info(f"{itx.id}: {{input_token: {input_token}, output_token: {output_token}}}")
+                metrics.observe_tokens(input_token, output_token)
+                admission.record(input_token, output_token)
+
+                if results:
+                    stem = datetime.now().strftime('%Y%m%d_%H%M%S')
+                    with trace.span("encode"):
+                        output_files = list(await asyncio.gather(*(
+                            media.to_discord_file(image.data, image.mime_type or "image/png", stem if len(results) == 1 else f"{stem}_{i}") # type: ignore
+                            for i, (image, _) in enumerate(results, 1)
+                        )))
+                        # 複数枚なら一覧画像をプレビューにし、元の画像は同じメッセージに添付する
+                        if len(output_files) == 1:
+                            preview, originals = output_files[0], []
+                        else:
+                            preview, originals = await media.make_grid([image.data for image, _ in results], stem), output_files # type: ignore
+                    text = next((t for _, t in results if t), "")
+                    if len(results) < count:
+                        text = f"{text}\n({count}枚中{len(results)}枚を生成しました)".strip()
+                    embed = discord.Embed(title=prompt, description=text, colour=Config.EMBED_SET["image"]["colour"])
+                    embed.set_image(url=f"attachment://{preview.filename}")
+                    if view_token:
+                        embed.set_footer(text=f"input_token: {input_token} output_token: {output_token}")
+                    files = _fit_upload([*file_to_resends, preview], originals)
+                    if len(files) < len(file_to_resends) + 1 + len(originals):
+                        logger.info(f"{itx.id} : Dropped {len(file_to_resends) + 1 + len(originals) - len(files)} images over the upload limit")
+                    with trace.span("send"):
+                        await itx.followup.send(embed=embed, files=files)
+                else:
+                    await itx.followup.send(embed=myutils.get_error_embed("画像の生成に失敗しました。"))
+
+            except gemini.errors.APIError as e:
+                await itx.followup.send(embed=myutils.get_error_embed(gemini.get_error_message(e)))
+                logger.error(f"{itx.id} : /image raised an API error. {e}")
+            except Exception as e:
+                await itx.followup.send(embed=myutils.get_error_embed("エラーが発生しました"))
+                logger.exception(f"{itx.id} : /image raised an Exception. {e}")
+            finally:
+                trace.finish()
+
+def _fit_upload(required: list[discord.File], optional: list[discord.File]) -> list[discord.File]:
+    """required はすべて、optional は合計が MAX_UPLOAD_BYTES に収まる分だけ順に添付する"""
+    def size(f: discord.File) -> int:
+        return f.fp.getbuffer().nbytes if isinstance(f.fp, BytesIO) else 0
+    files = list(required)
+    total = sum(size(f) for f in files)
+    for f in optional:
+        if total + size(f) <= Config.MAX_UPLOAD_BYTES:
+            files.append(f)
+            total += size(f)
+    return files
 
 async def setup(bot: commands.Bot):
+    bot.add_dynamic_items(ReplyButton)
     await bot.add_cog(ChatCog(bot))
\ No newline at end of file
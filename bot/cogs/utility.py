@@ -11,6 +11,10 @@ class UtilityCog(commands.Cog):
     @app_commands.command(name="info", description="Botの情報を確認")
     async def info(self, ctx: discord.Interaction):
         text = f"**チャットモデル**: {gemini.MODEL}\n**画像生成モデル**: {gemini.IMAGE_MODEL}"
+        if gemini.FALLBACK_MODEL:
+            text += f"\n**混雑時のチャットモデル**: {gemini.FALLBACK_MODEL}"
+        if gemini.FALLBACK_IMAGE_MODEL:
+            text += f"\n**混雑時の画像生成モデル**: {gemini.FALLBACK_IMAGE_MODEL}"
         embed = discord.Embed(
             title=Config.EMBED_SET["info"]["title"],
             description=text,
@@ -0,0 +1,56 @@
+import hashlib
+import json
+import logging
+import os
+import discord
+from discord import app_commands
+
+logger = logging.getLogger(__name__)
+
+
+def tree_fingerprint(tree: app_commands.CommandTree, guild: discord.abc.Snowflake) -> str:
+    """ギルドに同期されるコマンドの内容 (tree.sync が送るものと同じ) のハッシュ"""
+    payload = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class CommandSyncState:
+    """最後に同期したコマンドツリーのハッシュを (アプリケーション, ギルド) ごとにファイルに保存する"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self) -> dict[str, str]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key: str) -> str | None:
+        return self._read().get(key)
+
+    def set(self, key: str, fingerprint: str) -> None:
+        state = self._read()
+        state[key] = fingerprint
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+async def sync_commands(tree: app_commands.CommandTree, guild: discord.abc.Snowflake, state: CommandSyncState,
+                        application_id: int | None, force: bool = False) -> bool:
+    """コマンドツリーが前回の同期から変わっていれば同期する。同期したら True を返す"""
+    tree.copy_global_to(guild=guild)
+    fingerprint = tree_fingerprint(tree, guild)
+    key = f"{application_id}:{guild.id}"
+    if not force and state.get(key) == fingerprint:
+        logger.info(f"Command tree unchanged for guild {guild.id}, skipped sync")
+        return False
+    await tree.sync(guild=guild)
+    state.set(key, fingerprint)
+    logger.info(f"Synced commands to guild {guild.id}")
+    return True
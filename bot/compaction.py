@@ -0,0 +1,87 @@
+import logging
+from typing import Awaitable, Callable, Optional
+from google.genai import types
+from .conversation import Branch, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = "ここまでの会話を、以降のやり取りに必要な事実・決定事項・ユーザの意図が分かるように日本語で簡潔に要約してください。"
+
+# 要約なしでは予算に収まらないことを警告したか
+_warned_unshrinkable = False
+
+
+def _placeholder(mime_type: Optional[str]) -> types.Part:
+    mime_type = mime_type or "application/octet-stream"
+    kind = {"image": "画像", "audio": "音声", "video": "動画"}.get(mime_type.split("/")[0], "ファイル")
+    return types.Part.from_text(text=f"[{kind} ({mime_type}) は省略されています]")
+
+
+def strip_media(contents: list[types.Content]) -> list[types.Content]:
+    """画像・音声などのパートを短いプレースホルダに置き換える"""
+    stripped = []
+    for content in contents:
+        parts = content.parts or []
+        if not any(part.inline_data or part.file_data for part in parts):
+            stripped.append(content)
+            continue
+        new_parts = []
+        for part in parts:
+            if part.inline_data:
+                new_parts.append(_placeholder(part.inline_data.mime_type))
+            elif part.file_data:
+                new_parts.append(_placeholder(part.file_data.mime_type))
+            else:
+                new_parts.append(part)
+        stripped.append(types.Content(role=content.role, parts=new_parts))
+    return stripped
+
+
+def count_tokens(contents: list[types.Content]) -> int:
+    return sum(estimate_tokens(c) for c in contents)
+
+
+async def compact(
+        branch: Branch,
+        *,
+        budget: int,
+        keep_turns: int,
+        summarize: Optional[Callable[[list[types.Content]], Awaitable[str]]] = None,
+        ) -> bool:
+    """履歴が budget を超えていれば、直近 keep_turns 往復より前を圧縮してチェックポイントにする
+
+    メディアはプレースホルダに置き換え、それでも収まらず summarize があれば要約にまとめる。
+    チェックポイントは会話ツリーのノードに置くため、同じ祖先を持つ枝でも使われる。圧縮したら True を返す。
+    履歴が減らない場合はチェックポイントを作らない (作るたびにコンテキストキャッシュの起点が変わるため)。
+    """
+    global _warned_unshrinkable
+    history, base = branch.context()
+    if budget <= 0 or branch.tail is None or count_tokens(history) <= budget:
+        return False
+    keep = max(keep_turns, 0) * 2
+    node = branch.tail.ancestor(len(branch) - keep)
+    if node is None or (base is not None and node.depth <= base.depth):
+        # これ以上は圧縮できない
+        return False
+    split = len(history) - keep
+    compacted, recent = strip_media(history[:split]), history[split:]
+    if summarize is not None and count_tokens(compacted) + count_tokens(recent) > budget:
+        try:
+            summary = await summarize(compacted)
+            compacted = [
+                types.Content(role="user", parts=[types.Part.from_text(text=f"これまでの会話の要約:\n{summary}")]),
+                types.Content(role="model", parts=[types.Part.from_text(text="了解しました。")]),
+            ]
+        except Exception as e:
+            logger.warning(f"Failed to summarize history, using placeholders only. {e}")
+    if count_tokens(compacted) >= count_tokens(history[:split]):
+        if not _warned_unshrinkable:
+            _warned_unshrinkable = True
+            logger.warning("History exceeds HISTORY_TOKEN_BUDGET but has no media to strip. Set HISTORY_SUMMARIZE=true to compact it")
+        return False
+    node.checkpoint = compacted
+    logger.info(
+        f"Compacted history: {len(history)} turns ~{count_tokens(history)} tokens"
+        f" -> {len(compacted) + len(recent)} turns ~{count_tokens(compacted) + count_tokens(recent)} tokens"
+    )
+    return True
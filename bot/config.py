@@ -22,6 +22,17 @@ class Config:
         "audio/flac", "audio/x-flac",
     }
     MAX_PROMPT_LEN = 1800
+    MAX_ATTACHMENT_BYTES = int(os.environ.get("MAX_ATTACHMENT_BYTES", 20 * 1024 * 1024))
+    # --- 入力画像の前処理 ---
+    IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", 1536))
+    IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+    # --- /image の複数枚生成 (枚数の上限、打ち切るまでの秒数、一覧画像の1枚あたりの大きさ) ---
+    # 添付は1メッセージ10個まで (入力画像2枚 + 一覧画像 + 生成した画像) なので 7 枚を上限とする
+    IMAGE_MAX_COUNT = min(int(os.environ.get("IMAGE_MAX_COUNT", 4)), 7)
+    IMAGE_DEADLINE = float(os.environ.get("IMAGE_DEADLINE", 90))
+    IMAGE_GRID_CELL = int(os.environ.get("IMAGE_GRID_CELL", 512))
+    # 1メッセージに添付するファイルの合計サイズの上限 (Discord の上限に合わせる)
+    MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
     EMBED_SET: dict = {
         "error": {"title": "Error", "colour": discord.Colour.red()},
         "answer": {"title": "Answer", "colour": discord.Colour.blue()},
@@ -31,7 +42,7 @@ class Config:
     }
     HELP_TEXT = """スラッシュコマンドを通してGEMINI APIを利用できます
     - **/ask**: AIに質問します 画像か音声ファイルを添付できます
-    - **/image**: 画像を生成します
+    - **/image**: 画像を生成します count で複数枚を同時に生成できます
     - **/info**: モデルの情報を取得します
     - **/help**: /コマンドの情報を取得します"""
     HELP_EMBED = discord.Embed(
@@ -40,6 +51,80 @@ class Config:
         colour=EMBED_SET["help"]["colour"],
     )
     BOTTON_TIMEOUT = 21600.0
+    # --- ログファイル (サイズでローテーション) ---
+    LOG_FILE = os.environ.get("LOG_FILE", "discord.log")
+    LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+    LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 3))
+    # --- 終了時に処理中のリクエストを待つ秒数 (fly.toml の kill_timeout より短くする) ---
+    DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 45))
+    # --- シャーディング (SHARD_COUNT が 0 なら分割しない) ---
+    SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 0))
+    SHARD_ID = int(os.environ.get("SHARD_ID", 0))
+    # --- /metrics と /healthz を返す HTTP サーバー (0 で無効) ---
+    METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", 9091))
+    # --- 起動時に読み込む Cog と、ログイン中に先読みするモジュール ---
+    COGS = ("bot.cogs.chat", "bot.cogs.utility")
+    PRELOAD_MODULES = ("google.genai", "bot.gemini")
+    # --- ストリーミング応答 ---
+    STREAM_RESPONSE = os.environ.get("STREAM_RESPONSE", "true").lower() == "true"
+    STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+    STREAM_EDIT_CHARS = int(os.environ.get("STREAM_EDIT_CHARS", 300))
+    MAX_CHUNK_LEN = 1900
+    # 1メッセージに載せる埋め込みの上限 (Discord の上限は 10個 / 合計6000文字、作者名・フッター分を残す)
+    MAX_EMBEDS_PER_MESSAGE = 10
+    MAX_EMBED_CHARS_PER_MESSAGE = 5800
+    # --- Gemini 呼び出しのスケジューラ (同時実行数 / 1分あたりのリクエスト数、0 で無制限) ---
+    TEXT_CONCURRENCY = int(os.environ.get("TEXT_CONCURRENCY", 8))
+    TEXT_RPM = float(os.environ.get("TEXT_RPM", 0))
+    IMAGE_CONCURRENCY = int(os.environ.get("IMAGE_CONCURRENCY", 2))
+    IMAGE_RPM = float(os.environ.get("IMAGE_RPM", 10))
+    # --- 再試行とフォールバック ---
+    RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", 3))
+    RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 1.0))
+    RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 20.0))
+    BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 3))
+    BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 60.0))
+    # --- 利用上限 (直近 QUOTA_WINDOW 秒のトークン数・リクエスト数、0 で無制限) ---
+    QUOTA_WINDOW = float(os.environ.get("QUOTA_WINDOW", 3600))
+    QUOTA_USER_TOKENS = int(os.environ.get("QUOTA_USER_TOKENS", 0))
+    QUOTA_USER_REQUESTS = int(os.environ.get("QUOTA_USER_REQUESTS", 0))
+    QUOTA_GLOBAL_TOKENS = int(os.environ.get("QUOTA_GLOBAL_TOKENS", 0))
+    QUOTA_GLOBAL_REQUESTS = int(os.environ.get("QUOTA_GLOBAL_REQUESTS", 0))
+    # ユーザーのトークン数がこの割合を超えたらフォールバックモデルで応答する (0 で無効)
+    QUOTA_DOWNGRADE_RATIO = float(os.environ.get("QUOTA_DOWNGRADE_RATIO", 0.8))
+    # 画像生成1回をリクエスト何回分として数えるか
+    QUOTA_IMAGE_COST = int(os.environ.get("QUOTA_IMAGE_COST", 5))
+    # 同時に処理するリクエストの上限 (超えたら待たせずに断る、0 で無制限)
+    MAX_INFLIGHT = int(os.environ.get("MAX_INFLIGHT", 32))
+    MAX_INFLIGHT_PER_USER = int(os.environ.get("MAX_INFLIGHT_PER_USER", 3))
+    # --- セッションストア ---
+    SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", 500))
+    SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+    SESSION_TTL = float(os.environ.get("SESSION_TTL", BOTTON_TIMEOUT))
+    # --- 最初の質問への応答キャッシュ (秒、0 で無効) ---
+    ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 0))
+    ANSWER_CACHE_MAX = int(os.environ.get("ANSWER_CACHE_MAX", 256))
+    # --- コンテキストキャッシュ (キャッシュされていない履歴がこのトークン数を超えたら作成、0 で無効) ---
+    CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", 4096))
+    CONTEXT_CACHE_TTL = float(os.environ.get("CONTEXT_CACHE_TTL", 600))
+    CONTEXT_CACHE_MAX = int(os.environ.get("CONTEXT_CACHE_MAX", 100))
+    # --- 長い会話の圧縮 (履歴の見積もりトークン数の上限、0 で無効。直近の往復はそのまま残す) ---
+    HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 32000))
+    HISTORY_KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", 4))
+    HISTORY_SUMMARIZE = os.environ.get("HISTORY_SUMMARIZE", "false").lower() == "true"
+    # --- このバイト数以上の添付ファイルは Files API でアップロードして URI で送る (0 で無効) ---
+    FILES_API_THRESHOLD = int(os.environ.get("FILES_API_THRESHOLD", 2 * 1024 * 1024))
+    # --- 永続化 (fly.io ではボリュームをマウントしたパスを指定) ---
+    DATA_DIR = os.environ.get("DATA_DIR", "./data")
+    # 会話履歴の保存先: sqlite (SESSION_DB) / redis (REDIS_URL、複数のプロセスで共有) / memory (プロセス内)
+    SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlite").lower()
+    REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+    SESSION_DB = os.path.join(DATA_DIR, "sessions.sqlite3")
+    FILE_INDEX_DB = os.path.join(DATA_DIR, "files.sqlite3")
+    COMMAND_SYNC_STATE = os.path.join(DATA_DIR, "command_tree.json")
+    # 終了時にメモリ上のセッションを書き出すファイル
+    SESSION_SNAPSHOT = os.path.join(DATA_DIR, "sessions.snapshot")
     LOGO = r"""
 ┌──────────────────────────────────────────────────────────────┐
 │ ██████\  ██\   ██\  ██████\ ████████\  ██████\  ██\      ██\ │
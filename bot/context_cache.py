@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+from google import genai
+from google.genai import errors, types
+from .conversation import Turn, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# キャッシュが期限切れ・削除済みのときに返るエラー
+CACHE_ERROR_CODES = {400, 403, 404}
+
+
+@dataclass
+class ContextCacheStats:
+    created: int = 0
+    hits: int = 0
+    refreshed: int = 0
+    failures: int = 0
+
+
+class _Entry:
+    __slots__ = ("name", "expires_at", "base")
+
+    def __init__(self, name: str, expires_at: float, base: Optional[Turn]):
+        self.name = name
+        self.expires_at = expires_at
+        # 作成時に起点だったチェックポイント (ノードを生かし続けないよう弱参照で持つ)
+        self.base = weakref.ref(base) if base is not None else None
+
+    def has_base(self, base: Optional[Turn]) -> bool:
+        if self.base is None:
+            return base is None
+        return base is not None and self.base() is base
+
+    def is_dead(self) -> bool:
+        return self.base is not None and self.base() is None
+
+
+class ContextCache:
+    """Gemini の明示的コンテキストキャッシュで、会話の共通部分の再送をやめる
+
+    システムプロンプト・ツールとそこまでの履歴をサーバー側にキャッシュし、
+    キャッシュした最後のターン (会話ツリーのノード) とモデルの組で引く。
+    履歴が圧縮された後は、同じチェックポイントから作ったキャッシュだけを使う。
+    ノードは弱参照で持つため、セッションストアから追い出された会話の履歴を生かし続けない。
+    キャッシュされていない部分が min_tokens 以上になったらバックグラウンドで作成し、
+    使われている間は TTL を延長する。作成・利用に失敗したらキャッシュなしで送る。
+    """
+
+    def __init__(
+            self,
+            client: Callable[[], genai.Client],
+            *,
+            min_tokens: int,
+            ttl: float,
+            max_entries: int,
+            clock: Callable[[], float] = time.monotonic,
+            ):
+        self._client = client
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = ContextCacheStats()
+        self._clock = clock
+        self._entries: OrderedDict[tuple[str, weakref.ref[Turn]], _Entry] = OrderedDict()
+        self._pending: set[tuple[str, Turn]] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_tokens > 0 and self.ttl > 0 and self.max_entries > 0
+
+    def lookup(self, model: str, tail: Optional[Turn], base: Optional[Turn] = None) -> tuple[Optional[str], int]:
+        """tail から base までの間でキャッシュ済みの最も深いノードを探し、(キャッシュ名, 深さ) を返す"""
+        if not self.enabled:
+            return None, 0
+        self._purge()
+        entry, depth = self._find(model, tail, base)
+        if entry is None:
+            return None, 0
+        self.stats.hits += 1
+        now = self._clock()
+        if entry.expires_at - now < self.ttl / 2:
+            entry.expires_at = now + self.ttl
+            self._spawn(self._refresh(entry.name))
+        return entry.name, depth
+
+    def maybe_create(self, model: str, tail: Optional[Turn], base: Optional[Turn], contents: list[types.Content],
+                     system_instruction: list[types.Part], tools: list[types.Tool]) -> None:
+        """キャッシュされていない部分が十分に長ければ、tail までの履歴 contents のキャッシュを作成する"""
+        if not self.enabled or tail is None or (model, tail) in self._pending:
+            return
+        self._purge()
+        _, depth = self._find(model, tail, base)
+        uncached = contents[len(contents) - (tail.depth - depth):] if depth else contents
+        if sum(estimate_tokens(c) for c in uncached) < self.min_tokens:
+            return
+        self._pending.add((model, tail))
+        self._spawn(self._create(model, tail, base, contents, system_instruction, tools))
+
+    def _find(self, model: str, tail: Optional[Turn], base: Optional[Turn]) -> tuple[Optional[_Entry], int]:
+        now = self._clock()
+        node = tail
+        while node is not None and node is not base:
+            key = (model, weakref.ref(node))
+            entry = self._entries.get(key)
+            # 送信中に切れないよう、期限間近のものは使わない
+            if entry is not None and entry.has_base(base) and entry.expires_at - now > 30:
+                self._entries.move_to_end(key)
+                return entry, node.depth
+            node = node.parent
+        return None, 0
+
+    def _purge(self) -> None:
+        """期限切れと、ノード (会話) がもう残っていないキャッシュを取り除き、サーバー側からも削除する"""
+        now = self._clock()
+        for key, entry in list(self._entries.items()):
+            if entry.expires_at <= now or key[1]() is None or entry.is_dead():
+                del self._entries[key]
+                self._spawn(self._delete(entry.name))
+
+    def invalidate(self, name: str) -> None:
+        for key, entry in list(self._entries.items()):
+            if entry.name == name:
+                del self._entries[key]
+        logger.info(f"Dropped context cache {name}")
+
+    @staticmethod
+    def is_cache_error(e: Exception) -> bool:
+        return isinstance(e, errors.APIError) and e.code in CACHE_ERROR_CODES
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _create(self, model: str, tail: Turn, base: Optional[Turn], contents: list[types.Content],
+                      system_instruction: list[types.Part], tools: list[types.Tool]) -> None:
+        try:
+            cached = await self._client().aio.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    contents=contents,
+                    system_instruction=system_instruction,
+                    tools=tools,
+                    ttl=f"{int(self.ttl)}s",
+                ),
+            )
+        except Exception as e:
+            self.stats.failures += 1
+            logger.warning(f"Failed to create context cache for {model} ({len(contents)} turns). {e}")
+            return
+        finally:
+            self._pending.discard((model, tail))
+        self.stats.created += 1
+        self._entries[(model, weakref.ref(tail))] = _Entry(cached.name, self._clock() + self.ttl, base) # type: ignore
+        logger.info(f"Created context cache {cached.name} for {model} ({len(contents)} turns)")
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            self._spawn(self._delete(entry.name))
+
+    async def _refresh(self, name: str) -> None:
+        try:
+            await self._client().aio.caches.update(
+                name=name, config=types.UpdateCachedContentConfig(ttl=f"{int(self.ttl)}s")
+            )
+            self.stats.refreshed += 1
+        except Exception as e:
+            self.stats.failures += 1
+            logger.warning(f"Failed to refresh context cache {name}. {e}")
+            self.invalidate(name)
+
+    async def _delete(self, name: str) -> None:
+        try:
+            await self._client().aio.caches.delete(name=name)
+        except Exception as e:
+            logger.debug(f"Failed to delete context cache {name}. {e}")
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from typing import Iterable, Optional
+from google.genai import types
+
+# 1秒あたりのバイト数の目安 (Gemini の音声は1秒 32 トークン)。非圧縮の形式以外は 128kbps とみなす
+_AUDIO_BYTES_PER_SECOND = {
+    "audio/wav": 176400, "audio/x-wav": 176400, "audio/vnd.wave": 176400,
+    "audio/aiff": 176400, "audio/x-aiff": 176400,
+    "audio/flac": 88200, "audio/x-flac": 88200,
+}
+_AUDIO_TOKENS_PER_SECOND = 32
+_IMAGE_TOKENS = 258
+
+# Files API にアップロードしたファイルの URI → バイト数 (アップロード・再利用時に記録する)
+_file_sizes: OrderedDict[str, int] = OrderedDict()
+_FILE_SIZES_MAX = 10000
+# 記録のない URI (再起動前のセッションなど) のバイト数。Files API を使うのはこれ以上の大きさのファイルだけ
+unknown_file_size = 0
+
+
+def record_file_size(uri: str, size: int) -> None:
+    _file_sizes[uri] = size
+    _file_sizes.move_to_end(uri)
+    while len(_file_sizes) > _FILE_SIZES_MAX:
+        _file_sizes.popitem(last=False)
+
+
+def estimate_media_tokens(mime_type: Optional[str], size: int) -> int:
+    """画像は1枚 258 トークン、音声は長さ (バイト数から推定) に比例するトークン数"""
+    mime_type = mime_type or ""
+    if mime_type.startswith("image/"):
+        return _IMAGE_TOKENS
+    if mime_type.startswith("audio/"):
+        seconds = size / _AUDIO_BYTES_PER_SECOND.get(mime_type, 16000)
+        return int(seconds * _AUDIO_TOKENS_PER_SECOND)
+    return size // 1000
+
+
+def estimate_content_size(content: types.Content) -> int:
+    """Content が保持しているテキスト・インラインデータのおおよそのバイト数"""
+    size = 64
+    for part in content.parts or []:
+        if part.text:
+            size += len(part.text.encode("utf-8"))
+        if part.inline_data and part.inline_data.data:
+            size += len(part.inline_data.data)
+        if part.file_data and part.file_data.file_uri:
+            size += len(part.file_data.file_uri)
+    return size
+
+
+def estimate_tokens(content: types.Content) -> int:
+    """Content のおおよそのトークン数 (圧縮やキャッシュの目安にだけ使う)"""
+    tokens = 0
+    for part in content.parts or []:
+        if part.text:
+            tokens += len(part.text.encode("utf-8")) // 4 + 1
+        if part.inline_data and part.inline_data.data:
+            tokens += estimate_media_tokens(part.inline_data.mime_type, len(part.inline_data.data))
+        if part.file_data and part.file_data.file_uri:
+            size = _file_sizes.get(part.file_data.file_uri, unknown_file_size)
+            tokens += estimate_media_tokens(part.file_data.mime_type, size)
+    return tokens
+
+
+def merge_stream_contents(contents: list[types.Content]) -> list[types.Content]:
+    """ストリーミングでチャンクごとに分かれた Content を1ターンにまとめる
+
+    同じ role の連続した Content を結合し、隣り合う通常のテキストパートは1つにつなげる。
+    """
+    groups: list[tuple[str | None, list[types.Part]]] = []
+    for content in contents:
+        if not groups or groups[-1][0] != content.role:
+            groups.append((content.role, []))
+        parts = groups[-1][1]
+        for part in content.parts or []:
+            if parts and _is_plain_text(parts[-1]) and _is_plain_text(part):
+                parts[-1] = types.Part(text=(parts[-1].text or "") + (part.text or ""))
+            else:
+                parts.append(part)
+    return [types.Content(role=role, parts=parts) for role, parts in groups]
+
+
+def _is_plain_text(part: types.Part) -> bool:
+    return part.text is not None and not part.thought and part.thought_signature is None
+
+
+class Turn:
+    """会話ツリーのノード
+
+    親ノードへの参照と自分の Content だけを持つ。
+    分岐した会話は共通の祖先ノードを共有するため、履歴はコピーされない。
+    checkpoint には、根からこのノードまでの履歴を圧縮したものを置ける。
+    refs はこのノードを経路に含む、セッションストアに登録された枝の数。
+    """
+    __slots__ = ("content", "parent", "depth", "size", "checkpoint", "refs", "__weakref__")
+
+    def __init__(self, content: types.Content, parent: Optional["Turn"] = None):
+        self.content = content
+        self.parent = parent
+        self.depth: int = parent.depth + 1 if parent else 1
+        self.size = estimate_content_size(content)
+        self.checkpoint: Optional[list[types.Content]] = None
+        self.refs = 0
+
+    def ancestor(self, depth: int) -> Optional["Turn"]:
+        """深さ depth の祖先 (自身を含む) を返す。depth <= 0 なら None"""
+        node: Optional[Turn] = self
+        while node is not None and node.depth > depth:
+            node = node.parent
+        return node
+
+
+class Branch:
+    """セッションが指す会話の枝
+
+    tail から根までを辿ったものが Gemini に渡す履歴になる。
+    共有しているノードのメモリ使用量は retain / release で参照を数えて1回だけ計上する。
+    """
+    __slots__ = ("tail",)
+
+    def __init__(self, tail: Optional[Turn] = None):
+        self.tail = tail
+
+    def __len__(self) -> int:
+        return self.tail.depth if self.tail else 0
+
+    def fork(self, depth: Optional[int] = None) -> "Branch":
+        """深さ depth の時点から新しい枝を作る。祖先のノードはそのまま共有される"""
+        if depth is None or self.tail is None:
+            return Branch(self.tail)
+        return Branch(self.tail.ancestor(depth))
+
+    def extended(self, contents: Iterable[types.Content]) -> "Branch":
+        """contents を末尾に追加した新しい枝を返す"""
+        tail = self.tail
+        for content in contents:
+            tail = Turn(content, tail)
+        return Branch(tail)
+
+    def retain(self) -> int:
+        """枝の各ノードの参照を1つ増やし、新たに参照されるようになったノードのサイズの合計を返す"""
+        added = 0
+        node = self.tail
+        while node is not None:
+            node.refs += 1
+            if node.refs == 1:
+                added += node.size
+            node = node.parent
+        return added
+
+    def release(self) -> int:
+        """retain を取り消し、どの枝からも参照されなくなったノードのサイズの合計を返す"""
+        freed = 0
+        node = self.tail
+        while node is not None:
+            node.refs -= 1
+            if node.refs == 0:
+                freed += node.size
+            node = node.parent
+        return freed
+
+    def context(self) -> tuple[list[types.Content], Optional[Turn]]:
+        """モデルに送る履歴と、その起点になったチェックポイントのノードを返す
+
+        最も近いチェックポイントより前は圧縮した履歴、それ以降は元のターンそのまま。
+        """
+        contents: list[types.Content] = []
+        node = self.tail
+        while node is not None and node.checkpoint is None:
+            contents.append(node.content)
+            node = node.parent
+        contents.reverse()
+        if node is None:
+            return contents, None
+        return [*node.checkpoint, *contents], node # type: ignore
+
+    def history(self) -> list[types.Content]:
+        """根から順に並べた Content のリストを組み立てる"""
+        history: list[types.Content] = []
+        node = self.tail
+        while node is not None:
+            history.append(node.content)
+            node = node.parent
+        history.reverse()
+        return history
@@ -2,34 +2,151 @@ from google import genai
 from google.genai import errors
 from google.genai import types
 import os
-from io import BytesIO
-from PIL import Image
-import mimetypes
-import tempfile
 from .config import Config
+from .sessions import SessionStore
+from .conversation import Branch, Turn, merge_stream_contents
+from .storage import FileIndexDB, SessionSnapshot, open_session_store
+from .uploads import FileUploader
+from . import media
+from . import compaction
+from . import conversation
+from .scheduler import Scheduler
+from .resilience import Resilience
+from .cache import CachedAnswer, ResponseCache, cache_key
+from .context_cache import ContextCache
+from .quota import Quota
+from . import metrics
+from typing import AsyncIterator
+import asyncio
+import logging
+import time
 
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 MODEL = os.environ.get("MODEL", "gemini-2.5-flash")
 IMAGE_MODEL = os.environ.get("IMAGE_MODEL", "gemini-2.0-flash-preview-image-generation")
+# 混雑時 (429/503 が続いたとき) に切り替えるモデル。空なら切り替えない
+FALLBACK_MODEL = os.environ.get("FALLBACK_MODEL", "gemini-2.5-flash-lite") or None
+FALLBACK_IMAGE_MODEL = os.environ.get("FALLBACK_IMAGE_MODEL", "") or None
+# 長い会話の古いターンを要約するモデル
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gemini-2.5-flash-lite")
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-chats = {}
+logger = logging.getLogger(__name__)
 
-def save_image_to_temp(inline_data) -> str:
-    """BytesIO から PIL で開いて、一時ファイルに保存。パスを返す。"""
-    img = Image.open(BytesIO(inline_data.data))
-    suffix = mimetypes.guess_extension(inline_data.mime_type) or ".png"
-    fd, path = tempfile.mkstemp(suffix=suffix)
-    try:
-        img.save(path)
-    finally:
-        os.close(fd)
-    return path
+_client: genai.Client | None = None
+
+
+def get_client() -> genai.Client:
+    """Gemini クライアントは最初に使うときに作成する"""
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=GEMINI_API_KEY)
+    return _client
+
+
+class SessionNotFoundError(Exception):
+    """セッションが期限切れ・追い出し済みで見つからない"""
+
+
+# セッションIDごとに会話ツリーの枝を保持する (分岐元と共通の履歴は共有される)
+chats: SessionStore[int, Branch] = SessionStore(
+    max_sessions=Config.SESSION_MAX_COUNT,
+    max_bytes=Config.SESSION_MAX_BYTES,
+    ttl=Config.SESSION_TTL,
+    sizeof=Branch.retain,
+    release=Branch.release,
+)
+# モデルごとの同時実行数・レート制限とユーザー間の公平性を保つ
+scheduler = Scheduler({
+    "text": (Config.TEXT_CONCURRENCY, Config.TEXT_RPM),
+    "image": (Config.IMAGE_CONCURRENCY, Config.IMAGE_RPM),
+})
+# 429/503 の再試行とフォールバックモデルへの切り替え
+resilience = Resilience(
+    max_attempts=Config.RETRY_MAX_ATTEMPTS,
+    base_delay=Config.RETRY_BASE_DELAY,
+    max_delay=Config.RETRY_MAX_DELAY,
+    threshold=Config.BREAKER_THRESHOLD,
+    cooldown=Config.BREAKER_COOLDOWN,
+)
+# 再起動やメモリからの追い出しに備えてディスク (または共有ストア) にも保存し、必要になった時だけ読み込む
+session_db = open_session_store(Config.SESSION_BACKEND, path=Config.SESSION_DB, url=Config.REDIS_URL, ttl=Config.SESSION_TTL)
+# 終了時にメモリ上のセッションを書き出し、次の起動後に必要になったものだけ読み込む
+snapshot = SessionSnapshot(Config.SESSION_SNAPSHOT)
+# 大きなメディアは Files API に一度だけアップロードし、以降は URI で参照する
+uploader = FileUploader(
+    get_client,
+    FileIndexDB(Config.FILE_INDEX_DB),
+    threshold=Config.FILES_API_THRESHOLD,
+    min_remaining=Config.SESSION_TTL,
+)
+# 大きさの記録がない URI (再起動前のセッションなど) は、Files API を使う最小の大きさとみなしてトークン数を見積もる
+conversation.unknown_file_size = Config.FILES_API_THRESHOLD
+# 同じ最初の質問への応答を使い回す (ANSWER_CACHE_TTL が 0 なら無効)
+answer_cache = ResponseCache(max_entries=Config.ANSWER_CACHE_MAX, ttl=Config.ANSWER_CACHE_TTL)
+# 長い会話の共通部分をサーバー側にキャッシュして、毎ターンの再送をやめる
+context_cache = ContextCache(
+    get_client,
+    min_tokens=Config.CONTEXT_CACHE_MIN_TOKENS,
+    ttl=Config.CONTEXT_CACHE_TTL,
+    max_entries=Config.CONTEXT_CACHE_MAX,
+)
+
+# ユーザーごと・全体の利用上限と、同時に処理するリクエスト数の上限
+quotas = Quota(
+    window=Config.QUOTA_WINDOW,
+    user_tokens=Config.QUOTA_USER_TOKENS,
+    user_requests=Config.QUOTA_USER_REQUESTS,
+    global_tokens=Config.QUOTA_GLOBAL_TOKENS,
+    global_requests=Config.QUOTA_GLOBAL_REQUESTS,
+    max_inflight=Config.MAX_INFLIGHT,
+    max_inflight_per_user=Config.MAX_INFLIGHT_PER_USER,
+    downgrade_ratio=Config.QUOTA_DOWNGRADE_RATIO,
+)
+
+metrics.registry.gauge("bot_inflight", "Interactions being processed", lambda: quotas.inflight)
+metrics.registry.gauge("bot_sessions", "Conversation sessions held in memory", lambda: len(chats))
+metrics.registry.gauge("bot_session_bytes", "Approximate size of the sessions held in memory", lambda: chats.total_bytes)
+metrics.registry.gauge(
+    "bot_queue_depth", "Requests waiting for a Gemini slot",
+    lambda: {(lane,): stats["queued"] for lane, stats in scheduler.stats().items()}, labelnames=("lane",),
+)
+metrics.registry.stats("bot_resilience_events_total", "Gemini retries, fallbacks, failures and breaker trips", resilience.stats)
+metrics.registry.gauge(
+    "bot_circuit_breaker_state", "1 for the current circuit breaker state of each model",
+    lambda: {(model, state): int(breaker.state == state) for model, breaker in resilience.breakers.items()
+             for state in (breaker.CLOSED, breaker.OPEN, breaker.HALF_OPEN)},
+    labelnames=("model", "state"),
+)
+metrics.registry.stats("bot_quota_events_total", "Requests admitted, rejected, shed and downgraded by the quota", quotas.stats)
+metrics.registry.stats("bot_context_cache_events_total", "Context caches created, hit, refreshed and failed", context_cache.stats)
+metrics.registry.stats("bot_answer_cache_events_total", "Answer cache hits, misses and coalesced requests", answer_cache.stats)
+metrics.registry.stats("bot_upload_events_total", "Files API uploads, reuses and failures", uploader.stats)
+metrics.registry.stats("bot_session_events_total", "Session store hits, misses, evictions and expirations", chats.stats)
+
+SYSTEM_INSTRUCTION = [
+    types.Part.from_text(text="""あなたは優秀なAIアシスタントです。回答は指定がない限り日本語でしてください。
+                                 ユーザの質問は以下のように構造化されています。<**ユーザの名前**>: <質問内容>""")
+]
+TOOLS = [
+    types.Tool(google_search=types.GoogleSearch()),
+    types.Tool(url_context=types.UrlContext()),
+]
+
+async def prepare_parts(parts: list[dict]) -> list[dict]:
+    """送信前の前処理。添付画像は縮小・変換し、大きなファイルは Files API にアップロードしてから送る"""
+    prepared = []
+    for part in parts:
+        if "file_data" in part and part["file_data"]["mime_type"] in Config.ALLOWED_IMAGE_MIME:
+            data, mime_type = await media.prepare_image(part["file_data"]["data"], part["file_data"]["mime_type"])
+            part = {"file_data": {"mime_type": mime_type, "data": data}}
+        prepared.append(await uploader.resolve(part))
+    return prepared
 
 def create_part_objs(parts: list[dict]) -> types.Content:
     """
     parts = [
         {"file_data": {"mime_type": file mime type, "data": file byte data}},
+        {"file_uri": {"mime_type": file mime type, "uri": Files API の URI}},
         {"text": "prompt"}
     ]
     """
@@ -42,6 +159,11 @@ def create_part_objs(parts: list[dict]) -> types.Content:
                 mime_type=part["file_data"]["mime_type"],
                 data=part["file_data"]["data"]
             ))
+        elif "file_uri" in part:
+            part_objs.append(types.Part.from_uri(
+                file_uri=part["file_uri"]["uri"],
+                mime_type=part["file_uri"]["mime_type"]
+            ))
     
     contents = types.Content(
             role="user",
@@ -49,78 +171,359 @@ def create_part_objs(parts: list[dict]) -> types.Content:
         )
     return contents
 
-def create_chat(parent_id: int | None = None, last_idx: int | None = None):
-    if parent_id is not None:
-        history = chats[parent_id].get_history()[:last_idx]
+async def load_branch(id: int) -> Branch:
+    """メモリ上になければスナップショットかディスクから読み込んでセッションに登録する"""
+    branch = chats.get(id)
+    if branch is not None:
+        return branch
+    history = await snapshot.load(id)
+    if history is None:
+        history = await session_db.load(id)
+    if history is None:
+        raise SessionNotFoundError(id)
+    branch = Branch().extended(history)
+    chats.put(id, branch)
+    logger.debug(f"Restored session {id} from disk ({len(branch)} turns)")
+    return branch
+
+async def save_snapshot() -> int:
+    """保存待ちの書き込みを終わらせ、メモリ上のセッションをスナップショットに書き出す"""
+    await session_db.flush()
+    now = time.time()
+    sessions = [(id, branch.history(), now + remaining) for id, branch, remaining in chats.items()]
+    return await asyncio.to_thread(snapshot.write, sessions)
+
+async def get_branch(id: int, parent_id: int | None = None, last_idx: int | None = None, is_new_chat: bool = False) -> Branch:
+    """送信先の枝を取得する。分岐する場合は親の枝の last_idx 時点から新しい枝を作る"""
+    if not is_new_chat:
+        return await load_branch(id)
+    if parent_id is None:
+        return Branch()
+    parent = await load_branch(parent_id)
+    return parent.fork(last_idx)
+
+def create_chat(history: list[types.Content] | None = None, model: str = MODEL, cached_content: str | None = None):
+    """会話ツリーから組み立てた履歴で、送信用のチャットを作成
+
+    cached_content を指定した場合、システムプロンプト・ツールと history より前の履歴はキャッシュ側にある。
+    """
+    if cached_content:
+        generate_content_config = types.GenerateContentConfig(
+            cached_content=cached_content,
+            response_mime_type="text/plain",
+        )
     else:
-        history = None
-    grounding_tool = types.Tool(
-        google_search=types.GoogleSearch()
-    )
-    url_context_tool = types.Tool(
-        url_context=types.UrlContext()
-    )
-    generate_content_config = types.GenerateContentConfig(
-        tools=[grounding_tool, url_context_tool],
-        response_mime_type="text/plain",
-        system_instruction=[
-            types.Part.from_text(text="""あなたは優秀なAIアシスタントです。回答は指定がない限り日本語でしてください。
-                                 ユーザの質問は以下のように構造化されています。<**ユーザの名前**>: <質問内容>""")
-        ],
-    )
-    chat = client.aio.chats.create(
-        model=MODEL,
+        generate_content_config = types.GenerateContentConfig(
+            tools=TOOLS,
+            response_mime_type="text/plain",
+            system_instruction=SYSTEM_INSTRUCTION,
+        )
+    chat = get_client().aio.chats.create(
+        model=model,
         config=generate_content_config,
         history=history
     )
     return chat
 
-def delete_chat(id: int):
-    del chats[id]
+def _open_chat(branch: Branch, history: list[types.Content], base: Turn | None, model: str):
+    """キャッシュ済みの部分を除いた履歴でチャットを作り、(chat, 渡した履歴, キャッシュ名) を返す"""
+    cached_content, depth = context_cache.lookup(model, branch.tail, base)
+    chat_history = history[len(history) - (len(branch) - depth):] if cached_content else history
+    return create_chat(chat_history, model, cached_content), chat_history, cached_content
 
-async def generate_image(parts: list[dict]):
-    contents = create_part_objs(parts)
-    response = await client.aio.models.generate_content(
-        model=IMAGE_MODEL,
-        contents=contents,
-        config=types.GenerateContentConfig(
-            response_modalities=["TEXT", "IMAGE"],
-        )
-    )
+async def _summarize(contents: list[types.Content]) -> str:
+    """圧縮する古いターンを要約する"""
+    prompt = types.Content(role="user", parts=[types.Part.from_text(text=compaction.SUMMARY_PROMPT)])
+
+    async def send(model: str):
+        async with scheduler.slot("text"):
+            return await get_client().aio.models.generate_content(model=model, contents=[*contents, prompt])
+
+    response = await resilience.call(SUMMARY_MODEL, None, send)
+    if not response.text:
+        raise ValueError("empty summary")
+    return response.text
+
+async def generate_image(parts: list[dict], user_id: int | None = None) -> tuple[types.Blob | None, str, int | None, int | None]:
+    """画像を生成し、(画像の inline_data, テキスト, 入力トークン, 出力トークン) を返す"""
+    contents = create_part_objs(await prepare_parts(parts))
+    return await _generate_image(contents, user_id)
+
+async def generate_images(
+        parts: list[dict],
+        count: int,
+        user_id: int | None = None,
+        deadline: float = Config.IMAGE_DEADLINE
+        ) -> tuple[list[tuple[types.Blob, str]], int | None, int | None]:
+    """count 枚の画像を並行して生成し、([(画像, テキスト), ...], 入力トークンの合計, 出力トークンの合計) を返す
+
+    同時に実行する数は scheduler の image レーンが制限する。deadline 秒までに終わらなかった生成は取り消す。
+    1枚も生成できなければ、最初に起きたエラー (すべて時間切れなら TimeoutError) を送出する。
+    """
+    contents = create_part_objs(await prepare_parts(parts))
+    tasks = [asyncio.create_task(_generate_image(contents, user_id)) for _ in range(count)]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+    finally:
+        # 時間切れ (または呼び出し元の取り消し) で残った生成は打ち切る
+        for task in tasks:
+            task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.info(f"Cancelled {len(pending)} of {count} image generations after {deadline:.0f}s")
+
+    images: list[tuple[types.Blob, str]] = []
+    input_token = output_token = None
+    failures: list[BaseException] = []
+    for task in tasks:
+        if task not in done:
+            continue
+        if task.exception() is not None:
+            failures.append(task.exception()) # type: ignore
+            continue
+        image, text, i, o = task.result()
+        input_token = (input_token or 0) + i if i is not None else input_token
+        output_token = (output_token or 0) + o if o is not None else output_token
+        if image is not None:
+            images.append((image, text))
+    if not images and failures:
+        raise failures[0]
+    if not images and pending:
+        raise TimeoutError(f"image generation did not finish in {deadline:.0f}s")
+    return images, input_token, output_token
+
+async def _generate_image(contents: types.Content, user_id: int | None) -> tuple[types.Blob | None, str, int | None, int | None]:
+    async def send(model: str):
+        async with scheduler.slot("image", user_id):
+            return await get_client().aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    response_modalities=["TEXT", "IMAGE"],
+                )
+            )
+
+    response = await resilience.call(IMAGE_MODEL, FALLBACK_IMAGE_MODEL, send)
     input_token = getattr(response.usage_metadata, "prompt_token_count", None)
     output_token = getattr(response.usage_metadata, "candidates_token_count", None)
-    image_path = None
+    image = None
     text = ""
     for part in response.candidates[0].content.parts: # type: ignore
         if part.text is not None:
             text = part.text
         if part.inline_data and part.inline_data.data:
-            image_path = save_image_to_temp(part.inline_data)
+            image = part.inline_data
             break
-    return image_path, text, input_token, output_token
+    return image, text, input_token, output_token
+
+async def _prepare_chat(parts: list[dict], id: int, parent_id: int | None, last_idx: int | None, is_new_chat: bool):
+    contents = create_part_objs(await prepare_parts(parts))
+    branch = await get_branch(id, parent_id, last_idx, is_new_chat)
+    await compaction.compact(
+        branch,
+        budget=Config.HISTORY_TOKEN_BUDGET,
+        keep_turns=Config.HISTORY_KEEP_TURNS,
+        summarize=_summarize if Config.HISTORY_SUMMARIZE else None,
+    )
+    history, base = branch.context()
+    return contents, branch, history, base
+
+def _answer_cache_key(parts: list[dict], parent_id: int | None, is_new_chat: bool) -> str | None:
+    """キャッシュの対象 (返信ではない最初の質問) ならキーを返す"""
+    if not answer_cache.enabled or not is_new_chat or parent_id is not None:
+        return None
+    return cache_key(parts, MODEL)
+
+def _reuse_answer(id: int, parts: list[dict], answer: CachedAnswer) -> int:
+    """キャッシュした応答と今回の質問で新しいセッションを作り、枝の長さを返す
+
+    添付ファイルは前処理済みのものを使い回し、テキストだけ今回の質問 (ユーザー名を含む) に差し替える。
+    """
+    question, *turns = answer.turns
+    contents = types.Content(role="user", parts=[
+        types.Part.from_text(text=part["text"]) if "text" in part else cached
+        for part, cached in zip(parts, question.parts or [])
+    ])
+    branch = Branch().extended([contents, *turns])
+    chats.put(id, branch)
+    session_db.save(id, branch.history())
+    logger.info(f"Answered {id} from cache")
+    return len(branch)
+
+def _commit_chat(
+        id: int,
+        branch: Branch,
+        history: list[types.Content],
+        chat,
+        model: str,
+        contents: types.Content,
+        text: str | None,
+        merge: bool = False
+        ) -> Branch:
+    """今回追加されたターンだけを枝の末尾に繋いでセッションに登録する
+
+    history はチャットに渡した履歴 (コンテキストキャッシュ分を除く)、contents は今回の質問、text は応答のテキスト。
+    """
+    new_turns = chat.get_history(curated=True)[len(history):]
+    if not new_turns:
+        # SDK は空のパートを含む応答 (ストリームの最後の空チャンクなど) を履歴から外すので、受け取ったテキストで補う
+        logger.warning(f"{id}: response was not added to the curated history, storing the received text instead")
+        new_turns = [contents, types.Content(role="model", parts=[types.Part.from_text(text=text or "エラーが発生しました")])]
+    elif merge:
+        new_turns = merge_stream_contents(new_turns)
+    branch = branch.extended(new_turns)
+    chats.put(id, branch)
+    session_db.save(id, branch.history())
+    if context_cache.enabled:
+        context, base = branch.context()
+        context_cache.maybe_create(model, branch.tail, base, context, SYSTEM_INSTRUCTION, TOOLS)
+    logger.debug(f"sessions: {len(chats)} ({chats.total_bytes} bytes) {chats.stats}")
+    return branch
 
 async def generate_text(
         parts: list[dict], 
         id: int, 
         parent_id: int | None = None,
         last_idx: int | None = None,
-        is_new_chat: bool = False
+        is_new_chat: bool = False,
+        user_id: int | None = None,
+        downgrade: bool = False
         ):
-    contents = create_part_objs(parts)
-    if is_new_chat:
-        chats[id] = create_chat(parent_id, last_idx)
-    response = await chats[id].send_message(
-        message = contents.parts
-    )
-    text = add_citations(response)
-    input_token = getattr(response.usage_metadata, "prompt_token_count", None)
-    output_token = getattr(response.usage_metadata, "candidates_token_count", None)
-    last_idx = len(chats[id].get_history())
+    # キャッシュに当たれば添付ファイルの前処理やアップロードもしない
+    key = _answer_cache_key(parts, parent_id, is_new_chat)
+    if key is not None:
+        cached = await answer_cache.acquire(key)
+        if cached is not None:
+            return cached.text, cached.input_token, cached.output_token, _reuse_answer(id, parts, cached)
+
+    async def send(model: str):
+        while True:
+            chat, chat_history, cached_content = _open_chat(branch, history, base, model)
+            try:
+                async with scheduler.slot("text", user_id):
+                    response = await chat.send_message(
+                        message = contents.parts
+                    )
+            except Exception as e:
+                if cached_content is None or not context_cache.is_cache_error(e):
+                    raise
+                # キャッシュが使えなければ、キャッシュなしで送り直す
+                context_cache.invalidate(cached_content)
+                continue
+            return chat, chat_history, response, model
+
+    answer = None
+    try:
+        contents, branch, history, base = await _prepare_chat(parts, id, parent_id, last_idx, is_new_chat)
+        chat, chat_history, response, model = await resilience.call(*_models(downgrade), send)
+        branch = _commit_chat(id, branch, chat_history, chat, model, contents, response.text)
+        text = add_citations(response)
+        input_token, output_token = _token_counts(id, response.usage_metadata)
+        if key is not None and text and model == MODEL:
+            answer = CachedAnswer(text, input_token, output_token, branch.history()[len(history):])
+    finally:
+        if key is not None:
+            answer_cache.release(key, answer)
+    last_idx = len(branch)
     return text or "エラーが発生しました", input_token, output_token, last_idx
 
+class TextStream:
+    """generate_text のストリーミング版
+
+    async for で生成されたテキストの差分を受け取る。
+    最後まで読み終えると result に generate_text と同じ
+    (text, input_token, output_token, last_idx) が入る。
+    """
+    def __init__(self, parts: list[dict], id: int, parent_id: int | None, last_idx: int | None, is_new_chat: bool, user_id: int | None = None,
+                 downgrade: bool = False):
+        self._args = (parts, id, parent_id, last_idx, is_new_chat)
+        self._user_id = user_id
+        self._downgrade = downgrade
+        self.result: tuple[str, int | None, int | None, int] | None = None
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        parts, id, parent_id, last_idx, is_new_chat = self._args
+        key = _answer_cache_key(parts, parent_id, is_new_chat)
+        if key is not None:
+            cached = await answer_cache.acquire(key)
+            if cached is not None:
+                yield cached.text
+                self.result = (cached.text, cached.input_token, cached.output_token, _reuse_answer(id, parts, cached))
+                return
+        answer = None
+        try:
+            contents, branch, history, base = await _prepare_chat(parts, id, parent_id, last_idx, is_new_chat)
+            attempt = 0
+            while True:
+                model = resilience.choose_model(*_models(self._downgrade))
+                chat, chat_history, cached_content = _open_chat(branch, history, base, model)
+                texts: list[str] = []
+                usage = None
+                grounding_metadata = None
+                try:
+                    with resilience.attempt(model):
+                        async with scheduler.slot("text", self._user_id):
+                            async for chunk in await chat.send_message_stream(message=contents.parts):
+                                if chunk.usage_metadata:
+                                    usage = chunk.usage_metadata
+                                if chunk.candidates and chunk.candidates[0].grounding_metadata:
+                                    grounding_metadata = chunk.candidates[0].grounding_metadata
+                                if chunk.text:
+                                    texts.append(chunk.text)
+                                    yield chunk.text
+                except Exception as e:
+                    if cached_content is not None and not texts and context_cache.is_cache_error(e):
+                        context_cache.invalidate(cached_content)
+                        continue
+                    # 表示を始めた後は最初からやり直せないため、再試行は最初のチャンクの前だけ
+                    delay = resilience.backoff(e, attempt) if not texts else None
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                break
+            branch = _commit_chat(id, branch, chat_history, chat, model, contents, "".join(texts), merge=True)
+            text = format_citations("".join(texts).rstrip(), grounding_metadata)
+            input_token, output_token = _token_counts(id, usage)
+            if key is not None and text and model == MODEL:
+                answer = CachedAnswer(text, input_token, output_token, branch.history()[len(history):])
+        finally:
+            if key is not None:
+                answer_cache.release(key, answer)
+        self.result = (text or "エラーが発生しました", input_token, output_token, len(branch))
+
+def generate_text_stream(
+        parts: list[dict],
+        id: int,
+        parent_id: int | None = None,
+        last_idx: int | None = None,
+        is_new_chat: bool = False,
+        user_id: int | None = None,
+        downgrade: bool = False
+        ) -> TextStream:
+    return TextStream(parts, id, parent_id, last_idx, is_new_chat, user_id, downgrade)
+
+def _models(downgrade: bool) -> tuple[str, str | None]:
+    """(使うモデル, フォールバックモデル)。利用上限に近いユーザーには最初から軽いモデルを使う"""
+    if downgrade and FALLBACK_MODEL:
+        return FALLBACK_MODEL, None
+    return MODEL, FALLBACK_MODEL
+
+def _token_counts(id: int, usage) -> tuple[int | None, int | None]:
+    """(入力トークン, 出力トークン) を返す。コンテキストキャッシュから読んだ分は別に記録する"""
+    cached_token = getattr(usage, "cached_content_token_count", None)
+    if cached_token:
+        logger.info(f"{id}: {{cached_token: {cached_token}}}")
+    return getattr(usage, "prompt_token_count", None), getattr(usage, "candidates_token_count", None)
+
 def add_citations(response) -> str:
     text = response.text.rstrip()
     gm = getattr(response.candidates[0], "grounding_metadata", None)
+    return format_citations(text, gm)
+
+def format_citations(text: str, gm) -> str:
+    """グラウンディングの参照元を脚注として text の末尾に付ける"""
     if not gm or not gm.grounding_supports or gm.grounding_chunks is None:
         return text
 
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import math
+import mimetypes
+import discord
+from io import BytesIO
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+# Discord がそのままプレビューできる画像形式
+DISCORD_IMAGE_MIME: set[str] = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+# Gemini にそのまま送れる形式 (HEIC/HEIF はこれらに変換する)
+GEMINI_NATIVE_IMAGE_MIME: set[str] = {"image/png", "image/jpeg", "image/webp"}
+
+_heif_registered: bool | None = None
+
+
+def _register_heif() -> bool:
+    """pillow-heif があれば HEIC/HEIF を開けるようにする (任意の依存)"""
+    global _heif_registered
+    if _heif_registered is None:
+        try:
+            import pillow_heif
+            pillow_heif.register_heif_opener()
+            _heif_registered = True
+        except ImportError:
+            _heif_registered = False
+    return _heif_registered
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini が画像に割り当てるトークン数の見積もり
+
+    384px 以下なら 258 トークン、それより大きい画像はタイルに分割され、1タイルあたり 258 トークン。
+    """
+    if width <= 384 and height <= 384:
+        return 258
+    unit = min(max(int(min(width, height) / 1.5), 256), 768)
+    return math.ceil(width / unit) * math.ceil(height / unit) * 258
+
+
+def _prepare_image(data: bytes, mime_type: str, max_edge: int) -> tuple[bytes, str, tuple[int, int], tuple[int, int]]:
+    from PIL import Image, ImageOps
+    if mime_type not in GEMINI_NATIVE_IMAGE_MIME:
+        _register_heif()
+    with Image.open(BytesIO(data)) as src:
+        before = src.size
+        needs_resize = max(src.size) > max_edge
+        needs_convert = mime_type not in GEMINI_NATIVE_IMAGE_MIME
+        has_metadata = any(key in src.info for key in ("exif", "icc_profile", "xmp", "comment"))
+        if not (needs_resize or needs_convert or has_metadata):
+            return data, mime_type, before, before
+        # メタデータを捨てる前に EXIF の向きを反映しておく
+        img = ImageOps.exif_transpose(src)
+        if needs_resize:
+            img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        buf = BytesIO()
+        if img.mode in ("RGBA", "LA", "P"):
+            img.save(buf, format="WEBP", quality=Config.IMAGE_QUALITY)
+            out_mime = "image/webp"
+        else:
+            img.convert("RGB").save(buf, format="JPEG", quality=Config.IMAGE_QUALITY, optimize=True)
+            out_mime = "image/jpeg"
+        return buf.getvalue(), out_mime, before, img.size
+
+
+async def prepare_image(data: bytes, mime_type: str, max_edge: int = Config.IMAGE_MAX_EDGE) -> tuple[bytes, str]:
+    """モデルに送る前に入力画像を縮小・変換し、メタデータを取り除く
+
+    処理はワーカースレッドで行う。開けない画像 (pillow-heif が無い HEIC など) はそのまま返す。
+    """
+    try:
+        out, out_mime, before, after = await asyncio.to_thread(_prepare_image, data, mime_type, max_edge)
+    except Exception as e:
+        logger.warning(f"Failed to preprocess {mime_type} image, sending as is. {e!r}")
+        return data, mime_type
+    if out is not data:
+        logger.info(
+            f"Preprocessed image: {mime_type} {before[0]}x{before[1]} {len(data)} bytes ~{estimate_image_tokens(*before)} tokens"
+            f" -> {out_mime} {after[0]}x{after[1]} {len(out)} bytes ~{estimate_image_tokens(*after)} tokens"
+        )
+    return out, out_mime
+
+
+def extension_for(mime_type: str, default: str = ".png") -> str:
+    return mimetypes.guess_extension(mime_type) or default
+
+
+def _convert_to_png(data: bytes) -> bytes:
+    from PIL import Image
+    with Image.open(BytesIO(data)) as img:
+        buf = BytesIO()
+        img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+async def to_discord_file(data: bytes, mime_type: str, stem: str) -> discord.File:
+    """モデルが返した画像を、そのままのバイト列でメモリ上の discord.File にする
+
+    Discord で表示できない形式のときだけ、ワーカースレッドで PNG に変換する。
+    """
+    if mime_type not in DISCORD_IMAGE_MIME:
+        data = await asyncio.to_thread(_convert_to_png, data)
+        mime_type = "image/png"
+    return discord.File(BytesIO(data), filename=f"{stem}{extension_for(mime_type)}")
+
+
+def _make_grid(images: list[bytes], cell: int, quality: int) -> bytes:
+    from PIL import Image
+    cols = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / cols)
+    gap = max(2, cell // 64)
+    grid = Image.new("RGB", (cols * cell + (cols - 1) * gap, rows * cell + (rows - 1) * gap), (32, 34, 37))
+    for i, data in enumerate(images):
+        with Image.open(BytesIO(data)) as src:
+            img = src.convert("RGB")
+        img.thumbnail((cell, cell), Image.Resampling.LANCZOS)
+        x = (i % cols) * (cell + gap) + (cell - img.width) // 2
+        y = (i // cols) * (cell + gap) + (cell - img.height) // 2
+        grid.paste(img, (x, y))
+    buf = BytesIO()
+    grid.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+async def make_grid(images: list[bytes], stem: str, cell: int = Config.IMAGE_GRID_CELL) -> discord.File:
+    """複数の画像を1枚の一覧画像 (JPEG) にまとめる。処理はワーカースレッドで行う"""
+    data = await asyncio.to_thread(_make_grid, images, cell, Config.IMAGE_QUALITY)
+    return discord.File(BytesIO(data), filename=f"{stem}_grid.jpg")
@@ -0,0 +1,210 @@
+import asyncio
+import bisect
+import dataclasses
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 秒単位のレイテンシ用のバケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Prometheus 形式のヒストグラム。observe はバケットの探索と加算だけ"""
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...], labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labelnames = labelnames
+        # ラベルの値 → [バケットごとの件数..., +Inf の件数], 合計
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = 'le="' + str(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """値を読み出されたときに計算するゲージ (kind="counter" なら単調増加するカウンタ)。fn は数値か {ラベルの値: 数値} を返す"""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float | dict[tuple[str, ...], float]], labelnames: tuple[str, ...] = (),
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.debug(f"Failed to read gauge {self.name}: {e!r}")
+            return lines
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, v in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {v}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Histogram | Gauge] = {}
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS, labelnames: tuple[str, ...] = ()) -> Histogram:
+        metric = self._metrics[name] = Histogram(name, help, buckets, labelnames)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable, labelnames: tuple[str, ...] = ()) -> Gauge:
+        metric = self._metrics[name] = Gauge(name, help, fn, labelnames)
+        return metric
+
+    def counter(self, name: str, help: str, fn: Callable, labelnames: tuple[str, ...] = ()) -> Gauge:
+        """件数を持っている側 (stats など) から、読み出されたときに値を取るカウンタ"""
+        metric = self._metrics[name] = Gauge(name, help, fn, labelnames, kind="counter")
+        return metric
+
+    def stats(self, name: str, help: str, stats: object) -> Gauge:
+        """dataclass の各フィールドを event ラベルで区別したカウンタとして出す"""
+        return self.counter(name, help, lambda: {(field,): value for field, value in dataclasses.asdict(stats).items()}, ("event",)) # type: ignore
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+PHASE_SECONDS = registry.histogram("bot_phase_seconds", "Time spent in each phase of an interaction", labelnames=("command", "phase"))
+TOKENS = registry.histogram("bot_tokens", "Tokens per Gemini call", TOKEN_BUCKETS, labelnames=("direction",))
+QUEUE_WAIT = registry.histogram("bot_queue_wait_seconds", "Time spent waiting for a Gemini slot", labelnames=("lane",))
+LOOP_LAG = registry.histogram("bot_event_loop_lag_seconds", "Delay of a periodic task on the event loop",
+                              (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+
+class Trace:
+    """1つのインタラクションの各段階 (defer, ダウンロード, モデル呼び出し, 送信など) の所要時間"""
+
+    __slots__ = ("id", "command", "started", "phases")
+
+    def __init__(self, id: int, command: str):
+        self.id = id
+        self.command = command
+        self.started = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+
+    @contextmanager
+    def span(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases.append((phase, seconds))
+        PHASE_SECONDS.observe(seconds, self.command, phase)
+
+    def finish(self) -> None:
+        total = time.perf_counter() - self.started
+        PHASE_SECONDS.observe(total, self.command, "total")
+        if logger.isEnabledFor(logging.INFO):
+            spans = ", ".join(f"{phase}: {seconds:.3f}" for phase, seconds in self.phases)
+            logger.info(f"{self.id}: {{command: {self.command}, total: {total:.3f}, {spans}}}")
+
+
+def observe_tokens(input_token: int | None, output_token: int | None) -> None:
+    if input_token is not None:
+        TOKENS.observe(input_token, "input")
+    if output_token is not None:
+        TOKENS.observe(output_token, "output")
+
+
+async def monitor_loop_lag(interval: float = 1.0) -> None:
+    """interval 秒ごとに起きるタスクが、予定よりどれだけ遅れたかを記録する"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+class MetricsServer:
+    """/metrics (Prometheus 形式) と /healthz を返す最小限の HTTP サーバー"""
+
+    def __init__(self, host: str, port: int, is_healthy: Callable[[], bool]):
+        self.host = host
+        self.port = port
+        self.is_healthy = is_healthy
+        self._server: asyncio.Server | None = None
+        self._lag_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self._lag_task = asyncio.create_task(monitor_loop_lag())
+        logger.info(f"Metrics server listening on {self.host}:{self.port}")
+
+    async def close(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5.0)
+            # ヘッダーは使わないので読み捨てる
+            while (await asyncio.wait_for(reader.readline(), timeout=5.0)) not in (b"\r\n", b"\n", b""):
+                pass
+            method, path, *_ = request.decode("latin-1").split(" ") + ["", ""]
+            path = path.split("?", 1)[0]
+            if method not in ("GET", "HEAD"):
+                status, body, content_type = "405 Method Not Allowed", "method not allowed\n", "text/plain"
+            elif path == "/metrics":
+                status, body, content_type = "200 OK", registry.render(), "text/plain; version=0.0.4"
+            elif path == "/healthz":
+                ok = self.is_healthy()
+                status, body, content_type = ("200 OK", "ok\n", "text/plain") if ok else ("503 Service Unavailable", "not ready\n", "text/plain")
+            else:
+                status, body, content_type = "404 Not Found", "not found\n", "text/plain"
+            data = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            )
+            if method != "HEAD":
+                writer.write(data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -1,48 +1,218 @@
 import discord
-import google.genai
-import PIL
+import bisect
+import re
 import zlib
 import json
 import sys
 import time
 import logging
+from importlib import metadata
+from typing import Iterator, Optional
 from .config import Config
 
-def split_message(text, max_length=1900):
-    if len(text) <= max_length:
-        return [text] 
-    chunks = []
-    current_chunk = ""
-    lines = text.split('\n')
-    for line in lines:
-        # 行が長すぎる場合は文で分割
-        if len(line) > max_length:
-            sentences = line.split('。')
-            for sentence in sentences:
-                if sentence:  # 空でない場合
-                    sentence = sentence + '。' if not sentence.endswith('。') else sentence
-                    
-                    if len(current_chunk + sentence) > max_length:
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                            current_chunk = sentence
-                        else:
-                            # 1文が長すぎる場合は強制分割
-                            chunks.append(sentence[:max_length])
-                            current_chunk = sentence[max_length:]
-                    else:
-                        current_chunk += sentence
-        else:
-            if len(current_chunk + '\n' + line) > max_length:
-                chunks.append(current_chunk.strip())
-                current_chunk = line
+_FENCE_RE = re.compile(r"^\s*(`{3,}|~{3,})")
+# 途中で切ってはいけない範囲 (リンク・インラインコード・URL)
+_SPAN_RE = re.compile(r"(?=[!\[`<h])(?:!?\[[^\]\n]*\]\([^)\s]*\)|`[^`\n]+`|<https?://[^>\s]+>|https?://\S+)")
+_SENTENCE_ENDS = "。！？!?"
+_SEPARATOR_LINE = Config.RESPONSE_SEPARATOR.strip()
+
+
+class MessageSplitter:
+    """Markdown を壊さずにテキストを max_length 以下のチャンクへ分割する
+
+    feed() でテキストを少しずつ渡すと、確定したチャンクを順に返す。close() で残りを返す。
+    - 改行 > 文末 > 空白 の順に区切り、リンク・インラインコード・URL の途中では切らない
+    - コードブロックをまたぐときは閉じてから切り、次のチャンクで同じ言語指定で開き直す
+    - 見出し・参考リンクの見出しは次の行と同じチャンクに入れる
+    各行・各文字は一度しか走査しないため、入力長に対して線形時間で動く。
+    """
+
+    def __init__(self, max_length: int = Config.MAX_CHUNK_LEN):
+        self.max_length = max_length
+        self._parts: list[str] = []     # 現在のチャンクの行
+        self._size = 0                  # "\n".join(self._parts) の長さ
+        self._partial: list[str] = []   # 改行を待っている行の断片
+        self._partial_len = 0
+        self._keep: Optional[str] = None
+        self._fence: Optional[str] = None  # 開いているコードブロックの開始行
+        self._out: list[str] = []
+
+    @property
+    def preview(self) -> str:
+        """まだ確定していない部分 (表示用に開いているコードブロックは閉じる)"""
+        lines = [*self._parts]
+        if self._keep is not None:
+            lines.append(self._keep)
+        lines.append("".join(self._partial))
+        text = "\n".join(lines)
+        if self._fence is not None:
+            text += "\n" + self._closer(self._fence)
+        return text.strip()
+
+    def feed(self, text: str) -> list[str]:
+        lines = text.split("\n")
+        for line in lines[:-1]:
+            self._partial.append(line)
+            self._add_line("".join(self._partial))
+            self._partial, self._partial_len = [], 0
+        self._partial.append(lines[-1])
+        self._partial_len += len(lines[-1])
+        if self._partial_len > self.max_length:
+            # 改行がないまま長くなった行は、確定できる部分だけ先に切り出す
+            line = "".join(self._partial)
+            if self._keep is not None and not _FENCE_RE.match(self._keep):
+                line = f"{self._keep}\n{line}"
+                self._keep = None
+            elif self._keep is not None:
+                keep, self._keep = self._keep, None
+                self._place_line(keep)
+            self._flush()
+            pieces = self._cut(line)
+            for piece in pieces[:-1]:
+                self._emit_alone(piece)
+            self._partial, self._partial_len = [pieces[-1]], len(pieces[-1])
+        return self._drain()
+
+    def close(self) -> list[str]:
+        if self._partial:
+            self._add_line("".join(self._partial))
+            self._partial, self._partial_len = [], 0
+        if self._keep is not None:
+            keep, self._keep = self._keep, None
+            self._place_line(keep)
+        self._flush()
+        return self._drain()
+
+    def _drain(self) -> list[str]:
+        out, self._out = self._out, []
+        return out
+
+    @staticmethod
+    def _closer(fence: str) -> str:
+        return _FENCE_RE.match(fence).group(1) # type: ignore
+
+    def _next_fence(self, line: str, fence: Optional[str]) -> Optional[str]:
+        m = _FENCE_RE.match(line)
+        if m is None:
+            return fence
+        if fence is None:
+            return line.strip()
+        return None if m.group(1)[0] == fence[0] else fence
+
+    def _head_size(self, fence: Optional[str]) -> int:
+        return len(fence) + 1 if fence is not None else 0
+
+    def _tail_size(self, fence: Optional[str]) -> int:
+        return len(self._closer(fence)) + 1 if fence is not None else 0
+
+    def _add_line(self, line: str) -> None:
+        if self._keep is not None:
+            keep, self._keep = self._keep, None
+            fence_after = self._next_fence(line, self._next_fence(keep, self._fence))
+            unit = f"{keep}\n{line}"
+            if len(unit) + self._head_size(self._fence) + self._tail_size(fence_after) <= self.max_length:
+                self._place(unit, fence_after)
+                return
+            if _FENCE_RE.match(keep):
+                self._place_line(keep)
             else:
-                current_chunk += '\n' + line if current_chunk else line
-    
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
+                # 見出しは長い行の最初の断片と一緒に置く
+                self._place_line(unit)
+                return
+        if self._fence is None and (line.startswith("#") or line == _SEPARATOR_LINE or _FENCE_RE.match(line)):
+            # 次の行と離れないように保留する
+            self._keep = line
+            return
+        self._place_line(line)
+
+    def _place_line(self, line: str) -> None:
+        fence_after = self._next_fence(line, self._fence)
+        if len(line) + self._head_size(self._fence) + self._tail_size(fence_after) > self.max_length:
+            self._flush()
+            pieces = self._cut(line)
+            for piece in pieces[:-1]:
+                self._emit_alone(piece)
+            line = pieces[-1]
+        self._place(line, fence_after)
+
+    def _place(self, unit: str, fence_after: Optional[str]) -> None:
+        joiner = 1 if self._parts else 0
+        if self._parts and self._size + joiner + len(unit) + self._tail_size(fence_after) > self.max_length:
+            self._flush()
+            joiner = 1 if self._parts else 0
+        self._parts.append(unit)
+        self._size += joiner + len(unit)
+        self._fence = fence_after
+
+    def _flush(self) -> None:
+        if not self._parts:
+            return
+        fence = self._fence
+        if fence is not None:
+            self._parts.append(self._closer(fence))
+        chunk = "\n".join(self._parts).strip()
+        if chunk and chunk != fence:
+            self._out.append(chunk)
+        self._parts, self._size = ([fence], len(fence)) if fence is not None else ([], 0)
+
+    def _emit_alone(self, piece: str) -> None:
+        self._place(piece, self._fence)
+        self._flush()
+
+    def _cut(self, line: str) -> list[str]:
+        """長い行を、文末・空白・リンクの境界で max_length 以下に切り分ける"""
+        limit = self.max_length - self._head_size(self._fence) - self._tail_size(self._fence)
+        has_spans = "[" in line or "`" in line or "://" in line
+        spans = [(m.start(), m.end()) for m in _SPAN_RE.finditer(line)] if has_spans else []
+        span_starts = [s for s, _ in spans]
+        pieces = []
+        start = 0
+        while len(line) - start > limit:
+            end = start + limit
+            lo = start + limit // 2
+            cut = max(line.rfind(c, lo, end) for c in _SENTENCE_ENDS) + 1
+            if cut <= lo:
+                cut = line.rfind(" ", lo, end)
+            if cut <= lo:
+                cut = end
+            i = bisect.bisect_right(span_starts, cut - 1) - 1
+            if i >= 0 and spans[i][0] < cut < spans[i][1]:
+                span_start, span_end = spans[i]
+                if span_start > start:
+                    cut = span_start
+                elif span_end - start <= limit:
+                    cut = span_end
+            pieces.append(line[start:cut])
+            start = cut
+        pieces.append(line[start:])
+        return pieces
+
+
+def iter_chunks(text: str, max_length: int = Config.MAX_CHUNK_LEN) -> Iterator[str]:
+    splitter = MessageSplitter(max_length)
+    yield from splitter.feed(text)
+    yield from splitter.close()
+
+def split_message(text: str, max_length: int = Config.MAX_CHUNK_LEN) -> list[str]:
+    if len(text) <= max_length:
+        return [text]
+    return list(iter_chunks(text, max_length))
+
+def pack_chunks(chunks: list[str], max_embeds: int = Config.MAX_EMBEDS_PER_MESSAGE,
+                max_chars: int = Config.MAX_EMBED_CHARS_PER_MESSAGE) -> list[list[str]]:
+    """分割したチャンクを、1メッセージに載せられる埋め込みの組にまとめる"""
+    groups: list[list[str]] = []
+    current: list[str] = []
+    size = 0
+    for chunk in chunks:
+        if current and (len(current) >= max_embeds or size + len(chunk) > max_chars):
+            groups.append(current)
+            current, size = [], 0
+        current.append(chunk)
+        size += len(chunk)
+    if current:
+        groups.append(current)
+    return groups
 
 def get_error_embed(description: str) -> discord.Embed:
     return discord.Embed(
@@ -50,12 +220,24 @@ def get_error_embed(description: str) -> discord.Embed:
         description=description, 
         colour=Config.EMBED_SET["error"]["colour"])
     
+def get_restarting_embed() -> discord.Embed:
+    return discord.Embed(
+        title="Restarting",
+        description="Botを再起動しています。少し待ってからもう一度お試しください",
+        colour=Config.EMBED_SET["info"]["colour"])
+
 def rgb(r, g, b): return f"\x1b[38;2;{r};{g};{b}m"  # 前景
 LOGO = rgb(114, 137, 218)
 GREEN  = rgb(80, 255, 180)
 GREY   = rgb(180, 180, 180)
 RESET  = "\x1b[0m"
 
+def _package_version(name: str) -> str:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "-"
+
 def print_banner(bot, start_ts: float) -> None:
     lines = Config.LOGO.split("\n")
     for line in lines:
@@ -72,13 +254,18 @@ def print_banner(bot, start_ts: float) -> None:
     rows = [
         (f"{GREEN}python{RESET}",   f"{sys.version_info.major}.{sys.version_info.minor}"),
         (f"{GREEN}discord.py{RESET}", discord.__version__),
-        (f"{GREEN}google-genai{RESET}", google.genai.__version__),
-        (f"{GREEN}pillow{RESET}", PIL.__version__),
+        # 重いモジュールを読み込まないよう、パッケージのメタデータからバージョンを取る
+        (f"{GREEN}google-genai{RESET}", _package_version("google-genai")),
+        (f"{GREEN}pillow{RESET}", _package_version("pillow")),
         (f"{GREEN}user{RESET}",     f"{bot.user} ({bot.user.id})"),          # type: ignore
         (f"{GREEN}guild{RESET}",   bot.guild_id),
         (f"{GREEN}logLevel{RESET}", logging.getLevelName(logging.getLogger().level)),
         (f"{GREEN}startup{RESET}",  f"{time.perf_counter() - start_ts:.2f}s"),
     ]
+    # 起動の段階ごとの内訳
+    phases = getattr(bot, "phases", {})
+    if phases:
+        rows.append((f"{GREEN}phases{RESET}", "  ".join(f"{name} {sec:.2f}s" for name, sec in phases.items())))
     for key, val in rows:
         print(f" {key:<10} : {GREY}{val}{RESET}")
         
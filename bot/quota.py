@@ -0,0 +1,212 @@
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindow:
+    """直近 window 秒に記録された量の合計"""
+
+    __slots__ = ("window", "events", "total")
+
+    def __init__(self, window: float):
+        self.window = window
+        self.events: deque[tuple[float, int]] = deque()
+        self.total = 0
+
+    def _expire(self, now: float) -> None:
+        limit = now - self.window
+        while self.events and self.events[0][0] <= limit:
+            self.total -= self.events.popleft()[1]
+
+    def add(self, amount: int, now: float) -> None:
+        self._expire(now)
+        self.events.append((now, amount))
+        self.total += amount
+
+    def sum(self, now: float) -> int:
+        self._expire(now)
+        return self.total
+
+    def reset_in(self, now: float, excess: int) -> float:
+        """合計が excess だけ減るまでの秒数"""
+        self._expire(now)
+        released = 0
+        for ts, amount in self.events:
+            released += amount
+            if released >= excess:
+                return max(0.0, ts + self.window - now)
+        return self.window
+
+
+class QuotaExceeded(Exception):
+    """利用上限に達した。message はそのままユーザーに表示する"""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class QuotaStats:
+    admitted: int = 0
+    rejected: int = 0
+    shed: int = 0
+    downgraded: int = 0
+
+
+class _Usage:
+    __slots__ = ("requests", "tokens", "inflight")
+
+    def __init__(self, window: float):
+        self.requests = SlidingWindow(window)
+        self.tokens = SlidingWindow(window)
+        self.inflight = 0
+
+
+class Admission:
+    """admit で受け付けたリクエスト。終わったら release する (with 文でも使える)"""
+
+    __slots__ = ("quota", "user_id", "downgrade", "_released")
+
+    def __init__(self, quota: "Quota", user_id: Hashable, downgrade: bool):
+        self.quota = quota
+        self.user_id = user_id
+        # True ならフォールバックモデルで応答する
+        self.downgrade = downgrade
+        self._released = False
+
+    def record(self, input_token: int | None, output_token: int | None) -> None:
+        self.quota.record(self.user_id, (input_token or 0) + (output_token or 0))
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.quota._release(self.user_id)
+
+    def __enter__(self) -> "Admission":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class Quota:
+    """ユーザーごと・全体のリクエスト数とトークン数を直近 window 秒で数え、上限を超えたリクエストを断る
+
+    判定はメモリ上の数値の比較だけなので、添付ファイルのダウンロードやモデルの呼び出しの前に行う。
+    同時に処理中のリクエストが max_inflight (ユーザーごとは max_inflight_per_user) を超えたら、
+    待たせずにすぐ断る。ユーザーのトークン数が上限の downgrade_ratio を超えたら、軽いモデルに切り替える。
+    上限が 0 の項目は制限しない。
+    """
+
+    def __init__(
+            self,
+            *,
+            window: float,
+            user_tokens: int = 0,
+            user_requests: int = 0,
+            global_tokens: int = 0,
+            global_requests: int = 0,
+            max_inflight: int = 0,
+            max_inflight_per_user: int = 0,
+            downgrade_ratio: float = 0.0,
+            clock: Callable[[], float] = time.monotonic,
+            ):
+        self.window = window
+        self.user_tokens = user_tokens
+        self.user_requests = user_requests
+        self.global_tokens = global_tokens
+        self.global_requests = global_requests
+        self.max_inflight = max_inflight
+        self.max_inflight_per_user = max_inflight_per_user
+        self.downgrade_ratio = downgrade_ratio
+        self.stats = QuotaStats()
+        self._clock = clock
+        self._global = _Usage(window)
+        self._users: dict[Hashable, _Usage] = {}
+        self._pruned = clock()
+
+    @property
+    def inflight(self) -> int:
+        return self._global.inflight
+
+    def _user(self, user_id: Hashable) -> _Usage:
+        usage = self._users.get(user_id)
+        if usage is None:
+            usage = self._users[user_id] = _Usage(self.window)
+        return usage
+
+    def admit(self, user_id: Hashable, cost: int = 1) -> Admission:
+        """リクエストを受け付けるか判定する。断る場合は QuotaExceeded を送出する
+
+        cost は画像生成など重いリクエストの重み (リクエスト数として数える)。
+        """
+        now = self._clock()
+        if now - self._pruned > self.window:
+            self._prune(now)
+        user = self._user(user_id)
+        if self.max_inflight and self._global.inflight >= self.max_inflight:
+            self.stats.shed += 1
+            raise QuotaExceeded("現在混み合っています。しばらくしてからもう一度お試しください")
+        if self.max_inflight_per_user and user.inflight >= self.max_inflight_per_user:
+            self.stats.rejected += 1
+            raise QuotaExceeded("前のリクエストの処理中です。完了してからもう一度お試しください")
+        self._check(user.requests, self.user_requests, cost, now, "リクエスト数")
+        self._check(user.tokens, self.user_tokens, 1, now, "トークン数")
+        self._check(self._global.requests, self.global_requests, cost, now, "Bot全体のリクエスト数", shared=True)
+        self._check(self._global.tokens, self.global_tokens, 1, now, "Bot全体のトークン数", shared=True)
+
+        user.requests.add(cost, now)
+        self._global.requests.add(cost, now)
+        user.inflight += 1
+        self._global.inflight += 1
+        self.stats.admitted += 1
+        downgrade = bool(self.user_tokens and self.downgrade_ratio
+                         and user.tokens.sum(now) >= self.user_tokens * self.downgrade_ratio)
+        if downgrade:
+            self.stats.downgraded += 1
+        return Admission(self, user_id, downgrade)
+
+    def _check(self, window: SlidingWindow, limit: int, cost: int, now: float, name: str, shared: bool = False) -> None:
+        if not limit:
+            return
+        used = window.sum(now)
+        if used + cost <= limit:
+            return
+        retry_after = window.reset_in(now, used + cost - limit)
+        if shared:
+            self.stats.shed += 1
+        else:
+            self.stats.rejected += 1
+        raise QuotaExceeded(f"{name}の上限に達しました。約{max(1, round(retry_after / 60))}分後にもう一度お試しください", retry_after)
+
+    def record(self, user_id: Hashable, tokens: int) -> None:
+        """応答のトークン数を記録する"""
+        if tokens <= 0:
+            return
+        now = self._clock()
+        self._user(user_id).tokens.add(tokens, now)
+        self._global.tokens.add(tokens, now)
+
+    def _release(self, user_id: Hashable) -> None:
+        self._global.inflight -= 1
+        user = self._users.get(user_id)
+        if user is not None:
+            user.inflight -= 1
+
+    def _prune(self, now: float) -> None:
+        # 処理中のリクエストがなく、記録がすべて窓から外れたユーザーを捨てる
+        self._pruned = now
+        for user_id in [k for k, u in self._users.items() if u.inflight == 0 and not u.requests.sum(now) and not u.tokens.sum(now)]:
+            del self._users[user_id]
+
+    def usage(self, user_id: Hashable) -> dict[str, int]:
+        now = self._clock()
+        user = self._users.get(user_id)
+        if user is None:
+            return {"requests": 0, "tokens": 0, "inflight": 0}
+        return {"requests": user.requests.sum(now), "tokens": user.tokens.sum(now), "inflight": user.inflight}
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterator, TypeVar
+from google.genai import errors
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 時間を置けば成功しうるエラー
+RETRYABLE_CODES = {429, 500, 503, 504}
+
+
+def retry_after(e: errors.APIError) -> float | None:
+    """エラーに含まれる再試行までの待ち時間 (Retry-After ヘッダ / RetryInfo) を秒で返す"""
+    headers = getattr(e.response, "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    details = e.details.get("error", e.details) if isinstance(e.details, dict) else {}
+    for detail in details.get("details", None) or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+            match = re.fullmatch(r"([0-9.]+)s", str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+class CircuitBreaker:
+    """連続して失敗したモデルへの送信を止めるサーキットブレーカー
+
+    threshold 回続けて失敗すると open になり、cooldown 秒後に half_open で1件だけ試す。
+    試行が成功すれば closed に戻り、失敗すればまた open になる。
+    結果が判断できない試行 (取り消し・リクエスト自体の誤り) なら、次のリクエストでもう一度試す。
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold: int, cooldown: float, clock: Callable[[], float] = time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._clock = clock
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self._clock() - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> bool:
+        """失敗を記録し、これで open になったら True を返す"""
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+            return True
+        return False
+
+    def release(self) -> None:
+        """成功とも失敗とも言えない結果で試行を終える"""
+        self._probing = False
+
+
+@dataclass
+class ResilienceStats:
+    retries: int = 0
+    fallbacks: int = 0
+    breaker_opens: int = 0
+    failures: int = 0
+
+
+class Resilience:
+    """Gemini 呼び出しの再試行とフォールバック
+
+    429/5xx はジッター付きの指数バックオフ (Retry-After があればそれに従う) で再試行する。
+    モデルごとのサーキットブレーカーが open の間は、フォールバックモデルに切り替える。
+    """
+
+    def __init__(self, *, max_attempts: int, base_delay: float, max_delay: float, threshold: int, cooldown: float):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.stats = ResilienceStats()
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.threshold, self.cooldown)
+        return self.breakers[model]
+
+    def choose_model(self, primary: str, fallback: str | None) -> str:
+        if not fallback or self._breaker(primary).allow():
+            return primary
+        self.stats.fallbacks += 1
+        return fallback
+
+    def record_success(self, model: str) -> None:
+        if model in self.breakers:
+            self.breakers[model].record_success()
+
+    def record_failure(self, model: str, e: BaseException) -> None:
+        if isinstance(e, Exception):
+            self.stats.failures += 1
+        if isinstance(e, errors.APIError) and e.code in RETRYABLE_CODES:
+            if self._breaker(model).record_failure():
+                self.stats.breaker_opens += 1
+                logger.warning(f"Circuit breaker opened for {model} after {e.code}")
+        elif model in self.breakers:
+            # 400 やタイムアウト、取り消しではモデルの状態が分からないので、half_open の試行だけ終わらせる
+            self.breakers[model].release()
+
+    @contextmanager
+    def attempt(self, model: str) -> Iterator[None]:
+        """model への1回の呼び出しを囲み、どのように終わっても結果をブレーカーに記録する"""
+        error: BaseException | None = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if error is None:
+                self.record_success(model)
+            else:
+                self.record_failure(model, error)
+
+    def backoff(self, e: Exception, attempt: int) -> float | None:
+        """attempt 回目 (0始まり) の失敗後に待つ秒数。再試行しない場合は None"""
+        if not isinstance(e, errors.APIError) or e.code not in RETRYABLE_CODES:
+            return None
+        if attempt + 1 >= self.max_attempts:
+            return None
+        hint = retry_after(e)
+        if hint is not None:
+            delay = min(hint, self.max_delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        self.stats.retries += 1
+        logger.info(f"Retrying after {e.code} in {delay:.2f}s (attempt {attempt + 1}/{self.max_attempts})")
+        return delay
+
+    async def call(self, primary: str, fallback: str | None, fn: Callable[[str], Awaitable[T]]) -> T:
+        """fn(model) を再試行・フォールバック付きで呼び出す"""
+        attempt = 0
+        while True:
+            model = self.choose_model(primary, fallback)
+            try:
+                with self.attempt(model):
+                    return await fn(model)
+            except Exception as e:
+                delay = self.backoff(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
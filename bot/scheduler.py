@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Hashable
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """1分あたり rate 回まで、最大 burst 回まで溜められるトークンバケット"""
+
+    def __init__(self, rate_per_minute: float, burst: float | None = None, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, rate_per_minute / 6)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """取得できれば 0 を、できなければ次のトークンまでの秒数を返す"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Lane:
+    def __init__(self, name: str, concurrency: int, rate_per_minute: float):
+        self.name = name
+        # 0 以下は同時実行数を制限しない
+        self.concurrency = concurrency if concurrency > 0 else float("inf")
+        self.bucket = TokenBucket(rate_per_minute)
+        # ユーザーごとの待ち行列。先頭のユーザーから1件ずつ取り出して末尾に回す
+        self.queues: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+        self.active = 0
+        self.timer: asyncio.TimerHandle | None = None
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+
+class Scheduler:
+    """Gemini 呼び出しの同時実行数・レートを制限する非同期スケジューラ
+
+    レーン (テキスト/画像など) ごとに同時実行数の上限 (0 で無制限) とトークンバケットを持ち、
+    待ち行列はユーザー単位のラウンドロビンで取り出すため、一人の連投が他のユーザーを待たせない。
+    """
+
+    def __init__(self, lanes: dict[str, tuple[int, float]]):
+        self._lanes = {name: _Lane(name, concurrency, rpm) for name, (concurrency, rpm) in lanes.items()}
+
+    @asynccontextmanager
+    async def slot(self, lane_name: str, user_id: Hashable = None) -> AsyncIterator[float]:
+        """実行枠を確保する。待った秒数を返す"""
+        lane = self._lanes[lane_name]
+        fut = asyncio.get_running_loop().create_future()
+        lane.queues.setdefault(user_id, deque()).append(fut)
+        enqueued = time.monotonic()
+        self._dispatch(lane)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(lane)
+            else:
+                self._discard(lane, user_id, fut)
+            raise
+        wait = time.monotonic() - enqueued
+        lane.granted += 1
+        lane.total_wait += wait
+        lane.max_wait = max(lane.max_wait, wait)
+        metrics.QUEUE_WAIT.observe(wait, lane_name)
+        if wait >= 1.0:
+            logger.info(f"{lane_name}: waited {wait:.2f}s in queue (depth: {lane.depth}, active: {lane.active})")
+        try:
+            yield wait
+        finally:
+            self._release(lane)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            name: {
+                "active": lane.active,
+                "queued": lane.depth,
+                "granted": lane.granted,
+                "avg_wait": lane.total_wait / lane.granted if lane.granted else 0.0,
+                "max_wait": lane.max_wait,
+            }
+            for name, lane in self._lanes.items()
+        }
+
+    def _release(self, lane: _Lane) -> None:
+        lane.active -= 1
+        self._dispatch(lane)
+
+    def _discard(self, lane: _Lane, user_id: Hashable, fut: asyncio.Future) -> None:
+        queue = lane.queues.get(user_id)
+        if queue is not None and fut in queue:
+            queue.remove(fut)
+            if not queue:
+                del lane.queues[user_id]
+
+    def _on_timer(self, lane: _Lane) -> None:
+        lane.timer = None
+        self._dispatch(lane)
+
+    def _dispatch(self, lane: _Lane) -> None:
+        while lane.queues and lane.active < lane.concurrency:
+            user_id, queue = next(iter(lane.queues.items()))
+            if queue[0].done():
+                # 取り出す前にキャンセルされたもの
+                queue.popleft()
+                if not queue:
+                    del lane.queues[user_id]
+                continue
+            delay = lane.bucket.try_acquire()
+            if delay > 0:
+                # レート上限に達したら、トークンが溜まる頃にもう一度取り出す
+                if lane.timer is None:
+                    lane.timer = asyncio.get_running_loop().call_later(delay, self._on_timer, lane)
+                return
+            fut = queue.popleft()
+            if queue:
+                lane.queues.move_to_end(user_id)
+            else:
+                del lane.queues[user_id]
+            lane.active += 1
+            fut.set_result(None)
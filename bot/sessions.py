@@ -0,0 +1,130 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+@dataclass
+class SessionStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+
+class _Entry(Generic[V]):
+    __slots__ = ("value", "size", "expires_at")
+
+    def __init__(self, value: V, size: int, expires_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+class SessionStore(Generic[K, V]):
+    """件数・メモリ量・TTL で上限を設けた LRU セッションストア
+
+    - max_sessions: 保持するセッション数の上限
+    - max_bytes: sizeof で見積もった合計サイズの上限
+    - ttl: 最終アクセスからの有効期限 (秒)
+
+    値どうしがデータを共有する場合は、sizeof に登録で増えるバイト数を、
+    release に取り除いたときに減るバイト数を返す関数を渡す。
+    """
+
+    def __init__(
+            self,
+            *,
+            max_sessions: int,
+            max_bytes: int,
+            ttl: float,
+            sizeof: Callable[[V], int],
+            release: Optional[Callable[[V], int]] = None,
+            clock: Callable[[], float] = time.monotonic,
+            ):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = SessionStats()
+        self._sizeof = sizeof
+        self._release = release
+        self._clock = clock
+        self._entries: OrderedDict[K, _Entry[V]] = OrderedDict()
+        self._total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.expires_at > self._clock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._entries.get(key)
+        now = self._clock()
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        if entry.expires_at <= now:
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        entry.expires_at = now + self.ttl
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry.value
+
+    def put(self, key: K, value: V) -> None:
+        """値を登録 (既存なら更新) し、上限を超えた分を古い順に追い出す"""
+        if key in self._entries:
+            self._remove(key)
+        size = self._sizeof(value)
+        self._entries[key] = _Entry(value, size, self._clock() + self.ttl)
+        self._total_bytes += size
+        self._expire()
+        self._evict(keep=key)
+
+    def items(self) -> list[tuple[K, V, float]]:
+        """期限内のセッションを (キー, 値, 残りの秒数) で返す (古い順)"""
+        now = self._clock()
+        return [(key, entry.value, entry.expires_at - now) for key, entry in self._entries.items() if entry.expires_at > now]
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        if key not in self._entries:
+            return default
+        return self._remove(key).value
+
+    def _remove(self, key: K) -> _Entry[V]:
+        entry = self._entries.pop(key)
+        self._total_bytes -= self._release(entry.value) if self._release is not None else entry.size
+        return entry
+
+    def _expire(self) -> None:
+        # アクセス順に並んでいるため、先頭から期限切れを取り除けばよい
+        now = self._clock()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            self._remove(key)
+            self.stats.expirations += 1
+
+    def _evict(self, keep: K) -> None:
+        while (len(self._entries) > self.max_sessions or self._total_bytes > self.max_bytes) and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            self._remove(key)
+            self.stats.evictions += 1
+            logger.debug(f"Evicted session {key} (sessions: {len(self._entries)}, bytes: {self._total_bytes})")
@@ -0,0 +1,463 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import ssl
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Protocol
+from urllib.parse import unquote, urlparse
+from google.genai import types
+from .myutils import compress_history, decompress_history
+
+logger = logging.getLogger(__name__)
+
+
+class _SQLiteStore:
+    """専用のワーカースレッドで読み書きする SQLite ストアの共通部分
+
+    書き込みは投げっぱなしで、flush() で未完了の書き込みを待てる。
+    """
+    SCHEMA = ""
+
+    def __init__(self, path: str, thread_name_prefix: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name_prefix)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: set[Future] = set()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # ワーカースレッド内でのみ呼ばれる
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(self.SCHEMA)
+            self._prune()
+        return self._conn
+
+    def _prune(self) -> None:
+        pass
+
+    def _submit(self, fn, *args) -> None:
+        future = self._executor.submit(fn, *args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        if future.exception() is not None:
+            logger.error(f"{type(self).__name__} write failed: {future.exception()!r}")
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def flush(self) -> None:
+        """予約済みの書き込みがすべて終わるまで待つ"""
+        with self._lock:
+            pending = [asyncio.wrap_future(f) for f in self._pending]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class SessionDB(_SQLiteStore):
+    """会話履歴を zlib 圧縮して SQLite に保存するストア
+
+    読み書きはすべて専用のワーカースレッドで行い、イベントループをブロックしない。
+    """
+    PRUNE_EVERY = 100
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        "id INTEGER PRIMARY KEY, history BLOB NOT NULL, updated_at REAL NOT NULL)"
+    )
+
+    def __init__(self, path: str, ttl: float):
+        super().__init__(path, "session-db")
+        self.ttl = ttl
+        self._writes = 0
+
+    def _prune(self) -> None:
+        assert self._conn is not None
+        with self._conn:
+            cur = self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+        if cur.rowcount:
+            logger.info(f"Pruned {cur.rowcount} expired sessions from {self.path}")
+
+    def _save(self, id: int, history: list[types.Content]) -> None:
+        data = compress_history([content.model_dump(mode="json", exclude_none=True) for content in history])
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, history, updated_at) VALUES (?, ?, ?)",
+                (id, data, time.time()),
+            )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._prune()
+
+    def _load(self, id: int) -> Optional[list[types.Content]]:
+        row = self._connect().execute(
+            "SELECT history, updated_at FROM sessions WHERE id = ?", (id,)
+        ).fetchone()
+        if row is None or row[1] < time.time() - self.ttl:
+            return None
+        return [types.Content.model_validate(content) for content in decompress_history(row[0])]
+
+    def _delete(self, id: int) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (id,))
+
+    def save(self, id: int, history: list[types.Content]) -> None:
+        """履歴の保存を予約する (完了を待たない)"""
+        self._submit(self._save, id, history)
+
+    def delete(self, id: int) -> None:
+        self._submit(self._delete, id)
+
+    async def load(self, id: int) -> Optional[list[types.Content]]:
+        return await self._run(self._load, id)
+
+
+class KeyValueClient(Protocol):
+    async def get(self, key: str) -> Optional[bytes]: ...
+    async def set(self, key: str, value: bytes, ttl: float) -> None: ...
+    async def delete(self, key: str) -> None: ...
+    async def close(self) -> None: ...
+
+
+class RedisClient:
+    """GET / SET / DEL だけを使う最小限の Redis (RESP2) クライアント
+
+    接続は1本で、コマンドは順番に送る。切断されていたら次のコマンドで繋ぎ直す。
+    redis:// と rediss:// (TLS) の URL に対応し、パスワードと DB 番号も URL から読む。
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", "rediss"):
+            raise ValueError(f"unsupported redis url: {url}")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.ssl = ssl.create_default_context() if parsed.scheme == "rediss" else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout
+        )
+        try:
+            if self.password is not None:
+                await self._send(*(["AUTH", self.username] if self.username else ["AUTH"]), self.password)
+            if self.db:
+                await self._send("SELECT", str(self.db))
+        except BaseException:
+            # 認証・DB の選択に失敗した接続は使い回さない
+            self._drop()
+            raise
+
+    async def _send(self, *args: str | bytes):
+        assert self._reader is not None and self._writer is not None
+        out = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8") if isinstance(arg, str) else arg
+            out += [f"${len(data)}\r\n".encode(), data, b"\r\n"]
+        self._writer.write(b"".join(out))
+        await self._writer.drain()
+        return await asyncio.wait_for(self._read(), self.timeout)
+
+    async def _read(self):
+        assert self._reader is not None
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise RuntimeError(rest.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = await self._reader.readexactly(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [await self._read() for _ in range(size)]
+        raise ConnectionError(f"unexpected redis reply: {line!r}")
+
+    async def command(self, *args: str | bytes):
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._send(*args)
+                except RuntimeError:
+                    # エラー応答は読み終えているので、接続はそのまま使える
+                    raise
+                except (ConnectionError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    # 途中で切れた接続は使い回さず、1回だけ繋ぎ直す
+                    self._drop()
+                    if attempt:
+                        raise
+                except BaseException:
+                    # 応答を読み終える前に中断されたら、以降の応答がずれるので接続を捨てる
+                    self._drop()
+                    raise
+
+    def _drop(self) -> None:
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.command("GET", key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.command("SET", key, value, "PX", str(max(1, int(ttl * 1000))))
+
+    async def delete(self, key: str) -> None:
+        await self.command("DEL", key)
+
+    async def close(self) -> None:
+        async with self._lock:
+            self._drop()
+
+
+class MemoryKV:
+    """RedisClient と同じインターフェースを持つプロセス内の代役 (開発・ベンチマーク用)"""
+
+    def __init__(self, clock=time.monotonic):
+        self._data: dict[str, tuple[bytes, float]] = {}
+        self._clock = clock
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= self._clock():
+            del self._data[key]
+            return None
+        return item[0]
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._data[key] = (value, self._clock() + ttl)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def close(self) -> None:
+        pass
+
+
+class KVSessionStore:
+    """会話履歴を Redis 互換のキーバリューストアに保存する、SessionDB と同じ使い方のストア
+
+    複数のプロセスから同じストアを使えば、どのプロセスでも返信ボタンの会話を読み込める。
+    セッションは作成後に書き換えないため、各プロセスのメモリ上のコピーが古くなることはない。
+    期限切れはストア側の TTL に任せる。
+    """
+
+    def __init__(self, client: KeyValueClient, ttl: float, prefix: str = "session:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._pending: set[asyncio.Task] = set()
+
+    def _submit(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{type(self).__name__} write failed: {task.exception()!r}")
+
+    async def _save(self, id: int, history: list[types.Content]) -> None:
+        data = await asyncio.to_thread(
+            lambda: compress_history([content.model_dump(mode="json", exclude_none=True) for content in history])
+        )
+        await self.client.set(f"{self.prefix}{id}", data, self.ttl)
+
+    def save(self, id: int, history: list[types.Content]) -> None:
+        """履歴の保存を予約する (完了を待たない)"""
+        self._submit(self._save(id, history))
+
+    def delete(self, id: int) -> None:
+        self._submit(self.client.delete(f"{self.prefix}{id}"))
+
+    async def load(self, id: int) -> Optional[list[types.Content]]:
+        data = await self.client.get(f"{self.prefix}{id}")
+        if data is None:
+            return None
+        return await asyncio.to_thread(
+            lambda: [types.Content.model_validate(content) for content in decompress_history(data)]
+        )
+
+    async def flush(self) -> None:
+        """予約済みの書き込みがすべて終わるまで待つ"""
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    def close(self) -> None:
+        pass
+
+
+def open_session_store(backend: str, *, path: str, url: str, ttl: float) -> SessionDB | KVSessionStore:
+    """SESSION_BACKEND に応じたセッションの保存先を作る"""
+    if backend == "sqlite":
+        return SessionDB(path, ttl)
+    if backend == "redis":
+        return KVSessionStore(RedisClient(url), ttl)
+    if backend == "memory":
+        return KVSessionStore(MemoryKV(), ttl)
+    raise ValueError(f"unknown SESSION_BACKEND: {backend}")
+
+
+class SessionSnapshot:
+    """終了時にメモリ上のセッションを書き出し、次の起動後に必要になったものだけ読み込むファイル
+
+    セッションごとに zlib 圧縮した履歴を並べ、先頭に (ID, 有効期限, 位置, 長さ) の索引を置く。
+    起動時には何もせず、最初に見つからなかったセッションを探すときに索引だけを読む。
+    """
+    MAGIC = b"CAB-SNAPSHOT 1\n"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index: Optional[dict[int, tuple[float, int, int]]] = None
+        self._lock = asyncio.Lock()
+
+    def write(self, sessions: list[tuple[int, list[types.Content], float]]) -> int:
+        """(ID, 履歴, 有効期限の UNIX 時刻) を書き出し、書いたセッション数を返す"""
+        blobs = [
+            (id, expires_at, compress_history([content.model_dump(mode="json", exclude_none=True) for content in history]))
+            for id, history, expires_at in sessions
+        ]
+        # 前回のスナップショットにあって今回は読み込まれなかったセッションも、期限内なら引き継ぐ
+        written = {id for id, _, _ in sessions}
+        carried = [(id, entry) for id, entry in self._read_index().items() if id not in written]
+        if carried:
+            with open(self.path, "rb") as f:
+                for id, (expires_at, offset, length) in carried:
+                    f.seek(offset)
+                    blobs.append((id, expires_at, f.read(length)))
+        index, offset = {}, 0
+        for id, expires_at, blob in blobs:
+            index[str(id)] = [expires_at, offset, len(blob)]
+            offset += len(blob)
+        header = json.dumps(index).encode("utf-8")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(f"{len(header)}\n".encode())
+            f.write(header)
+            for _, _, blob in blobs:
+                f.write(blob)
+        os.replace(tmp, self.path)
+        return len(blobs)
+
+    def _read_index(self) -> dict[int, tuple[float, int, int]]:
+        try:
+            with open(self.path, "rb") as f:
+                if f.readline() != self.MAGIC:
+                    return {}
+                size = int(f.readline())
+                index = json.loads(f.read(size))
+                base = f.tell()
+        except (FileNotFoundError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f"Ignored a broken session snapshot {self.path}: {e!r}")
+            return {}
+        now = time.time()
+        return {int(id): (expires_at, base + offset, length) for id, (expires_at, offset, length) in index.items() if expires_at > now}
+
+    def _read(self, offset: int, length: int) -> list[types.Content]:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return [types.Content.model_validate(content) for content in decompress_history(data)]
+
+    async def load(self, id: int) -> Optional[list[types.Content]]:
+        if self._index is None:
+            async with self._lock:
+                if self._index is None:
+                    self._index = await asyncio.to_thread(self._read_index)
+                    if self._index:
+                        logger.info(f"Loaded session snapshot index ({len(self._index)} sessions)")
+        entry = self._index.get(id)
+        if entry is None or entry[0] <= time.time():
+            return None
+        try:
+            return await asyncio.to_thread(self._read, entry[1], entry[2])
+        except Exception as e:
+            logger.warning(f"Failed to read session {id} from snapshot: {e!r}")
+            return None
+
+
+class FileIndexDB(_SQLiteStore):
+    """アップロード済みファイルの内容ハッシュ → Files API の URI の対応表"""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS files ("
+        "hash TEXT PRIMARY KEY, name TEXT NOT NULL, uri TEXT NOT NULL, mime_type TEXT NOT NULL, expires_at REAL NOT NULL)"
+    )
+
+    def __init__(self, path: str):
+        super().__init__(path, "file-index")
+
+    def _prune(self) -> None:
+        assert self._conn is not None
+        with self._conn:
+            self._conn.execute("DELETE FROM files WHERE expires_at < ?", (time.time(),))
+
+    def _get(self, hash: str) -> Optional[tuple[str, str, str, float]]:
+        return self._connect().execute(
+            "SELECT name, uri, mime_type, expires_at FROM files WHERE hash = ?", (hash,)
+        ).fetchone()
+
+    def _put(self, hash: str, name: str, uri: str, mime_type: str, expires_at: float) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files (hash, name, uri, mime_type, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (hash, name, uri, mime_type, expires_at),
+            )
+
+    def _delete(self, hash: str) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM files WHERE hash = ?", (hash,))
+
+    async def get(self, hash: str) -> Optional[tuple[str, str, str, float]]:
+        """(name, uri, mime_type, expires_at) を返す"""
+        return await self._run(self._get, hash)
+
+    def put(self, hash: str, name: str, uri: str, mime_type: str, expires_at: float) -> None:
+        self._submit(self._put, hash, name, uri, mime_type, expires_at)
+
+    def delete(self, hash: str) -> None:
+        self._submit(self._delete, hash)
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import logging
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable
+from google import genai
+from google.genai import types
+from .storage import FileIndexDB
+from .conversation import record_file_size
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class UploadStats:
+    uploads: int = 0
+    reused: int = 0
+    failures: int = 0
+    bytes_uploaded: int = 0
+
+
+class FileUploader:
+    """大きなメディアを Files API に一度だけアップロードし、URI で参照する
+
+    threshold バイト以上のファイルが対象。内容のハッシュ → URI の対応を FileIndexDB に保存し、
+    同じファイルが再び投稿されたときや以降のターンではアップロードし直さない。
+    有効期限までの残りが min_remaining 秒を切ったものは使わない (会話の途中で切れないように)。
+    アップロードに失敗したらインラインのまま送る。
+    """
+
+    def __init__(
+            self,
+            client: Callable[[], genai.Client],
+            index: FileIndexDB,
+            *,
+            threshold: int,
+            min_remaining: float,
+            processing_timeout: float = 120.0,
+            poll_interval: float = 1.0,
+            clock: Callable[[], float] = time.time,
+            ):
+        self._client = client
+        self.index = index
+        self.threshold = threshold
+        self.min_remaining = min_remaining
+        self.processing_timeout = processing_timeout
+        self.poll_interval = poll_interval
+        self.stats = UploadStats()
+        self._clock = clock
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    async def resolve(self, part: dict) -> dict:
+        """{"file_data": ...} のパートが大きければ {"file_uri": ...} に置き換える"""
+        file_data = part.get("file_data")
+        if not self.enabled or file_data is None or len(file_data["data"]) < self.threshold:
+            return part
+        data, mime_type = file_data["data"], file_data["mime_type"]
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        key = f"{mime_type}:{digest}"
+        try:
+            uri = await self._get_or_upload(key, data, mime_type)
+        except Exception as e:
+            self.stats.failures += 1
+            logger.warning(f"Failed to upload {mime_type} ({len(data)} bytes), sending inline. {e!r}")
+            return part
+        # URI のパートからトークン数を見積もれるように大きさを覚えておく
+        record_file_size(uri, len(data))
+        return {"file_uri": {"mime_type": mime_type, "uri": uri}}
+
+    async def _get_or_upload(self, key: str, data: bytes, mime_type: str) -> str:
+        row = await self.index.get(key)
+        if row is not None and row[3] - self._clock() > self.min_remaining:
+            self.stats.reused += 1
+            return row[1]
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # 同じファイルをアップロード中なら、その結果を使う
+            uri = await asyncio.shield(fut)
+            if uri is None:
+                raise RuntimeError("concurrent upload failed")
+            return uri
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        file = None
+        try:
+            file = await self._upload(data, mime_type)
+        finally:
+            del self._inflight[key]
+            fut.set_result(file.uri if file is not None else None)
+        expires_at = file.expiration_time.timestamp() if file.expiration_time else self._clock() + 47 * 3600
+        self.index.put(key, file.name, file.uri, mime_type, expires_at) # type: ignore
+        return file.uri # type: ignore
+
+    async def _upload(self, data: bytes, mime_type: str) -> types.File:
+        started = time.perf_counter()
+        client = self._client()
+        file = await client.aio.files.upload(file=BytesIO(data), config=types.UploadFileConfig(mime_type=mime_type))
+        # 音声・動画は処理が終わるまで使えない
+        deadline = time.monotonic() + self.processing_timeout
+        while file.state == types.FileState.PROCESSING:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{file.name} is still processing")
+            await asyncio.sleep(self.poll_interval)
+            file = await client.aio.files.get(name=file.name) # type: ignore
+        if file.state == types.FileState.FAILED:
+            raise RuntimeError(f"{file.name} failed to process: {file.error}")
+        self.stats.uploads += 1
+        self.stats.bytes_uploaded += len(data)
+        logger.info(f"Uploaded {mime_type} ({len(data)} bytes) as {file.name} in {time.perf_counter() - started:.2f}s")
+        return file
@@ -1,15 +1,24 @@
 import argparse
+import atexit
+import json
 import logging
+import queue
+import subprocess
+import sys
 import bot
-from typing import Literal, Optional
-
-_FormatStyle = Literal["%", "{", "$"]
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+from bot.config import Config
 
 class ColorLogFormatter(logging.Formatter):
+    """ログレベルに応じてコンソール出力に色を付けるFormatter
+
+    装飾済みのレベル名を事前に作っておき、record を書き換えずに1回の文字列組み立てで出力する。
+    """
     BOLD = "\x1b[1m"
     GREY = "\x1b[38;2;150;150;150m"
     PURPLE = "\x1b[38;2;170;120;255m"
-    """ログレベルに応じてコンソール出力に色を付けるFormatter"""
     LOG_COLORS = {
         logging.DEBUG: "\x1b[38;2;100;150;255m",  # Blue
         logging.INFO: "\x1b[38;2;0;255;150m",  # Green
@@ -19,54 +28,108 @@ class ColorLogFormatter(logging.Formatter):
     }
     RESET = "\x1b[0m"
 
-    def __init__(self, fmt: Optional[str] = "%(asctime)s %(levelname)-8s %(name)s: %(message)s", datefmt: Optional[str] = None, style: _FormatStyle = '%'):
-        super().__init__(fmt=fmt, datefmt=datefmt, style=style)
+    def __init__(self, datefmt: Optional[str] = None):
+        super().__init__(datefmt=datefmt)
+        self._levels = {
+            levelno: f"{self.BOLD}{color}{logging.getLevelName(levelno):<8}{self.RESET}"
+            for levelno, color in self.LOG_COLORS.items()
+        }
 
     def format(self, record: logging.LogRecord) -> str:
-        # 副作用を避けるため、元の値を保持
-        original_levelname = record.levelname
-        original_name = record.name
-
-        # 1. levelnameを装飾 (太字 + レベル色)
-        log_color = self.LOG_COLORS.get(record.levelno, "")
-        record.levelname = f"{self.BOLD}{log_color}{original_levelname:<8}{self.RESET}"
-
-        # 2. name (ファイル名) を装飾 (紫色)
-        record.name = f"{self.PURPLE}{original_name}{self.RESET}"
-
-        # 3. super().format()で基本的なフォーマットを適用
-        formatted_message = super().format(record)
+        level = self._levels.get(record.levelno) or f"{record.levelname:<8}"
+        message = (
+            f"{self.BOLD}{self.GREY}{self.formatTime(record, self.datefmt)}{self.RESET} "
+            f"{level} {self.PURPLE}{record.name}{self.RESET}: {record.getMessage()}"
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        if record.stack_info:
+            message = f"{message}\n{self.formatStack(record.stack_info)}"
+        return message
+
+class JsonLogFormatter(logging.Formatter):
+    """1行1レコードの JSON で出力するFormatter"""
 
-        # 4. asctime部分を装飾 (グレー)
-        time_part, rest_part = formatted_message.split(record.levelname, 1)
-        decorated_time = f"{self.BOLD}{self.GREY}{time_part.strip()}{self.RESET}"
-        final_message = f"{decorated_time} {record.levelname}{rest_part}"
-
-        # 5. recordオブジェクトを元に戻す
-        record.levelname = original_levelname
-        record.name = original_name
-
-        return final_message
-
-def setup_logging(level: int) -> None:
-    """コンソール(色付き)とファイル(色なし)へ出力する root logger を構築します。"""
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+class _LogQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 引数は後から書き換えられることがあるため、ここでメッセージだけ確定させる。
+        # 整形 (例外の文字列化を含む) はリスナーのスレッドで行う
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(level: int, log_format: str = "text", use_queue: bool = True) -> None:
+    """コンソール(色付き)とファイル(色なし)へ出力する root logger を構築します。
+
+    use_queue が True の場合、ロガーを呼んだスレッドはレコードをキューに入れるだけで、
+    整形と書き込みはバックグラウンドのスレッドで行います。
+    """
     # 既存ハンドラを初期化
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
 
-    # --- ファイルハンドラ (色なし) ---
-    file_formatter = logging.Formatter("%(asctime)s %(levelname)-8s %(name)s: %(message)s")
-    file_handler = logging.FileHandler("discord.log", encoding="utf-8", mode="w")
+    # --- ファイルハンドラ (色なし、サイズでローテーション) ---
+    if log_format == "json":
+        file_formatter: logging.Formatter = JsonLogFormatter()
+    else:
+        file_formatter = logging.Formatter("%(asctime)s %(levelname)-8s %(name)s: %(message)s")
+    file_handler = RotatingFileHandler(
+        Config.LOG_FILE, encoding="utf-8", maxBytes=Config.LOG_MAX_BYTES, backupCount=Config.LOG_BACKUP_COUNT
+    )
+    if file_handler.stream.tell() > 0:
+        # 起動ごとに新しいファイルから書き始める (前回分はバックアップに残る)
+        file_handler.doRollover()
     file_handler.setFormatter(file_formatter)
     file_handler.setLevel(level)
 
     # --- コンソールハンドラ (色付き) ---
-    console_formatter = ColorLogFormatter()
+    console_formatter = JsonLogFormatter() if log_format == "json" else ColorLogFormatter()
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(console_formatter)
     stream_handler.setLevel(level)
 
-    logging.basicConfig(level=level, handlers=[file_handler, stream_handler])
+    if not use_queue:
+        logging.basicConfig(level=level, handlers=[file_handler, stream_handler])
+        return
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(level=level, handlers=[_LogQueueHandler(log_queue)])
+
+def profile_startup(top: int = 30) -> None:
+    """-X importtime で bot と Cog の読み込みを計測し、時間のかかったモジュールを表示します。"""
+    code = "import importlib, bot; [importlib.import_module(name) for name in bot.Config.COGS]"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    if result.returncode != 0 or not rows:
+        print(result.stderr)
+        return
+    total = sum(cumulative for cumulative, _, name in rows if not name[1:].startswith(" "))  # トップレベルの import だけ
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for cumulative, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1000:10.1f}ms {self_us / 1000:8.1f}ms  {name.strip()}")
+    print(f"total: {total / 1000:.1f}ms")
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="起動時のログレベルを設定")
@@ -76,10 +139,34 @@ def main() -> None:
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="ログ出力のレベル (既定: INFO)"
     )
+    parser.add_argument(
+        "--sync-commands",
+        action="store_true",
+        help="コマンドツリーが変わっていなくてもスラッシュコマンドを同期する"
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="起動せずに、モジュールの読み込み時間の内訳を表示する"
+    )
+    parser.add_argument(
+        "--log-format",
+        default="text",
+        choices=["text", "json"],
+        help="ログの形式 (既定: text)"
+    )
+    parser.add_argument(
+        "--log-sync",
+        action="store_true",
+        help="キューを使わず、ログを呼び出したスレッドで直接書き込む"
+    )
     args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup()
+        return
     level = getattr(logging, args.log_level.upper(), logging.INFO)
-    setup_logging(level)
-    bot.run(level)
+    setup_logging(level, log_format=args.log_format, use_queue=not args.log_sync)
+    bot.run(level, force_sync=args.sync_commands)
 
 if __name__ == "__main__":
     main()
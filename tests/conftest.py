@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# bot を読み込む前に、ディスクや外部サービスに触れない設定にする
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-test-"))
+os.environ.setdefault("SESSION_BACKEND", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
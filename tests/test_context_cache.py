@@ -0,0 +1,192 @@
+import asyncio
+import gc
+import weakref
+from types import SimpleNamespace
+
+from google.genai import types
+
+from bot.context_cache import ContextCache
+from bot.conversation import Branch
+
+
+class StubCaches:
+    """caches.create / update / delete の呼び出しを記録するだけの偽物"""
+
+    def __init__(self):
+        self.created: list[types.CreateCachedContentConfig] = []
+        self.updated: list[str] = []
+        self.deleted: list[str] = []
+
+    async def create(self, *, model, config):
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    async def update(self, *, name, config):
+        self.updated.append(name)
+
+    async def delete(self, *, name):
+        self.deleted.append(name)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _make(min_tokens: int = 100, ttl: float = 600, max_entries: int = 10):
+    caches = StubCaches()
+    client = SimpleNamespace(aio=SimpleNamespace(caches=caches))
+    clock = Clock()
+    cache = ContextCache(lambda: client, min_tokens=min_tokens, ttl=ttl, max_entries=max_entries, clock=clock) # type: ignore
+    return cache, caches, clock
+
+
+def _turns(n: int, chars: int = 400) -> list[types.Content]:
+    return [types.Content(role="user" if i % 2 == 0 else "model", parts=[types.Part.from_text(text="あ" * chars)]) for i in range(n)]
+
+
+async def _settle(cache: ContextCache) -> None:
+    while cache._tasks:
+        await asyncio.gather(*list(cache._tasks))
+
+
+def _create(cache: ContextCache, branch: Branch, base=None) -> None:
+    history = branch.history()
+    cache.maybe_create("m", branch.tail, base, history, [], [])
+
+
+def test_lookup_hit_and_miss():
+    async def run():
+        cache, caches, _ = _make()
+        branch = Branch().extended(_turns(4))
+        assert cache.lookup("m", branch.tail) == (None, 0)
+        _create(cache, branch)
+        await _settle(cache)
+        assert len(caches.created) == 1
+        # キャッシュしたノードより後ろに続いた枝でも、キャッシュ済みの深さまで使える
+        longer = branch.extended(_turns(2))
+        assert cache.lookup("m", longer.tail) == ("cachedContents/1", 4)
+        # 別のモデルや、キャッシュしたノードを含まない枝では使わない
+        assert cache.lookup("other", longer.tail) == (None, 0)
+        assert cache.lookup("m", Branch().extended(_turns(4)).tail) == (None, 0)
+        assert cache.stats.hits == 1
+    asyncio.run(run())
+
+
+def test_lookup_requires_same_base():
+    async def run():
+        cache, _, _ = _make()
+        branch = Branch().extended(_turns(6))
+        checkpoint = branch.tail.ancestor(2)
+        _create(cache, branch, base=None)
+        await _settle(cache)
+        # 圧縮後 (起点のチェックポイントが変わった後) は使わない
+        assert cache.lookup("m", branch.tail, checkpoint) == (None, 0)
+        assert cache.lookup("m", branch.tail, None)[0] == "cachedContents/1"
+    asyncio.run(run())
+
+
+def test_lookup_skips_expiring_and_refreshes_ttl():
+    async def run():
+        cache, caches, clock = _make(ttl=600)
+        branch = Branch().extended(_turns(4))
+        _create(cache, branch)
+        await _settle(cache)
+        # TTL の半分を過ぎたら延長する
+        clock.now += 400
+        assert cache.lookup("m", branch.tail)[0] == "cachedContents/1"
+        await _settle(cache)
+        assert caches.updated == ["cachedContents/1"]
+        # 期限まで 30 秒を切ったものは使わない
+        clock.now += 580
+        assert cache.lookup("m", branch.tail) == (None, 0)
+    asyncio.run(run())
+
+
+def test_maybe_create_below_min_tokens():
+    async def run():
+        cache, caches, _ = _make(min_tokens=10_000)
+        branch = Branch().extended(_turns(4))
+        _create(cache, branch)
+        await _settle(cache)
+        assert caches.created == []
+        # キャッシュ済みの部分は数えず、増えた部分だけで判断する
+        cache.min_tokens = 100
+        _create(cache, branch)
+        await _settle(cache)
+        cache.min_tokens = 10_000
+        _create(cache, branch.extended(_turns(2)))
+        await _settle(cache)
+        assert len(caches.created) == 1
+    asyncio.run(run())
+
+
+def test_disabled_cache_does_nothing():
+    async def run():
+        cache, caches, _ = _make(min_tokens=0)
+        branch = Branch().extended(_turns(4))
+        _create(cache, branch)
+        await _settle(cache)
+        assert caches.created == []
+        assert cache.lookup("m", branch.tail) == (None, 0)
+    asyncio.run(run())
+
+
+def test_evicted_entries_are_deleted():
+    async def run():
+        cache, caches, _ = _make(max_entries=2)
+        branches = [Branch().extended(_turns(4)) for _ in range(3)]
+        for branch in branches:
+            _create(cache, branch)
+            await _settle(cache)
+        assert caches.deleted == ["cachedContents/1"]
+        assert cache.lookup("m", branches[0].tail) == (None, 0)
+        assert cache.lookup("m", branches[2].tail)[0] == "cachedContents/3"
+    asyncio.run(run())
+
+
+def test_invalidate_drops_entry():
+    async def run():
+        cache, _, _ = _make()
+        branch = Branch().extended(_turns(4))
+        _create(cache, branch)
+        await _settle(cache)
+        cache.invalidate("cachedContents/1")
+        assert cache.lookup("m", branch.tail) == (None, 0)
+    asyncio.run(run())
+
+
+def test_entries_do_not_keep_turns_alive():
+    async def run():
+        cache, caches, _ = _make()
+        branch = Branch().extended(_turns(4))
+        root = weakref.ref(branch.tail.ancestor(1))
+        _create(cache, branch)
+        await _settle(cache)
+        del branch
+        gc.collect()
+        assert root() is None
+        # 会話が消えたキャッシュは次に使うときに取り除き、サーバー側も削除する
+        cache.lookup("m", None)
+        await _settle(cache)
+        assert caches.deleted == ["cachedContents/1"]
+        assert len(cache._entries) == 0
+    asyncio.run(run())
+
+
+def test_expired_entries_are_purged_and_deleted():
+    async def run():
+        cache, caches, clock = _make(ttl=600)
+        first = Branch().extended(_turns(4))
+        _create(cache, first)
+        await _settle(cache)
+        clock.now += 601
+        second = Branch().extended(_turns(4))
+        _create(cache, second)
+        await _settle(cache)
+        assert caches.deleted == ["cachedContents/1"]
+        assert len(cache._entries) == 1
+    asyncio.run(run())
@@ -0,0 +1,32 @@
+from google.genai import types
+
+from bot import conversation
+from bot.conversation import estimate_tokens, record_file_size
+
+
+def _turn(*parts: types.Part) -> types.Content:
+    return types.Content(role="user", parts=[types.Part.from_text(text="質問"), *parts])
+
+
+def test_files_api_image_counts_like_inline_image():
+    record_file_size("https://example.invalid/files/img", 3_000_000)
+    inline = _turn(types.Part.from_bytes(data=b"x" * 3_000_000, mime_type="image/png"))
+    uploaded = _turn(types.Part.from_uri(file_uri="https://example.invalid/files/img", mime_type="image/png"))
+    assert estimate_tokens(uploaded) == estimate_tokens(inline) == estimate_tokens(_turn()) + 258
+
+
+def test_files_api_audio_scales_with_size():
+    text_only = estimate_tokens(_turn())
+    record_file_size("https://example.invalid/files/short", 16000 * 60)
+    record_file_size("https://example.invalid/files/long", 16000 * 600)
+    short = estimate_tokens(_turn(types.Part.from_uri(file_uri="https://example.invalid/files/short", mime_type="audio/mpeg")))
+    long = estimate_tokens(_turn(types.Part.from_uri(file_uri="https://example.invalid/files/long", mime_type="audio/mpeg")))
+    # 1分の音声は 32 トークン/秒
+    assert short - text_only == 60 * 32
+    assert long - text_only == 600 * 32
+
+
+def test_unknown_files_api_size_uses_default(monkeypatch):
+    monkeypatch.setattr(conversation, "unknown_file_size", 16000 * 10)
+    turn = _turn(types.Part.from_uri(file_uri="https://example.invalid/files/restored", mime_type="audio/mpeg"))
+    assert estimate_tokens(turn) - estimate_tokens(_turn()) == 10 * 32
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from google.genai import chats, types
+
+from bot import gemini
+
+
+def _chunk(text: str, finish_reason: types.FinishReason | None = None) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(candidates=[types.Candidate(
+        content=types.Content(role="model", parts=[types.Part(text=text)]),
+        finish_reason=finish_reason,
+    )])
+
+
+class StubModels:
+    """本物の AsyncChat から呼ばれる generate_content / generate_content_stream の代わり"""
+
+    def __init__(self, chunks: list[types.GenerateContentResponse]):
+        self.chunks = chunks
+        self.requests: list[list[types.Content]] = []
+
+    async def generate_content(self, *, model, contents, config):
+        self.requests.append(contents)
+        parts = [part for chunk in self.chunks for part in chunk.candidates[0].content.parts]
+        return types.GenerateContentResponse(candidates=[types.Candidate(
+            content=types.Content(role="model", parts=parts),
+            finish_reason=self.chunks[-1].candidates[0].finish_reason,
+        )])
+
+    async def generate_content_stream(self, *, model, contents, config):
+        self.requests.append(contents)
+
+        async def stream():
+            for chunk in self.chunks:
+                yield chunk
+        return stream()
+
+
+@pytest.fixture
+def models(monkeypatch):
+    stub = StubModels([_chunk("こんにちは"), _chunk("、元気です"), _chunk("", types.FinishReason.STOP)])
+    monkeypatch.setattr(gemini, "_client", SimpleNamespace(aio=SimpleNamespace(chats=chats.AsyncChats(stub), models=stub)))
+    return stub
+
+
+async def _stream(id: int, **kwargs) -> tuple:
+    stream = gemini.generate_text_stream([{"text": "質問"}], id, **kwargs)
+    async for _ in stream:
+        pass
+    return stream.result
+
+
+def test_stream_with_empty_final_chunk_keeps_turns(models):
+    text, _, _, last_idx = asyncio.run(_stream(101, is_new_chat=True))
+    assert text == "こんにちは、元気です"
+    assert last_idx == 2
+    history = gemini.chats.get(101).history()
+    assert [c.role for c in history] == ["user", "model"]
+    assert history[1].parts[0].text == "こんにちは、元気です"
+
+
+def test_reply_after_empty_final_chunk_sends_context(models):
+    asyncio.run(_stream(102, is_new_chat=True))
+    _, _, _, last_idx = asyncio.run(_stream(103, parent_id=102, last_idx=2, is_new_chat=True))
+    assert last_idx == 4
+    assert [c.role for c in models.requests[-1]] == ["user", "model", "user"]
+
+
+def test_generate_text_with_empty_final_part_keeps_turns(models):
+    text, _, _, last_idx = asyncio.run(gemini.generate_text([{"text": "質問"}], 104, is_new_chat=True))
+    assert text == "こんにちは、元気です"
+    assert last_idx == 2
+    assert len(gemini.chats.get(104)) == 2
+
+
+def test_answer_cache_hit_skips_preprocessing(models, monkeypatch):
+    monkeypatch.setattr(gemini.answer_cache, "ttl", 60)
+    prepared = []
+    prepare_parts = gemini.prepare_parts
+
+    async def counting_prepare_parts(parts):
+        prepared.append(parts)
+        return await prepare_parts(parts)
+    monkeypatch.setattr(gemini, "prepare_parts", counting_prepare_parts)
+
+    asyncio.run(gemini.generate_text([{"text": "**alice**: 同じ質問"}], 105, is_new_chat=True))
+    text, _, _, last_idx = asyncio.run(gemini.generate_text([{"text": "**bob**: 同じ質問"}], 106, is_new_chat=True))
+    assert text == "こんにちは、元気です"
+    assert last_idx == 2
+    assert len(prepared) == 1
+    assert len(models.requests) == 1
+    # 質問のテキストは今回のユーザーのものに差し替える
+    assert gemini.chats.get(106).history()[0].parts[0].text == "**bob**: 同じ質問"
@@ -0,0 +1,28 @@
+from dataclasses import dataclass
+
+from bot.metrics import Registry
+
+
+@dataclass
+class Stats:
+    hits: int = 0
+    misses: int = 0
+
+
+def test_stats_are_rendered_as_counters():
+    registry = Registry()
+    stats = Stats()
+    registry.stats("test_events_total", "Test events", stats)
+    stats.hits += 2
+    lines = registry.render().splitlines()
+    assert "# TYPE test_events_total counter" in lines
+    assert 'test_events_total{event="hits"} 2' in lines
+    assert 'test_events_total{event="misses"} 0' in lines
+
+
+def test_gauge_with_several_labels():
+    registry = Registry()
+    registry.gauge("test_state", "State", lambda: {("m", "open"): 1, ("m", "closed"): 0}, labelnames=("model", "state"))
+    lines = registry.render().splitlines()
+    assert 'test_state{model="m",state="open"} 1' in lines
+    assert "# TYPE test_state gauge" in lines
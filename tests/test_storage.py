@@ -0,0 +1,205 @@
+import asyncio
+import time
+
+import pytest
+from google.genai import types
+
+from bot.storage import KVSessionStore, RedisClient, SessionSnapshot
+
+
+class FakeRedis:
+    """RESP2 で話すプロセス内の Redis の代役。GET / SET / DEL / AUTH / SELECT と、応答の種類を試すコマンドだけ"""
+
+    def __init__(self, password: str | None = None):
+        self.password = password
+        self.data: dict[bytes, bytes] = {}
+        self.connections = 0
+        self.commands: list[list[bytes]] = []
+        # 次に届いたコマンドに応答せずに切断する
+        self.drop_next = False
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        authed = self.password is None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                args = []
+                for _ in range(int(line[1:-2])):
+                    size = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(size + 2))[:-2])
+                self.commands.append(args)
+                if self.drop_next:
+                    self.drop_next = False
+                    return
+                name = args[0].upper()
+                if name == b"AUTH":
+                    authed = args[-1].decode() == self.password
+                    writer.write(b"+OK\r\n" if authed else b"-WRONGPASS invalid password\r\n")
+                elif not authed:
+                    writer.write(b"-NOAUTH Authentication required.\r\n")
+                elif name == b"SELECT":
+                    writer.write(b"+OK\r\n")
+                elif name == b"GET":
+                    value = self.data.get(args[1])
+                    writer.write(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value))
+                elif name == b"SET":
+                    self.data[args[1]] = args[2]
+                    writer.write(b"+OK\r\n")
+                elif name == b"DEL":
+                    writer.write(b":%d\r\n" % (self.data.pop(args[1], None) is not None))
+                elif name == b"LIST":
+                    writer.write(b"*3\r\n$1\r\na\r\n:2\r\n$-1\r\n")
+                elif name == b"NILLIST":
+                    writer.write(b"*-1\r\n")
+                elif name == b"BLOCK":
+                    # 応答しない (クライアント側で取り消される)
+                    continue
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def _with_server(test, password: str | None = None, path: str = "", client_password: str | None = None) -> None:
+    server = FakeRedis(password)
+    address = await server.start()
+    client_password = client_password or password
+    auth = f":{client_password}@" if client_password is not None else ""
+    client = RedisClient(f"redis://{auth}{address}{path}", timeout=1.0)
+    try:
+        await test(server, client)
+    finally:
+        await client.close()
+        await server.stop()
+
+
+def test_bulk_nil_integer_and_array_replies():
+    async def run(server, client):
+        assert await client.get("missing") is None
+        await client.set("k", b"\x00bytes\r\n", ttl=10)
+        assert await client.get("k") == b"\x00bytes\r\n"
+        assert await client.command("DEL", "k") == 1
+        assert await client.command("LIST") == [b"a", 2, None]
+        assert await client.command("NILLIST") is None
+        assert server.connections == 1
+        assert server.commands[1][3:] == [b"PX", b"10000"]
+    asyncio.run(_with_server(run))
+
+
+def test_error_reply_keeps_connection():
+    async def run(server, client):
+        with pytest.raises(RuntimeError, match="unknown command"):
+            await client.command("NOPE")
+        assert await client.get("missing") is None
+        assert server.connections == 1
+    asyncio.run(_with_server(run))
+
+
+def test_reconnects_once_after_disconnect():
+    async def run(server, client):
+        await client.set("k", b"v", ttl=10)
+        server.drop_next = True
+        assert await client.get("k") == b"v"
+        assert server.connections == 2
+    asyncio.run(_with_server(run))
+
+
+def test_auth_and_select():
+    async def run(server, client):
+        await client.set("k", b"v", ttl=10)
+        assert server.commands[:2] == [[b"AUTH", b"secret"], [b"SELECT", b"2"]]
+    asyncio.run(_with_server(run, password="secret", path="/2"))
+
+
+def test_failed_auth_drops_connection():
+    async def run(server, client):
+        for _ in range(2):
+            with pytest.raises(RuntimeError, match="WRONGPASS"):
+                await client.get("k")
+        # 認証に失敗した接続は使い回さず、毎回繋ぎ直して AUTH から始める
+        assert server.connections == 2
+        assert [c[0] for c in server.commands] == [b"AUTH", b"AUTH"]
+    asyncio.run(_with_server(run, password="secret", client_password="wrong"))
+
+
+def test_cancelled_command_drops_connection():
+    async def run(server, client):
+        await client.set("k", b"v", ttl=10)
+        task = asyncio.create_task(client.command("BLOCK"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # 応答を読み終えていない接続は捨てて、次のコマンドは新しい接続で送る
+        assert await client.get("k") == b"v"
+        assert server.connections == 2
+    asyncio.run(_with_server(run))
+
+
+def _history(text: str) -> list[types.Content]:
+    return [
+        types.Content(role="user", parts=[types.Part.from_text(text=text)]),
+        types.Content(role="model", parts=[types.Part.from_text(text=f"{text}への回答")]),
+    ]
+
+
+def test_kv_session_store_round_trip():
+    async def run(server, client):
+        store = KVSessionStore(client, ttl=60)
+        store.save(1, _history("質問"))
+        await store.flush()
+        assert await store.load(1) == _history("質問")
+        store.delete(1)
+        await store.flush()
+        assert await store.load(1) is None
+    asyncio.run(_with_server(run))
+
+
+def test_snapshot_write_and_load(tmp_path):
+    async def run():
+        path = str(tmp_path / "sessions.snapshot")
+        now = time.time()
+        SessionSnapshot(path).write([(1, _history("a"), now + 60), (2, _history("b"), now + 60), (3, _history("c"), now - 1)])
+        snapshot = SessionSnapshot(path)
+        assert await snapshot.load(2) == _history("b")
+        assert await snapshot.load(1) == _history("a")
+        # 期限切れと存在しないセッション
+        assert await snapshot.load(3) is None
+        assert await snapshot.load(4) is None
+    asyncio.run(run())
+
+
+def test_snapshot_carries_over_unread_sessions(tmp_path):
+    async def run():
+        path = str(tmp_path / "sessions.snapshot")
+        now = time.time()
+        SessionSnapshot(path).write([(1, _history("a"), now + 60), (2, _history("b"), now + 60)])
+        # 次の起動では 2 だけ読み込まれて更新された
+        assert SessionSnapshot(path).write([(2, _history("b2"), now + 60)]) == 2
+        snapshot = SessionSnapshot(path)
+        assert await snapshot.load(1) == _history("a")
+        assert await snapshot.load(2) == _history("b2")
+    asyncio.run(run())
+
+
+def test_snapshot_ignores_missing_or_broken_file(tmp_path):
+    async def run():
+        assert await SessionSnapshot(str(tmp_path / "missing")).load(1) is None
+        broken = tmp_path / "broken"
+        broken.write_bytes(SessionSnapshot.MAGIC + b"12\n{not json")
+        assert await SessionSnapshot(str(broken)).load(1) is None
+    asyncio.run(run())
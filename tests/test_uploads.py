@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+from google.genai import types
+
+from bot.storage import FileIndexDB
+from bot.conversation import estimate_tokens
+from bot.uploads import FileUploader
+
+NOW = 1_700_000_000.0
+
+
+class StubFiles:
+    """Files API の upload / get の代わり。get が呼ばれるたびに states の状態へ進む"""
+
+    def __init__(self, states: list[types.FileState] | None = None, expires_in: float = 48 * 3600):
+        self.states = states or [types.FileState.ACTIVE]
+        self.expires_in = expires_in
+        self.uploads: list[bytes] = []
+        self.gets = 0
+
+    def _file(self, n: int, state: types.FileState) -> types.File:
+        return types.File(
+            name=f"files/{n}",
+            uri=f"https://example.invalid/files/{n}",
+            state=state,
+            expiration_time=datetime.datetime.fromtimestamp(NOW + self.expires_in, datetime.timezone.utc),
+            error=types.FileStatus(message="bad media") if state == types.FileState.FAILED else None,
+        )
+
+    async def upload(self, *, file, config):
+        self.uploads.append(file.read())
+        self._step = 0
+        return self._file(len(self.uploads), self.states[0])
+
+    async def get(self, *, name):
+        self.gets += 1
+        self._step = min(self._step + 1, len(self.states) - 1)
+        return self._file(len(self.uploads), self.states[self._step])
+
+
+@pytest.fixture
+def index(tmp_path):
+    db = FileIndexDB(str(tmp_path / "files.sqlite3"))
+    yield db
+    db.close()
+
+
+def _make(index: FileIndexDB, files: StubFiles, clock=lambda: NOW) -> FileUploader:
+    client = SimpleNamespace(aio=SimpleNamespace(files=files))
+    return FileUploader(lambda: client, index, threshold=100, min_remaining=3600, poll_interval=0.01, clock=clock) # type: ignore
+
+
+def _part(data: bytes = b"a" * 200, mime_type: str = "audio/mpeg") -> dict:
+    return {"file_data": {"mime_type": mime_type, "data": data}}
+
+
+async def _resolve(uploader: FileUploader, part: dict) -> dict:
+    result = await uploader.resolve(part)
+    await uploader.index.flush()
+    return result
+
+
+def test_small_files_stay_inline(index):
+    files = StubFiles()
+    part = _part(b"a" * 10)
+    assert asyncio.run(_resolve(_make(index, files), part)) is part
+    assert files.uploads == []
+
+
+def test_uploads_once_and_reuses_uri(index):
+    async def run():
+        files = StubFiles()
+        uploader = _make(index, files)
+        first = await _resolve(uploader, _part())
+        second = await _resolve(uploader, _part())
+        assert first == second == {"file_uri": {"mime_type": "audio/mpeg", "uri": "https://example.invalid/files/1"}}
+        assert len(files.uploads) == 1
+        assert uploader.stats.reused == 1
+        # 別の内容はアップロードし直す
+        await _resolve(uploader, _part(b"b" * 200))
+        assert len(files.uploads) == 2
+    asyncio.run(run())
+
+
+def test_concurrent_uploads_are_shared(index):
+    async def run():
+        files = StubFiles([types.FileState.PROCESSING, types.FileState.ACTIVE])
+        uploader = _make(index, files)
+        results = await asyncio.gather(*(uploader.resolve(_part()) for _ in range(3)))
+        assert len({r["file_uri"]["uri"] for r in results}) == 1
+        assert len(files.uploads) == 1
+    asyncio.run(run())
+
+
+def test_waits_while_processing(index):
+    files = StubFiles([types.FileState.PROCESSING, types.FileState.PROCESSING, types.FileState.ACTIVE])
+    result = asyncio.run(_resolve(_make(index, files), _part()))
+    assert "file_uri" in result
+    assert files.gets == 2
+
+
+def test_failed_processing_falls_back_to_inline(index):
+    async def run():
+        files = StubFiles([types.FileState.PROCESSING, types.FileState.FAILED])
+        uploader = _make(index, files)
+        part = _part()
+        assert await _resolve(uploader, part) is part
+        assert uploader.stats.failures == 1
+        assert await index.get(f"audio/mpeg:{hashlib.sha256(part['file_data']['data']).hexdigest()}") is None
+    asyncio.run(run())
+
+
+def test_upload_error_falls_back_to_inline(index):
+    class BrokenFiles(StubFiles):
+        async def upload(self, *, file, config):
+            raise ConnectionError("files endpoint unreachable")
+
+    part = _part()
+    uploader = _make(index, BrokenFiles())
+    assert asyncio.run(_resolve(uploader, part)) is part
+    assert uploader.stats.failures == 1
+
+
+def test_processing_timeout_falls_back_to_inline(index):
+    files = StubFiles([types.FileState.PROCESSING])
+    uploader = _make(index, files)
+    uploader.processing_timeout = 0.05
+    part = _part()
+    assert asyncio.run(_resolve(uploader, part)) is part
+
+
+def test_reuploads_when_expiring(index):
+    async def run():
+        now = [NOW]
+        files = StubFiles(expires_in=2 * 3600)
+        uploader = _make(index, files, clock=lambda: now[0])
+        first = await _resolve(uploader, _part())
+        # 有効期限までの残りが min_remaining を切ったら使わない
+        now[0] += 1.5 * 3600
+        second = await _resolve(uploader, _part())
+        assert len(files.uploads) == 2
+        assert first != second
+    asyncio.run(run())
+
+
+def test_resolved_uri_counts_toward_token_estimate(index):
+    uploader = _make(index, StubFiles())
+    result = asyncio.run(_resolve(uploader, _part(b"a" * 16000 * 30)))
+    uri = result["file_uri"]["uri"]
+    turn = types.Content(role="user", parts=[types.Part.from_uri(file_uri=uri, mime_type="audio/mpeg")])
+    assert estimate_tokens(turn) == 30 * 32